@@ -0,0 +1,86 @@
+"""
+Benchmark of the accumulation of monthly DCIR results over a 24-month window.
+
+Compares the former accumulation (concat + drop_duplicates on the growing DataFrame at each month of flux)
+with SNDS_Query._collect (results gathered then deduplicated once), on a synthetic SQLite database.
+
+Usage (with pysnds installed, e.g. pip install -e .) : python benchmarks/accumulation.py [number of patients]
+"""
+
+import sys
+import time
+import sqlite3
+import random
+import pandas as pd
+from datetime import date, datetime, timedelta
+from dateutil.relativedelta import relativedelta
+
+from pysnds import SNDS_Query
+
+
+def synthetic_dcir(n_patients, seed=0):
+    '''
+    Build an in-memory SQLite database with IR_BEN_R, ER_PRS_F and ER_CAM_F covering 2020-2021.
+    '''
+
+    random.seed(seed)
+    conn = sqlite3.connect(':memory:')
+    key = ['FLX_DIS_DTD', 'FLX_TRT_DTD', 'FLX_EMT_TYP', 'FLX_EMT_NUM', 'FLX_EMT_ORD', 'ORG_CLE_NUM', 'DCT_ORD_NUM', 'PRS_ORD_NUM', 'REM_TYP_AFF']
+    conn.execute("CREATE TABLE IR_BEN_R (BEN_IDT_ANO TEXT, BEN_NIR_PSA TEXT, BEN_RNG_GEM INTEGER)")
+    conn.execute(f"CREATE TABLE ER_PRS_F ({', '.join(key)}, BEN_NIR_PSA TEXT, BEN_RNG_GEM INTEGER, EXE_SOI_DTD TEXT, EXE_SOI_DTF TEXT)")
+    conn.execute(f"CREATE TABLE ER_CAM_F ({', '.join(key)}, CAM_PRS_IDE TEXT)")
+
+    patients = [(f'ID{i:07d}', f'PSA{i:07d}', 1) for i in range(n_patients)]
+    conn.executemany("INSERT INTO IR_BEN_R VALUES (?, ?, ?)", patients)
+
+    prs, cam = [], []
+    for num, (_, psa, gem) in enumerate(p for p in patients for _ in range(20)):
+        soi = date(2020, 1, 1) + timedelta(days=random.randint(0, 729))
+        flx = (soi + relativedelta(months=random.randint(0, 2))).replace(day=1).isoformat()
+        row_key = (flx, flx, 1, 'E1', 1, 'O1', num, 1, 1)
+        prs.append(row_key + (psa, gem, soi.isoformat(), soi.isoformat()))
+        cam.append(row_key + (random.choice(['ACT0001', 'ACT0002', 'ACT0003', 'ACT0004']),))
+    conn.executemany(f"INSERT INTO ER_PRS_F VALUES ({', '.join('?' * 13)})", prs)
+    conn.executemany(f"INSERT INTO ER_CAM_F VALUES ({', '.join('?' * 10)})", cam)
+    conn.commit()
+    return conn, pd.DataFrame(patients, columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'])
+
+
+def incremental_collect(query, queries, columns):
+    '''
+    Former accumulation : the growing DataFrame is concatenated and deduplicated at each query.
+    '''
+
+    df = pd.DataFrame(columns=columns)
+    for sql in queries:
+        df = pd.concat([df, query.GetQuery(sql)], ignore_index=True)
+        df.drop_duplicates(inplace=True)
+        df.reset_index(drop=True, inplace=True)
+    return df
+
+
+if __name__ == '__main__':
+
+    n_patients = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    conn, df_ID_PATIENT = synthetic_dcir(n_patients)
+    query = SNDS_Query(conn, flux_loop=True)
+    years = [datetime(2020, 1, 1), datetime(2021, 12, 31)]
+    columns = ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'CAM_PRS_IDE', 'EXE_SOI_DTD', 'EXE_SOI_DTF']
+    queries = query._ccam_dcir_queries(df_ID_PATIENT, years, None)
+
+    # Results of the queries are fetched once beforehand, so that only the accumulation is timed
+    results = {sql: query.GetQuery(sql) for sql in queries}
+    query.GetQuery = lambda sql: results[sql]
+
+    start = time.perf_counter()
+    df_incremental = incremental_collect(query, queries, columns)
+    time_incremental = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_collect = query._collect(queries, columns=columns)
+    time_collect = time.perf_counter() - start
+
+    assert df_incremental.sort_values(columns).reset_index(drop=True).equals(df_collect.sort_values(columns).reset_index(drop=True))
+    print(f"{len(queries)} months of flux, {df_collect.shape[0]} rows")
+    print(f"concat + drop_duplicates at each month : {time_incremental:.2f}s")
+    print(f"single concat + drop_duplicates        : {time_collect:.2f}s")
@@ -1,5 +1,8 @@
 from .snds_query import SNDS_Query
 from .snds_treatment import SNDS_Treatment
 from .snds_bc import SNDS_BC
+from .snds_profiler import SNDS_Profiler
+from .snds_event_store import SNDS_EventStore
+from .snds_memo import SNDS_Memo
 
-__all__ = ["SNDS_Query", "SNDS_Treatment", "SNDS_BC"]
+__all__ = ["SNDS_Query", "SNDS_Treatment", "SNDS_BC", "SNDS_Profiler", "SNDS_EventStore", "SNDS_Memo"]
@@ -1,7 +1,6 @@
 from .snds_query import SNDS_Query
 from .snds_treatment import SNDS_Treatment
 import pkg_resources
-import sqlite3
 import json
 import pandas as pd
 import numpy as np
@@ -15,50 +14,28 @@ class SNDS_BC(SNDS_Treatment) :
     Class for computing Breast Cancer patients Statistical Analysis using the SNDS.
     """
 
-    def __init__(self, conn, df_ID_PATIENT):
+    def __init__(self, conn, df_ID_PATIENT, **kwargs):
 
         if set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}:
             raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-        self.conn = conn
-        
-        spark_session_type = None
-        if "pyspark" in str(type(conn)): 
-            try:
-                from pyspark.sql import SparkSession
-                spark_session_type = SparkSession
-            except ImportError:
-                raise ImportError("PySpark n'est pas installé, impossible d'utiliser Spark.")
-
-        # Spark
-        if spark_session_type is not None and isinstance(conn, spark_session_type):
-            self.conn = conn
-            self.backend = "spark"
-
-        # Sqlite
-        elif isinstance(conn, sqlite3.Connection):
-            self.conn = conn
-            self.backend = "sqlite"
+        if kwargs.get("lazy", False):
+            raise ValueError("SNDS_BC computes its statistics with pandas and does not support lazy=True.")
+
+        super().__init__(conn, **kwargs)
 
-        else:
-            raise TypeError(
-                f"Paramètre conn invalide : {type(conn)}. "
-                f"Attendu SparkSession ou sqlite3.Connection."
-            )
-            
-            
         self.df_ID_PATIENT = df_ID_PATIENT
         json_path = pkg_resources.resource_filename(__name__, 'BC_medical_codes.json')
         with open(json_path, 'r') as file:
             self.BC_medical_codes = json.load(file)
 
-        self.SNDS_query = SNDS_Query(self.conn)
-        self.SNDS_Treatment = SNDS_Treatment(self.conn)
+        self.SNDS_query = SNDS_Query(self.conn, **kwargs)
+        self.SNDS_Treatment = SNDS_Treatment(self.conn, **kwargs)
 
 
     def Get_ID(self):
         '''
-        Method for collecting unique identifiers of the population in IR_BEN_R.
+        Method for collecting unique identifiers of the population in IR_BEN_R. They are read from the identity index of the session (see identity_index).
 
         Returns
         -------
@@ -66,16 +43,7 @@ class SNDS_BC(SNDS_Treatment) :
             DataFrame containing the unique identifier of the population in a column named 'BEN_IDT_ANO'.
         '''
 
-        query_ID_patient =  """
-            SELECT DISTINCT
-            A.BEN_IDT_ANO,
-            A.BEN_NIR_PSA, 
-            A.BEN_RNG_GEM
-            FROM IR_BEN_R A
-
-        """
-
-        unique_id = self.GetQuery(query_ID_patient)
+        unique_id = self.identity_index()[['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM']].drop_duplicates().reset_index(drop=True)
     
         print('We have ' + str(unique_id.shape[0]) + ' distinct identifiers, ie. patients in the database.')
 
@@ -111,6 +79,11 @@ class SNDS_BC(SNDS_Treatment) :
         # First Treatment date
         df_first_treatment = self.first_date_treatment(self.BC_medical_codes['All_BC_Codes'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, dev=dev)
 
+        # With the memo, the procedures are extracted once for the population, each of them being then selected in memory for the patients without diagnosis date
+        if self.memo :
+            self.loc_ccam_dcir(list_CCAM=self.BC_medical_codes['Diag_Proc']['All']['CCAM'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False)
+            self.loc_ccam_pmsi(list_CCAM=self.BC_medical_codes['Diag_Proc']['All']['CCAM'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
+
         # Biopsy
         df_dates_diag_subset = df_dates_diag[df_dates_diag["Date_Diag"].isna()][['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM']].reset_index(drop=True)
         df_ccam_dcir_biopsy = self.loc_ccam_dcir(list_CCAM=self.BC_medical_codes['Diag_Proc']['Breast_core_biopsy']['CCAM'], df_ID_PATIENT=df_dates_diag_subset, years=years, print_option=False)
@@ -225,102 +198,42 @@ class SNDS_BC(SNDS_Treatment) :
         DataFrame containing the age at the time of enrollment (column DATE_DIAG) for each patient (BEN_IDT_ANO).
         '''
 
-        liste_benidtano_str = ', '.join(f"'{valeur}'" for valeur in np.unique(self.df_ID_PATIENT.BEN_IDT_ANO))
-        liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(self.df_ID_PATIENT.BEN_NIR_PSA))
+        cohort = self.register_cohort(self.df_ID_PATIENT)
 
         if (years is None) or (not isinstance(years, list)):
             raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
 
-        if isinstance(years[0], datetime):
-            flxmin_year = years[0].year
-            year_deb = int(str(years[0].year)[-2:])
-            deb = years[0]
-        else:
-            flxmin_year = years[0]
-            year_deb = str(years[0])[-2:]
-            deb = datetime(years[0], 1, 1)
-
-        if isinstance(years[1], datetime):
-            end = years[1]
-            year_end = int(str(years[1].year)[-2:])
-            flxmax_year = years[1].year
-        else:
-            end = datetime(years[1], 12, 31)
-            year_end = str(years[1])[-2:]
-            flxmax_year = years[1]
-
-        flxmin = datetime(flxmin_year, 1, 1)
-        flxmax_date = (end + relativedelta(months=6)).replace(day=1)
-        vecflx = []
-        current_date = flxmin
-        while current_date <= flxmax_date:
-            vecflx.append(current_date.strftime("%Y-%m-%d"))
-            current_date += relativedelta(months=1)
-
-        top_ER_PRS_F = True
-
-        # if self.backend == 'sqlite':
-        #     cursor = self.conn.cursor()
-        #     cursor.execute(
-        #     "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
-        #     ('E_PRS_F',)
-        #     )
-        #     top_ER_PRS_F = cursor.fetchone() is not None
-
-        if self.backend == 'spark':
-            top_ER_PRS_F = self.conn.catalog.tableExists('ER_PRS_F')
-
-
         # DCIR
-        age_dcir = pd.DataFrame(columns=['BEN_NIR_PSA', 'BEN_RNG_GEM', 'BEN_IDT_ANO', 'EXE_SOI_DTD', 'BEN_AMA_COD'])
+        frames_dcir = [pd.DataFrame(columns=['BEN_NIR_PSA', 'BEN_RNG_GEM', 'BEN_IDT_ANO', 'EXE_SOI_DTD', 'BEN_AMA_COD'])]
 
-        if top_ER_PRS_F==True :
+        identity_columns, identity_join, patient_conditions = self._identity_sql(self.df_ID_PATIENT, 'A', 'B', ['BEN_NIR_PSA', 'BEN_RNG_GEM'])
 
-            for flux in vecflx:
-                query_AGE_DCIR = f"""
+        queries_AGE_DCIR = []
+        for suffix, flux_conditions in self._dcir_partitions(years, 'A'):
 
-                    SELECT  
-                    A.BEN_NIR_PSA,      
-                    A.BEN_RNG_GEM,
-                    B.BEN_IDT_ANO,  
-                    A.EXE_SOI_DTD,
-                    A.BEN_AMA_COD
-                    FROM ER_PRS_F A
+            where_condition = "WHERE " + " AND ".join(flux_conditions + patient_conditions)
 
-                    INNER JOIN IR_BEN_R B
-                    ON B.BEN_NIR_PSA = A.BEN_NIR_PSA AND B.BEN_RNG_GEM = A.BEN_RNG_GEM
-
-                    WHERE A.FLX_DIS_DTD = '{flux}' AND B.BEN_IDT_ANO IN ({liste_benidtano_str}) AND B.BEN_NIR_PSA IN ({liste_bennirpsa_str})
-                """
-                df_flux = self.GetQuery(query_AGE_DCIR)
-                age_dcir = pd.concat([age_dcir, df_flux], ignore_index=True)
-                age_dcir['EXE_SOI_DTD'] = pd.to_datetime(age_dcir['EXE_SOI_DTD']) 
-                age_dcir.drop_duplicates(inplace=True)
-
-        else :
-            yy = list(range(int(flxmin_year), (int(flxmax_year)+1)))
+            queries_AGE_DCIR.append(f"""
 
-            for year in yy :
+                SELECT  
+                A.BEN_NIR_PSA,      
+                A.BEN_RNG_GEM,
+                {identity_columns['BEN_IDT_ANO']},  
+                A.EXE_SOI_DTD,
+                A.BEN_AMA_COD
+                FROM ER_PRS_F{suffix} A
 
-                query_AGE_DCIR = f"""
+                {identity_join}
 
-                    SELECT 
-                    A.BEN_NIR_PSA,      
-                    A.BEN_RNG_GEM,
-                    B.BEN_IDT_ANO,  
-                    A.EXE_SOI_DTD,
-                    A.BEN_AMA_COD
-                    FROM ER_PRS_F_{year} A
+                {where_condition}
+            """)
+        frames_dcir += self._run_queries(queries_AGE_DCIR)
 
-                    INNER JOIN IR_BEN_R B
-                    ON B.BEN_NIR_PSA = A.BEN_NIR_PSA AND B.BEN_RNG_GEM = A.BEN_RNG_GEM
-
-                    WHERE B.BEN_IDT_ANO IN ({liste_benidtano_str}) AND B.BEN_NIR_PSA IN ({liste_bennirpsa_str})
-                """
-                df_flux = self.GetQuery(query_AGE_DCIR)
-                age_dcir = pd.concat([age_dcir, df_flux], ignore_index=True)
-                age_dcir['EXE_SOI_DTD'] = pd.to_datetime(age_dcir['EXE_SOI_DTD']) 
-                age_dcir.drop_duplicates(inplace=True)
+        age_dcir = pd.concat(frames_dcir, ignore_index=True)
+        if identity_join == "":
+            age_dcir = self._map_identities(age_dcir, self.identity_index(self.df_ID_PATIENT), ['BEN_NIR_PSA', 'BEN_RNG_GEM'])
+        age_dcir['EXE_SOI_DTD'] = pd.to_datetime(age_dcir['EXE_SOI_DTD']) 
+        age_dcir.drop_duplicates(inplace=True)
 
         # PMSI
         age_pmsi = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'EXE_SOI_DTD', 'AGE_ANN'])
@@ -342,19 +255,18 @@ class SNDS_BC(SNDS_Treatment) :
                 INNER JOIN IR_BEN_R C
                 ON A.NIR_ANO_17 = C.BEN_NIR_PSA
 
-                WHERE C.BEN_IDT_ANO IN ({liste_benidtano_str}) AND C.BEN_NIR_PSA IN ({liste_bennirpsa_str})
+                WHERE C.BEN_IDT_ANO IN (SELECT BEN_IDT_ANO FROM {cohort}) AND C.BEN_NIR_PSA IN (SELECT BEN_NIR_PSA FROM {cohort})
             """
             age_pmsi = self.GetQuery(query_AGE_PMSI)
             age_pmsi['EXE_SOI_DTD'] = pd.to_datetime(age_pmsi['EXE_SOI_DTD'])  
             age_pmsi.drop_duplicates(inplace=True)
 
         else :
-            yy = list(range(int(year_deb), int(year_end)+1))
-
-            for year in yy :
+            queries_AGE_PMSI = []
+            for year in self._pmsi_partitions(years, dev) :
                 table_nameB = f"T_MCO{year}B"
                 table_nameC = f"T_MCO{year}C"
-                query_AGE_PMSI = f"""
+                queries_AGE_PMSI.append(f"""
 
                     SELECT DISTINCT
                     C.BEN_IDT_ANO, 
@@ -370,12 +282,12 @@ class SNDS_BC(SNDS_Treatment) :
                     INNER JOIN IR_BEN_R C
                     ON A.NIR_ANO_17 = C.BEN_NIR_PSA
 
-                    WHERE C.BEN_IDT_ANO IN ({liste_benidtano_str}) AND C.BEN_NIR_PSA IN ({liste_bennirpsa_str})
-                """
-                df_flux = self.GetQuery(query_AGE_PMSI)
-                age_pmsi = pd.concat([age_pmsi, df_flux], ignore_index=True)
-                age_pmsi['EXE_SOI_DTD'] = pd.to_datetime(age_pmsi['EXE_SOI_DTD'])  
-                age_pmsi.drop_duplicates(inplace=True)
+                    WHERE C.BEN_IDT_ANO IN (SELECT BEN_IDT_ANO FROM {cohort}) AND C.BEN_NIR_PSA IN (SELECT BEN_NIR_PSA FROM {cohort})
+                """)
+
+            age_pmsi = pd.concat([age_pmsi] + self._run_queries(queries_AGE_PMSI), ignore_index=True)
+            age_pmsi['EXE_SOI_DTD'] = pd.to_datetime(age_pmsi['EXE_SOI_DTD'])  
+            age_pmsi.drop_duplicates(inplace=True)
 
         # AGE
         age_pmsi = age_pmsi.rename(columns={'AGE_ANN': 'AGE'})
@@ -603,9 +515,8 @@ class SNDS_BC(SNDS_Treatment) :
 
         df_ET = self.treatment_dates(self.BC_medical_codes['ET']['All'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, dev=dev)
         df_ET['DATE'] = pd.to_datetime(df_ET['DATE'])
+        df_ET = df_ET[df_ET.COD_CIP.notna()].copy()
         df_ET['COD_CIP'] = df_ET['COD_CIP'].astype(str)
-        df_ET.replace('nan', np.nan, inplace=True)
-        df_ET = df_ET[df_ET.COD_CIP.notna()] 
         df_ET = df_ET.sort_values(by=['BEN_IDT_ANO', 'DATE'])
 
         def determine_ET_treatment(group):
@@ -692,21 +603,28 @@ class SNDS_BC(SNDS_Treatment) :
 
         ### Age
         df = self.Age_Diagnosis(years=years, dev=dev)
+
+        # The occurrence of all the events is computed in a single pass
+        df_events = self.Had_Treatments({'Nodal_Status': self.BC_medical_codes['Diag_NodalStatus'],
+                                         'Mastectomy': self.BC_medical_codes['Surgery_BC']['Mastectomy'],
+                                         'Partial_Mastectomy': self.BC_medical_codes['Surgery_BC']['Partial_Mastectomy'],
+                                         'CT': self.BC_medical_codes['CT'],
+                                         'RT': self.BC_medical_codes['RT'],
+                                         'TT': self.BC_medical_codes['TT']['Pertuzumab'],
+                                         'ET': self.BC_medical_codes['ET']['All']}, 
+                                        df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
         
         ### Nodal Status
-        df_nodal_status = self.Had_Treatment(self.BC_medical_codes['Diag_NodalStatus'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
-        df_nodal_status.rename(columns={'Response' : 'Nodal_Status'}, inplace=True)
+        df_nodal_status = df_events[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'Nodal_Status']]
         df = df.merge(df_nodal_status, on=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'], how='left')
 
         ### Surgery
         # Mastectomy
-        df_masectomy = self.Had_Treatment(self.BC_medical_codes['Surgery_BC']['Mastectomy'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
-        df_masectomy.rename(columns={'Response' : 'Mastectomy'}, inplace=True)
+        df_masectomy = df_events[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'Mastectomy']]
         df = df.merge(df_masectomy, on=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'], how='left')
 
         # Partial Mastectomy
-        df_partial_masectomy = self.Had_Treatment(self.BC_medical_codes['Surgery_BC']['Partial_Mastectomy'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
-        df_partial_masectomy.rename(columns={'Response' : 'Partial_Mastectomy'}, inplace=True)
+        df_partial_masectomy = df_events[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'Partial_Mastectomy']]
         df = df.merge(df_partial_masectomy, on=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'], how='left')
 
         # Surgery
@@ -715,8 +633,7 @@ class SNDS_BC(SNDS_Treatment) :
 
         ### Chemotherapy
         # Yes / No
-        df_CT = self.Had_Treatment(self.BC_medical_codes['CT'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
-        df_CT.rename(columns={'Response' : 'CT'}, inplace=True)
+        df_CT = df_events[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'CT']]
         df = df.merge(df_CT, on=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'], how='left')
 
         # Setting
@@ -731,8 +648,7 @@ class SNDS_BC(SNDS_Treatment) :
 
         ### Radiotherapy
         # Yes / No
-        df_RT = self.Had_Treatment(self.BC_medical_codes['RT'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
-        df_RT.rename(columns={'Response' : 'RT'}, inplace=True)
+        df_RT = df_events[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'RT']]
         df = df.merge(df_RT, on=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'], how='left')
 
         # Setting
@@ -743,8 +659,7 @@ class SNDS_BC(SNDS_Treatment) :
 
         ### TT
         # Yes / No
-        df_TT = self.Had_Treatment(self.BC_medical_codes['TT']['Pertuzumab'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
-        df_TT.rename(columns={'Response' : 'TT'}, inplace=True)
+        df_TT = df_events[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'TT']]
         df = df.merge(df_TT, on=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'], how='left')
 
         # Setting
@@ -755,8 +670,7 @@ class SNDS_BC(SNDS_Treatment) :
         
         ### ET
         # Yes / No
-        df_ET = self.Had_Treatment(self.BC_medical_codes['ET']['All'], df_ID_PATIENT=self.df_ID_PATIENT, years=years, print_option=False, dev=dev)
-        df_ET.rename(columns={'Response' : 'ET'}, inplace=True)
+        df_ET = df_events[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'ET']]
         df = df.merge(df_ET, on=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'], how='left')
 
         # Setting
@@ -0,0 +1,111 @@
+import numpy as np
+
+
+class SNDS_EventStore() :
+    """
+    Class holding the events of a targeted population extracted once from the DCIR and the PMSI for a dictionary of codes,
+    so that the events of any dictionary of codes it contains are selected in memory instead of being queried again.
+    """
+
+    COLUMNS = ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'DATE', 'SOURCE', 'CODE_SYSTEM', 'CODE', 'DGN_REL', 'ASS_DGN', 'ATC']
+    CODE_SYSTEMS = ['CCAM', 'ICD10', 'UCD', 'CIP13']
+
+    def __init__(self, df_events, code_sets, population, period, dev):
+        '''
+        Parameters
+        ----------
+        df_events : DataFrame
+            Events, one row per row of the results of the loc_* methods, with the columns of COLUMNS : identifiers of the patient, date of the event ('DATE'),
+            'SOURCE' ('DCIR' or 'PMSI'), 'CODE_SYSTEM' (one of CODE_SYSTEMS), 'CODE', the related diagnoses of the ICD-10 events ('DGN_REL', 'ASS_DGN')
+            and the ATC class ('ATC', PHA_ATC_C07) of the UCD and CIP-13 events.
+        code_sets : dict
+            Codes extracted for each type of code of CODE_SYSTEMS : True for all the codes of the type, a set of codes, or None if the type was not extracted.
+        population : DataFrame or None
+            Targeted population of the extraction, as registered by register_cohort, None if no filter was applied on patients.
+        period : tuple
+            Start and end dates of the extraction.
+        dev : bool
+            True if the events were extracted from a simulated dataset.
+        '''
+
+        super(SNDS_EventStore, self).__init__()
+
+        # Events are stored by patient and date, with the repeated values as categories
+        df_events = df_events[self.COLUMNS].sort_values(['BEN_IDT_ANO', 'DATE'], kind='stable').reset_index(drop=True)
+        self.events = df_events.astype({col: 'category' for col in ['SOURCE', 'CODE_SYSTEM', 'CODE', 'DGN_REL', 'ASS_DGN', 'ATC']})
+        self.code_sets = code_sets
+        self.period = period
+        self.dev = dev
+        self._population = None if population is None else (set(population['BEN_IDT_ANO']), set(population['BEN_NIR_PSA']))
+        self._identifiers = None
+
+
+    def memory_usage(self):
+        '''
+        Return the memory used by the events, in bytes.
+        '''
+
+        return int(self.events.memory_usage(deep=True).sum())
+
+
+    def covers(self, code_sets, df_ID_PATIENT, period, dev):
+        '''
+        Return True if the events of the codes code_sets (as in the constructor), for the population df_ID_PATIENT and the period, can be selected from the store :
+        the store was extracted for the same period and dataset, for a population containing df_ID_PATIENT, and for all these codes.
+        '''
+
+        if (period != self.period) or (dev != self.dev):
+            return False
+
+        if self._population is not None:
+            if (df_ID_PATIENT is None) or df_ID_PATIENT.empty:
+                return False
+            identifiers, nir_psa = self._population
+            if not (set(df_ID_PATIENT['BEN_IDT_ANO'].astype(str)) <= identifiers and set(df_ID_PATIENT['BEN_NIR_PSA'].astype(str)) <= nir_psa):
+                return False
+
+        for key, codes in code_sets.items():
+            if codes is None:
+                continue
+            if self.code_sets.get(key) is None:
+                return False
+            if (self.code_sets[key] is not True) and ((codes is True) or not (codes <= self.code_sets[key])):
+                return False
+        return True
+
+
+    def select(self, code_system, codes, source, df_ID_PATIENT=None):
+        '''
+        Return the events of a type of code and a source ('DCIR' or 'PMSI'), restricted to codes (True for all the codes) and to the population df_ID_PATIENT,
+        in the order of the store. The ICD-10 events match on their main diagnosis ('CODE'), related diagnosis ('DGN_REL') or associated diagnosis ('ASS_DGN').
+        '''
+
+        mask = (self.events['CODE_SYSTEM'] == code_system).to_numpy() & (self.events['SOURCE'] == source).to_numpy()
+
+        if codes is not True:
+            columns = ['CODE', 'DGN_REL', 'ASS_DGN'] if code_system == 'ICD10' else ['CODE']
+            matches = np.zeros(len(self.events), dtype=bool)
+            for column in columns:
+                matches |= self._isin(self.events[column], codes)
+            mask &= matches
+
+        if (df_ID_PATIENT is not None) and (not df_ID_PATIENT.empty):
+            # Identifiers are compared as strings, as in the cohort tables, the events of the population of the store need no filter
+            population = (set(df_ID_PATIENT['BEN_IDT_ANO'].astype(str)), set(df_ID_PATIENT['BEN_NIR_PSA'].astype(str)))
+            if population != self._population:
+                if self._identifiers is None:
+                    self._identifiers = (self.events['BEN_IDT_ANO'].astype(str), self.events['BEN_NIR_PSA'].astype(str))
+                mask &= self._identifiers[0].isin(population[0]).to_numpy() & self._identifiers[1].isin(population[1]).to_numpy()
+
+        return self.events.loc[mask]
+
+
+    @staticmethod
+    def _isin(column, codes):
+        '''
+        Vectorized membership test of a categorical column in a set of codes compared as strings : the test is made once per category.
+        '''
+
+        # The code -1 of missing values selects the last element, False
+        hits = np.append(column.cat.categories.astype(str).isin(codes), False)
+        return hits[column.cat.codes.to_numpy()]
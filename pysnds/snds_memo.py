@@ -0,0 +1,173 @@
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+
+class SNDS_Memo() :
+    """
+    Class keeping in memory the results of the extractions of a session, so that a later call contained in a previous one
+    (subset of the codes, sub-population or narrower period) is answered by filtering its result instead of querying the database again.
+    """
+
+    def __init__(self, max_size=2**28):
+        '''
+        Parameters
+        ----------
+        max_size : int, optional
+            Maximal memory used by the stored results, in bytes. The least recently used results are evicted beyond it. Default is 2**28 (256 MiB).
+        '''
+
+        super(SNDS_Memo, self).__init__()
+
+        if (type(max_size) != int) or (max_size <= 0):
+            raise ValueError("max_size must be a positive integer.")
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+
+    def lookup(self, method, codes, population, period, partitions, dev):
+        '''
+        Return the result of a call of method from a stored result containing it, filtered in memory, or None if there is none.
+
+        Parameters
+        ----------
+        method : string
+            Name of the extraction (e.g. 'loc_ccam_dcir').
+        codes : frozenset or None
+            Codes of the call, as strings, None for all the codes.
+        population : tuple or None
+            Frozensets of the 'BEN_IDT_ANO' and 'BEN_NIR_PSA' of the targeted population, as strings, None if no filter is applied on patients.
+        period : tuple
+            Start and end dates of the call.
+        partitions : string or None
+            Description of the partitions of the DCIR or years of the PMSI read for the period : a narrower period is only served from a result reading the same partitions.
+        dev : bool
+            True for a simulated dataset.
+
+        Returns
+        -------
+        df : DataFrame or None
+            Copy of the rows of the stored result matching the call.
+        '''
+
+        with self._lock:
+            candidates = [(key, entry) for key, entry in self._entries.items() if self._covers(entry, method, codes, population, period, partitions, dev)]
+            if len(candidates) == 0:
+                self.misses += 1
+                return None
+
+            # The smallest result containing the call is the fastest to filter
+            key, entry = min(candidates, key=lambda candidate: candidate[1]['size'])
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        df = entry['df']
+        mask = np.ones(len(df), dtype=bool)
+        if (codes != entry['codes']) and (entry['code_columns'] is not None):
+            matches = np.zeros(len(df), dtype=bool)
+            for column in entry['code_columns']:
+                matches |= df[column].astype(str).isin(codes).to_numpy() & df[column].notna().to_numpy()
+            mask &= matches
+        if population != entry['population']:
+            mask &= df['BEN_IDT_ANO'].astype(str).isin(population[0]).to_numpy() & df['BEN_NIR_PSA'].astype(str).isin(population[1]).to_numpy()
+        if period != entry['period']:
+            mask &= self._in_period(df[entry['date_column']], period)
+
+        return df.loc[mask].reset_index(drop=True)
+
+
+    def store(self, method, codes, population, period, partitions, dev, df, code_columns, date_column):
+        '''
+        Keep a copy of the result df of a call of method (see lookup for the other parameters), and evict the least recently used results beyond max_size.
+        The stored results contained in df are removed.
+
+        Parameters
+        ----------
+        code_columns : list or None
+            Columns of df holding the codes, a row matching a subset of the codes when one of them is in it. If None, the result only serves the same codes.
+        date_column : string or None
+            Column of df holding the date filtered by the period. If None, the result only serves the same period.
+        '''
+
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_size:
+            return
+
+        entry = {'method': method, 'codes': codes, 'population': population, 'period': period, 'partitions': partitions, 'dev': dev,
+                 'df': df.copy(), 'code_columns': code_columns, 'date_column': date_column, 'size': size}
+
+        with self._lock:
+            for key in [key for key, other in self._entries.items() if self._covers(entry, other['method'], other['codes'], other['population'], other['period'], other['partitions'], other['dev'])]:
+                self._size -= self._entries.pop(key)['size']
+
+            self._entries[(method, codes, population, period, partitions, dev)] = entry
+            self._size += size
+
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted['size']
+
+
+    def info(self):
+        '''
+        Return the number of hits and misses, the number of stored results and their size in bytes.
+        '''
+
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "size": self._size}
+
+
+    def clear(self):
+        '''
+        Delete the stored results.
+        '''
+
+        with self._lock:
+            self._entries = OrderedDict()
+            self._size = 0
+
+
+    @staticmethod
+    def _covers(entry, method, codes, population, period, partitions, dev):
+        '''
+        Return True if the stored result entry contains the result of the call (see lookup).
+        '''
+
+        if (method != entry['method']) or (dev != entry['dev']) or (partitions != entry['partitions']):
+            return False
+
+        if entry['code_columns'] is None:
+            if codes != entry['codes']:
+                return False
+        elif (entry['codes'] is not None) and ((codes is None) or not (codes <= entry['codes'])):
+            return False
+
+        if entry['population'] is not None:
+            if (population is None) or not (population[0] <= entry['population'][0] and population[1] <= entry['population'][1]):
+                return False
+
+        if entry['date_column'] is None:
+            return period == entry['period']
+        return (entry['period'][0] <= period[0]) and (period[1] <= entry['period'][1])
+
+
+    @staticmethod
+    def _in_period(values, period):
+        '''
+        Vectorized test of the dates of values between the start and end dates of period, compared as in the SQL queries :
+        as strings 'yyyy-mm-dd' when the dates are stored as text, as timestamps otherwise.
+        '''
+
+        deb, end = period[0].strftime('%Y-%m-%d'), period[1].strftime('%Y-%m-%d')
+        if pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+            values = values.fillna('').astype(str)
+            return ((values >= deb) & (values <= end)).to_numpy(dtype=bool)
+
+        dates = pd.to_datetime(values)
+        return (dates.notna() & (dates >= pd.Timestamp(deb)) & (dates <= pd.Timestamp(end))).to_numpy(dtype=bool)
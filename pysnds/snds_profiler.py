@@ -0,0 +1,174 @@
+import re
+import json
+import hashlib
+import threading
+import pandas as pd
+from datetime import datetime
+
+
+class SNDS_Profiler() :
+    """
+    Class for recording the SQL queries executed by SNDS_Query instances, to find which queries of a study are slow.
+    """
+
+    COLUMNS = ['START', 'METHOD', 'FINGERPRINT', 'TABLES', 'BACKEND', 'CACHED', 'WALL_TIME', 'FETCH_TIME', 'ROWS', 'BYTES']
+
+    def __init__(self, hook=None):
+        '''
+        Parameters
+        ----------
+        hook : callable, optional
+            Function called with each record (a dict with the keys of COLUMNS), e.g. to send it to a logger. Default is None.
+        '''
+
+        super(SNDS_Profiler, self).__init__()
+
+        if (hook is not None) and (not callable(hook)):
+            raise ValueError("hook must be a callable.")
+
+        self.hook = hook
+        self.records = []
+        self._lock = threading.Lock()
+
+
+    def record(self, query, method, backend, rows, size, wall_time, fetch_time, cached=False, start=None):
+        '''
+        Method for recording the execution of a query.
+
+        Parameters
+        ----------
+        query : string
+            SQL query.
+        method : string
+            Name of the SNDS_Query method which executed the query (e.g. 'loc_ccam_dcir').
+        backend : string
+            Backend of the connection ('sqlite', 'spark' or 'duckdb').
+        rows : int
+            Number of rows of the result.
+        size : int
+            Memory used by the result, in bytes.
+        wall_time : float
+            Time in seconds between the submission of the query and the end of the transfer of its result.
+        fetch_time : float
+            Part of wall_time spent transferring the result from the database. With Spark, the query is executed during the transfer.
+        cached : bool, optional
+            If True, the result was read from the query cache. Default is False.
+        start : datetime, optional
+            Date of the submission of the query. Default is None, i.e. now.
+
+        Returns
+        -------
+        record : dict
+            Recorded information.
+        '''
+
+        record = {
+            'START': (start or datetime.now()).isoformat(timespec='milliseconds'),
+            'METHOD': method,
+            'FINGERPRINT': self.fingerprint(query),
+            'TABLES': ', '.join(self.tables(query)),
+            'BACKEND': backend,
+            'CACHED': bool(cached),
+            'WALL_TIME': wall_time,
+            'FETCH_TIME': fetch_time,
+            'ROWS': rows,
+            'BYTES': size,
+        }
+
+        with self._lock:
+            self.records.append(record)
+        if self.hook is not None:
+            self.hook(record)
+        return record
+
+
+    def to_frame(self):
+        '''
+        Method for gathering the records in a DataFrame, one row per executed query.
+
+        Returns
+        -------
+        df : DataFrame
+            DataFrame whose columns are COLUMNS.
+        '''
+
+        with self._lock:
+            return pd.DataFrame(list(self.records), columns=self.COLUMNS)
+
+
+    def summary(self):
+        '''
+        Method for aggregating the records by method and query fingerprint, slowest first.
+
+        Returns
+        -------
+        df : DataFrame
+            DataFrame containing, for each method ('METHOD'), fingerprint ('FINGERPRINT') and tables ('TABLES'), the number of executions ('N_QUERIES')
+            and the sums of 'WALL_TIME', 'FETCH_TIME', 'ROWS' and 'BYTES'.
+        '''
+
+        df = self.to_frame()
+        df['N_QUERIES'] = 1
+        df = df.groupby(['METHOD', 'FINGERPRINT', 'TABLES'], dropna=False, as_index=False)[['N_QUERIES', 'WALL_TIME', 'FETCH_TIME', 'ROWS', 'BYTES']].sum()
+        return df.sort_values('WALL_TIME', ascending=False).reset_index(drop=True)
+
+
+    def to_json(self, path=None):
+        '''
+        Method for exporting the records in JSON format, as a list of objects.
+
+        Parameters
+        ----------
+        path : str, optional
+            Path of the JSON file. If None, the JSON string is returned instead. Default is None.
+
+        Returns
+        -------
+        json : string or None
+            JSON string if path is None.
+        '''
+
+        with self._lock:
+            records = list(self.records)
+
+        if path is None:
+            return json.dumps(records)
+        with open(path, 'w') as file:
+            json.dump(records, file)
+
+
+    def reset(self):
+        '''
+        Method for deleting the records.
+        '''
+
+        with self._lock:
+            self.records = []
+
+
+    @staticmethod
+    def fingerprint(query):
+        '''
+        Return a hash identifying the shape of a SQL query : string and numeric literals, lists of values, cohort and stay tables are ignored,
+        so that the queries of a method share their fingerprint whatever the codes, period and population.
+        '''
+
+        shape = re.sub(r"'(?:[^']|'')*'", "?", query)
+        shape = re.sub(r"\b\d+(\.\d+)?\b", "?", shape)
+        shape = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", shape)
+        shape = re.sub(r"\b(COHORT|STAYS)_\w+", r"\1", shape)
+        shape = re.sub(r"\s+", " ", shape).strip()
+        return hashlib.sha1(shape.encode()).hexdigest()[:16]
+
+
+    @staticmethod
+    def tables(query):
+        '''
+        Return the tables read by a SQL query, in order of appearance, without the cohort and stay tables.
+        '''
+
+        tables = []
+        for table in re.findall(r"\b(?:FROM|JOIN)\s+([A-Za-z_][\w.]*)", query, flags=re.IGNORECASE):
+            if (not table.upper().startswith(("COHORT_", "STAYS_"))) and (table not in tables):
+                tables.append(table)
+        return tables
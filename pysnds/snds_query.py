@@ -1,8 +1,22 @@
+import os
+import re
+import sys
+import json
+import shutil
+import time
 import sqlite3
+import hashlib
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 import pandas as pd
 import numpy as np
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from .snds_profiler import SNDS_Profiler
+from .snds_memo import SNDS_Memo
 
 
 class SNDS_Query() :
@@ -10,12 +24,53 @@ class SNDS_Query() :
     Class for navigating and identifying population in the SNDS.    
     """
 
-    def __init__(self, conn):
+    def __init__(self, conn, arrow=False, flux_loop=False, max_workers=1, lazy=False, cache=False, cache_dir=None, cache_size=2**30, profiler=None, batch_size=100000, batch_time=60.0, incremental=False, memo=False, memo_size=2**28):
         '''
         Parameters
         ----------
-        conn : sqlite3.Connection or pyspark.sql.session.SparkSession.
-            Connection to the database.
+        conn : sqlite3.Connection, pyspark.sql.session.SparkSession or duckdb.DuckDBPyConnection.
+            Connection to the database. With DuckDB, the SNDS tables can be exposed from Parquet files with register_parquet.
+        arrow : bool, optional
+            If True, query results are fetched as Arrow record batches and returned as DataFrames backed by pyarrow types, 
+            instead of being boxed into Python tuples. Requires pyarrow. Default is False.
+        flux_loop : bool, optional
+            If True, the DCIR is queried one month of flux (FLX_DIS_DTD) at a time, which bounds the size of each intermediate result. 
+            If False, a single query covers all the months of flux of the period, letting the engine prune ER_PRS_F in one scan. Default is False.
+        max_workers : int, optional
+            Number of sub-queries (years of the PMSI, months of flux or years of the DCIR) executed concurrently. 
+            With SQLite each worker reads through its own read-only connection to the database file, with Spark the sub-queries are submitted as concurrent jobs. 
+            Results are merged in the order of the sub-queries, so they do not depend on max_workers. Default is 1 (sequential execution).
+        lazy : bool, optional
+            Only with a SparkSession. If True, the loc_* methods and the SNDS_Treatment aggregations return Spark DataFrames 
+            instead of collecting their results to the driver ; use collect to retrieve a pandas DataFrame. Default is False.
+        cache : bool, optional
+            If True, the results of GetQuery are stored as Parquet files in cache_dir and reused when the same query is executed again on the same data, 
+            including in another session. Requires pyarrow. The cache can be switched on or off at any time through the attribute cache. Default is False.
+        cache_dir : str, optional
+            Directory of the query cache. Default is None, i.e. ~/.cache/pysnds.
+        cache_size : int, optional
+            Maximal size of the query cache in bytes. The least recently used results are deleted beyond it. Default is 2**30 (1 GiB).
+        profiler : SNDS_Profiler, optional
+            If given, every query executed by GetQuery is recorded in it (calling method, tables, wall and fetch times, rows and bytes). 
+            The same profiler can be shared by several instances to profile a whole study. Default is None.
+        batch_size : int, optional
+            Number of patients of the targeted population queried at once by the loc_* methods. A larger population is split into ceil(n / batch_size) batches 
+            of about batch_size patients (by a hash of BEN_NIR_PSA, so that twins stay together) queried one after the other, or max_workers batches at a time. 
+            The batches only depend on the population, so that the query cache and the incremental store are reused when the extraction is run again. Default is 100000.
+        batch_time : float, optional
+            Duration in seconds aimed at for a round of concurrent batches : fewer batches are queried at a time when a round is slower, 
+            and more (up to max_workers) when it is faster. Default is 60.0.
+        incremental : bool, optional
+            If True, the DCIR is queried one month of flux at a time and the results of each month of flux of the DCIR and each year of the PMSI are stored 
+            in cache_dir/incremental, with the last month of flux and year available in the database (watermarks). 
+            A later session on the same database reuses the months and years which were complete when they were stored (a later month or year existed) 
+            and only queries the new ones. Requires pyarrow. Default is False.
+        memo : bool, optional
+            If True, the results of the loc_* methods and of first_date_treatment are kept in memory for the session, and a later call contained in a previous one 
+            (subset of its codes, of its population, or narrower period reading the same partitions) is answered by filtering the previous result in memory. 
+            The memo can be switched on or off at any time through the attribute memo. Default is False.
+        memo_size : int, optional
+            Maximal memory used by the memo in bytes. The least recently used results are evicted beyond it. Default is 2**28 (256 MiB).
         '''
 
         super(SNDS_Query, self).__init__()
@@ -28,51 +83,1666 @@ class SNDS_Query() :
             except ImportError:
                 raise ImportError("PySpark n'est pas installé, impossible d'utiliser Spark.")
 
+        duckdb_connection_type = None
+        if "duckdb" in str(type(conn)):
+            try:
+                import duckdb
+                duckdb_connection_type = duckdb.DuckDBPyConnection
+            except ImportError:
+                raise ImportError("DuckDB n'est pas installé, impossible d'utiliser DuckDB.")
+
         # Spark
         if spark_session_type is not None and isinstance(conn, spark_session_type):
             self.conn = conn
             self.backend = "spark"
 
-        # Vérifier sqlite
-        elif isinstance(conn, sqlite3.Connection):
-            self.conn = conn
-            self.backend = "sqlite"
+        # DuckDB
+        elif duckdb_connection_type is not None and isinstance(conn, duckdb_connection_type):
+            self.conn = conn
+            self.backend = "duckdb"
+
+        # Vérifier sqlite
+        elif isinstance(conn, sqlite3.Connection):
+            self.conn = conn
+            self.backend = "sqlite"
+
+        else:
+            raise TypeError(
+                f"Paramètre conn invalide : {type(conn)}. "
+                f"Attendu SparkSession, sqlite3.Connection ou duckdb.DuckDBPyConnection."
+            )
+
+        if (type(max_workers) != int) or (max_workers < 1):
+            raise ValueError("max_workers must be a positive integer.")
+
+        if lazy and self.backend != "spark":
+            raise ValueError("lazy=True is only available with a SparkSession.")
+
+        if (type(cache_size) != int) or (cache_size <= 0):
+            raise ValueError("cache_size must be a positive integer.")
+
+        if (type(memo_size) != int) or (memo_size <= 0):
+            raise ValueError("memo_size must be a positive integer.")
+
+        if (profiler is not None) and (not isinstance(profiler, SNDS_Profiler)):
+            raise ValueError("profiler must be an instance of SNDS_Profiler.")
+
+        if (type(batch_size) != int) or (batch_size < 1):
+            raise ValueError("batch_size must be a positive integer.")
+
+        if (not isinstance(batch_time, (int, float))) or (batch_time <= 0):
+            raise ValueError("batch_time must be a positive number of seconds.")
+
+        self.arrow = arrow
+        self.flux_loop = flux_loop
+        self.max_workers = max_workers
+        self.lazy = lazy
+        self._cohorts = {}
+        self._stays = {}
+        self._stays_rows = {}
+        self._identities = {}
+        self._pha_r = None
+        self._catalog = None
+        self._local = threading.local()
+        self._readers = None
+        self.cache = cache
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(os.path.expanduser("~"), ".cache", "pysnds")
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache_lock = threading.Lock()
+        self.profiler = profiler
+        self.batch_size = batch_size
+        self.batch_time = batch_time
+        self.incremental = incremental
+        self._watermarks = None
+        self.memo = memo
+        self._memo = SNDS_Memo(memo_size)
+            
+            
+
+    def GetQuery(self, query, arrow=None, chunksize=None):
+        '''
+        Method to execute a SQL query.
+        
+        Parameters
+        ----------
+        query : string
+            SQL query.
+        arrow : bool, optional
+            If True, the result is fetched through Arrow and returned as a DataFrame backed by pyarrow types. 
+            If None, the value given at initialization is used. Default is None.
+        chunksize : int, optional
+            If given, the result is not materialized at once : an iterator of DataFrames of at most chunksize rows is returned instead. Default is None.
+
+        Returns
+        -------
+        df : DataFrame or iterator of DataFrames
+            DataFrame containing the targeted population, or an iterator over its chunks if chunksize is given.
+        '''
+
+        if arrow is None:
+            arrow = self.arrow
+
+        if chunksize is not None:
+            if (type(chunksize) != int) or (chunksize <= 0):
+                raise ValueError("chunksize must be a positive integer.")
+            if self.profiler is not None:
+                return self._profile_chunks(query, self._iter_query(query, chunksize, arrow), self._calling_method())
+            return self._iter_query(query, chunksize, arrow)
+
+        if self.profiler is None:
+            return self._stored_query(query, arrow)
+
+        start, method = datetime.now(), self._calling_method()
+        self._local.fetch_time, self._local.cache_hit = 0.0, False
+        wall_start = time.perf_counter()
+        df = self._stored_query(query, arrow)
+        wall_time = time.perf_counter() - wall_start
+        self.profiler.record(query, method, self.backend, len(df), int(df.memory_usage(index=False, deep=True).sum()), 
+                             wall_time, self._local.fetch_time, cached=self._local.cache_hit, start=start)
+        return df
+
+
+    def _execute_query(self, query, arrow):
+        '''
+        Execute query on the database and return its result as a DataFrame.
+        '''
+
+        if arrow or (self.backend == "duckdb"):
+            table = self.GetArrow(query)
+            fetch_start = time.perf_counter()
+            df = table.to_pandas(types_mapper=pd.ArrowDtype) if arrow else table.to_pandas()
+            self._local.fetch_time += time.perf_counter() - fetch_start
+            return df
+        
+        if self.backend == "spark":
+            df = self.conn.sql(query)
+            fetch_start = time.perf_counter()
+            df = df.toPandas()
+            self._local.fetch_time = time.perf_counter() - fetch_start
+            return df
+        
+        if self.backend == "sqlite":
+            cursor = self._connection().cursor()
+            cursor.execute(query)
+            fetch_start = time.perf_counter()
+            columns = [description[0] for description in cursor.description]
+            data = cursor.fetchall()
+            df = pd.DataFrame(data, columns=columns)
+            cursor.close()
+            self._local.fetch_time = time.perf_counter() - fetch_start
+            return df
+
+
+    def GetArrow(self, query, batch_size=100000):
+        '''
+        Method to execute a SQL query and fetch its result as an Arrow table.
+
+        Parameters
+        ----------
+        query : string
+            SQL query.
+        batch_size : int, optional
+            Number of rows converted to Arrow at once with SQLite, bounding the number of Python tuples alive at the same time. Default is 100000.
+
+        Returns
+        -------
+        table : pyarrow.Table
+            Arrow table containing the result of the query, with typed columns.
+        '''
+
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("pyarrow is not installed, impossible to fetch results with Arrow.")
+
+        if self.backend == "spark":
+            df = self.conn.sql(query)
+            fetch_start = time.perf_counter()
+            if hasattr(df, "toArrow"):
+                table = df.toArrow()
+            else:
+                # PySpark < 4.0 : Arrow is only used under the hood of toPandas
+                self.conn.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+                table = pa.Table.from_pandas(df.toPandas(), preserve_index=False)
+            self._local.fetch_time = time.perf_counter() - fetch_start
+            return table
+
+        if self.backend == "duckdb":
+            # DuckDB produces Arrow data natively, the result is transferred without copy
+            result = self.conn.execute(query)
+            fetch_start = time.perf_counter()
+            table = result.to_arrow_table() if hasattr(result, "to_arrow_table") else result.fetch_arrow_table()
+            self._local.fetch_time = time.perf_counter() - fetch_start
+            return table
+
+        if self.backend == "sqlite":
+            cursor = self._connection().cursor()
+            cursor.execute(query)
+            fetch_start = time.perf_counter()
+            columns = [description[0] for description in cursor.description]
+            tables = []
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                tables.append(pa.table({col: self._arrow_array(values) for col, values in zip(columns, zip(*rows))}))
+            cursor.close()
+            self._local.fetch_time = time.perf_counter() - fetch_start
+
+            if len(tables) == 0:
+                return pa.table({col: pa.array([], type=pa.null()) for col in columns})
+            try:
+                return pa.concat_tables(tables, promote_options="permissive")
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # a column typed differently by two batches falls back to strings in every batch, as within a batch
+                mixed = {col for col in columns if len({table.schema.field(col).type for table in tables} - {pa.null()}) > 1}
+                tables = [pa.table({col: pa.array([None if val is None else str(val) for val in table.column(col).to_pylist()], type=pa.string()) 
+                                    if col in mixed else table.column(col) for col in columns}) for table in tables]
+                return pa.concat_tables(tables, promote_options="permissive")
+
+
+    @staticmethod
+    def _arrow_array(values):
+        '''
+        Convert a column of a SQLite batch into an Arrow array. 
+        SQLite columns are dynamically typed, so mixed columns fall back to strings.
+        '''
+
+        import pyarrow as pa
+
+        try:
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array([None if val is None else str(val) for val in values], type=pa.string())
+
+
+    def register_parquet(self, path):
+        '''
+        Method for exposing Parquet exports of SNDS tables as DuckDB views, so that the queries of the package run unchanged on them.
+        Each file NAME.parquet, or directory NAME containing Parquet files (possibly hive-partitioned), of path becomes a view NAME 
+        (e.g. ER_PRS_F, ER_PRS_F_2020, T_MCO20C, IR_BEN_R).
+
+        Parameters
+        ----------
+        path : str
+            Directory containing the Parquet exports.
+
+        Returns
+        -------
+        views : list
+            Names of the created views.
+        '''
+
+        if self.backend != "duckdb":
+            raise ValueError("register_parquet is only available with a DuckDB connection.")
+
+        if not os.path.isdir(path):
+            raise ValueError(f"{path} is not a directory.")
+
+        views = []
+        for name in sorted(os.listdir(path)):
+            full_path = os.path.join(path, name)
+            # quotes are escaped so that any file or directory name gives a valid statement
+            if os.path.isfile(full_path) and name.endswith(".parquet"):
+                view, source = name[:-len(".parquet")], "read_parquet('{}')".format(full_path.replace("'", "''"))
+            elif os.path.isdir(full_path):
+                view, source = name, "read_parquet('{}', hive_partitioning = true)".format(os.path.join(full_path, '**', '*.parquet').replace("'", "''"))
+            else:
+                continue
+            quoted_view = '"{}"'.format(view.replace('"', '""'))
+            self.conn.execute(f"CREATE OR REPLACE VIEW {quoted_view} AS SELECT * FROM {source}")
+            # the modification times of the files identify the data of the view for the query cache
+            files = [full_path] if os.path.isfile(full_path) else [os.path.join(root, file) for root, _, names in os.walk(full_path) for file in names]
+            signature = ":".join(str(os.stat(file).st_mtime_ns) for file in sorted(files))
+            self.conn.execute(f"COMMENT ON VIEW {quoted_view} IS '{hashlib.sha1(signature.encode()).hexdigest()}'")
+            views.append(view)
+
+        # The new views change the layout of the database
+        self._catalog = None
+        return views
+
+
+    def catalog(self, refresh=False):
+        '''
+        Method for describing the SNDS tables available in the database, which select the tables queried by the loc_* methods.
+        The database is introspected once, the description being kept for the following queries.
+
+        Parameters
+        ----------
+        refresh : bool, optional
+            If True, the database is introspected again, e.g. after SNDS tables were created or deleted. Default is False.
+
+        Returns
+        -------
+        catalog : dict
+            Dictionary containing the names of the tables and views of the database in upper case ('tables'), 
+            whether the DCIR is the table ER_PRS_F partitioned by month of flux ('dcir_flux'), 
+            the years of the yearly tables ER_PRS_F_yyyy ('dcir_years'), the suffixes yy of the PMSI tables T_MCOyyC ('pmsi_years') 
+            and whether the tables T_MCOaa* of a simulated dataset exist ('pmsi_simulated').
+        '''
+
+        if (self._catalog is None) or refresh:
+            self._watermarks = None
+            if self.backend == "spark":
+                names = [table.name for table in self.conn.catalog.listTables()]
+            elif self.backend == "duckdb":
+                names = [row[0] for row in self.conn.execute("SELECT table_name FROM information_schema.tables").fetchall()]
+            else:
+                names = [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')").fetchall()]
+
+            tables = {name.upper() for name in names}
+            self._catalog = {
+                'tables': tables,
+                'dcir_flux': 'ER_PRS_F' in tables,
+                'dcir_years': sorted(int(name[-4:]) for name in tables if re.fullmatch(r"ER_PRS_F_\d{4}", name)),
+                'pmsi_years': sorted(name[5:-1] for name in tables if re.fullmatch(r"T_MCO\d{2}C", name)),
+                'pmsi_simulated': 'T_MCOAAC' in tables,
+            }
+
+        return self._catalog
+
+
+    def prepare_indexes(self, analyze=True, print_option=True):
+        '''
+        Method for creating, in a SQLite database, the indexes used by the joins and filters of the queries of the package : 
+        the 9-column claim key of the DCIR tables, (ETA_NUM, RSA_NUM) and NIR_ANO_17 of the PMSI, the medical codes, 
+        the dates of care and the identifiers of IR_BEN_R and IR_PHA_R. 
+        The tables are found in sqlite_master, existing indexes starting with the same columns are kept, 
+        and the query plans of representative queries, without population and for a sample population of IR_BEN_R, are reported before and after the creation.
+        Patient identifiers of the DCIR tables are only indexed after the dates, so that the cohort filter of the queries 
+        is checked against the cohort table instead of being iterated over for each claim. NIR_ANO_17 of T_MCOyyC also leads an index (with the date of the stay), 
+        so that the stays of a targeted population are searched from its patients instead of scanning T_MCOyyC.
+
+        Parameters
+        ----------
+        analyze : bool, optional
+            If True, the statistics of the indexed tables are gathered with ANALYZE, so that the query planner can choose between the indexes. Default is True.
+        print_option : bool, optional
+            If True, prints the created indexes and the query plans. Default is True.
+
+        Returns
+        -------
+        df_indexes : DataFrame
+            DataFrame containing the table ('TABLE'), name ('INDEX') and columns ('COLUMNS') of each created index.
+        df_plans : DataFrame
+            DataFrame containing, for each representative query ('QUERY'), its EXPLAIN QUERY PLAN before ('PLAN_BEFORE') and after ('PLAN_AFTER') the creation of the indexes.
+        '''
+
+        if self.backend != "sqlite":
+            raise ValueError("prepare_indexes is only available with a SQLite connection.")
+
+        flux_key = ['FLX_DIS_DTD', 'FLX_TRT_DTD', 'FLX_EMT_TYP', 'FLX_EMT_NUM', 'FLX_EMT_ORD', 'ORG_CLE_NUM', 'DCT_ORD_NUM', 'PRS_ORD_NUM', 'REM_TYP_AFF']
+        stay_key = ['ETA_NUM', 'RSA_NUM']
+        cod_ucd = 'substr(UCD_UCD_COD, -7)'
+
+        # (table name pattern, index suffix, indexed columns or expressions)
+        definitions = [
+            (r"ER_PRS_F(_\d{4})?", "KEY", flux_key + ['EXE_SOI_DTD', 'EXE_SOI_DTF', 'BEN_NIR_PSA', 'BEN_RNG_GEM']),
+            (r"ER_CAM_F(_\d{4})?", "KEY", flux_key + ['CAM_PRS_IDE']),
+            (r"ER_CAM_F(_\d{4})?", "CAM_PRS_IDE", ['CAM_PRS_IDE'] + flux_key),
+            (r"ER_PHA_F(_\d{4})?", "KEY", flux_key + ['PHA_PRS_C13']),
+            (r"ER_PHA_F(_\d{4})?", "PHA_PRS_C13", ['PHA_PRS_C13'] + flux_key),
+            (r"ER_UCD_F(_\d{4})?", "KEY", flux_key + ['UCD_UCD_COD']),
+            (r"ER_UCD_F(_\d{4})?", "COD_UCD", [cod_ucd] + flux_key),
+            (r"T_MCO(\d{2}|aa)C", "KEY", stay_key + ['EXE_SOI_DTD', 'EXE_SOI_DTF', 'NIR_ANO_17']),
+            (r"T_MCO(\d{2}|aa)C", "NIR_ANO_17", ['NIR_ANO_17', 'EXE_SOI_DTD']),
+            (r"T_MCO(\d{2}|aa)A", "CDC_ACT", ['CDC_ACT'] + stay_key),
+            (r"T_MCO(\d{2}|aa)B", "DGN_PAL", ['DGN_PAL'] + stay_key),
+            (r"T_MCO(\d{2}|aa)B", "DGN_REL", ['DGN_REL'] + stay_key),
+            (r"T_MCO(\d{2}|aa)D", "ASS_DGN", ['ASS_DGN'] + stay_key),
+            (r"T_MCO(\d{2}|aa)(MED|FH)", "COD_UCD", [cod_ucd] + stay_key),
+            (r"IR_BEN_R", "NIR_PSA", ['BEN_NIR_PSA', 'BEN_RNG_GEM']),
+            (r"IR_PHA_R", "CIP_C13", ['PHA_CIP_C13']),
+            (r"IR_PHA_R", "CIP_UCD", ['PHA_CIP_UCD']),
+            (r"IR_PHA_R", "ATC_CLA", ['PHA_ATC_CLA']),
+        ]
+
+        tables = [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        plans_before = self._representative_plans(tables)
+
+        created = []
+        for table in tables:
+            table_columns = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+            existing = [[row[2] for row in self.conn.execute(f"PRAGMA index_info({index[1]})")] for index in self.conn.execute(f"PRAGMA index_list({table})")]
+
+            for pattern, suffix, columns in definitions:
+                if not re.fullmatch(pattern, table):
+                    continue
+                if not all(column in table_columns for column in columns if column != cod_ucd):
+                    continue
+                if (cod_ucd in columns) and ('UCD_UCD_COD' not in table_columns):
+                    continue
+                # expressions are reported as None by index_info
+                names = [None if column == cod_ucd else column for column in columns]
+                if any(index[:len(names)] == names for index in existing):
+                    continue
+                index = f"IDX_{table}_{suffix}"
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({', '.join(columns)})")
+                created.append((table, index, ', '.join(columns)))
+
+        if analyze:
+            for table in sorted({table for table, _, _ in created}):
+                self.conn.execute(f"ANALYZE {table}")
+        self.conn.commit()
+
+        plans_after = self._representative_plans(tables)
+
+        df_indexes = pd.DataFrame(created, columns=['TABLE', 'INDEX', 'COLUMNS'])
+        df_plans = pd.DataFrame([(name, plans_before[name], plans_after[name]) for name in plans_before], columns=['QUERY', 'PLAN_BEFORE', 'PLAN_AFTER'])
+
+        if print_option:
+            print(str(len(created)) + ' indexes created.')
+            for _, row in df_indexes.iterrows():
+                print('  ' + row['INDEX'] + ' (' + row['COLUMNS'] + ')')
+            for _, row in df_plans.iterrows():
+                print('\n' + row['QUERY'] + ' - before :\n' + row['PLAN_BEFORE'] + '\n' + row['QUERY'] + ' - after :\n' + row['PLAN_AFTER'])
+
+        return df_indexes, df_plans
+
+
+    def _representative_plans(self, tables):
+        '''
+        Return the EXPLAIN QUERY PLAN of one query of each loc_* method whose tables exist, built on the first year available in tables. 
+        The queries run for a targeted population (cohort filter of the DCIR, stays of the PMSI) are built for a sample population of IR_BEN_R registered as a cohort.
+        '''
+
+        pmsi_years = sorted(re.fullmatch(r"T_MCO(\d{2}|aa)C", table).group(1) for table in tables if re.fullmatch(r"T_MCO(\d{2}|aa)C", table))
+        dcir_years = sorted(int(table[-4:]) for table in tables if re.fullmatch(r"ER_PRS_F_\d{4}", table))
+        dcir_year = 2020 if ('ER_PRS_F' in tables) or (len(dcir_years) == 0) else dcir_years[0]
+
+        queries = {
+            'loc_ccam_dcir': lambda: self._ccam_dcir_queries(None, [dcir_year, dcir_year], ['X']),
+            'loc_cip_dcir': lambda: self._cip_dcir_queries(None, [dcir_year, dcir_year], ['X']),
+            'loc_ucd_dcir': lambda: self._ucd_dcir_queries(None, [dcir_year, dcir_year], ['X']),
+        }
+        if len(pmsi_years) > 0:
+            dev = pmsi_years[0] == 'aa'
+            pmsi_year = 2020 if dev else 2000 + int(pmsi_years[0])
+            queries.update({
+                'loc_ccam_pmsi': lambda: self._ccam_pmsi_queries(None, [pmsi_year, pmsi_year], ['X'], dev),
+                'loc_icd10_pmsi': lambda: self._icd10_pmsi_queries(None, [pmsi_year, pmsi_year], ['X'], dev),
+                'loc_ucd_pmsi': lambda: self._ucd_pmsi_queries(None, [pmsi_year, pmsi_year], ['X'], dev),
+            })
+
+        cohort = None
+        if 'IR_BEN_R' in tables:
+            df_sample = self.GetQuery("SELECT BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM FROM IR_BEN_R LIMIT 1000", arrow=False)
+            if not df_sample.empty:
+                registered = set(self._cohorts)
+                cohort = self.register_cohort(df_sample)
+                queries['loc_ccam_dcir (population)'] = lambda: self._ccam_dcir_queries(df_sample, [dcir_year, dcir_year], ['X'])
+                if len(pmsi_years) > 0:
+                    # the stays of the population are the only query of the PMSI reading T_MCOyyC for a population
+                    queries['PMSI stays (population)'] = lambda: [self._pmsi_stays_query(df_sample, [pmsi_year, pmsi_year], pmsi_years[0])]
+
+        plans = {}
+        for name, build in queries.items():
+            try:
+                built = build()
+                if len(built) == 0:
+                    continue
+                rows = self.conn.execute("EXPLAIN QUERY PLAN " + built[0]).fetchall()
+            except sqlite3.OperationalError:
+                # tables of this query are missing from the database
+                continue
+            plans[name] = "\n".join(row[-1] for row in rows)
+
+        if (cohort is not None) and (cohort not in registered):
+            self._drop_tables([cohort])
+        return plans
+
+
+    def register_cohort(self, df_ID_PATIENT):
+        '''
+        Method for loading the targeted population once in the database, so that queries join against it 
+        instead of embedding the list of identifiers in their SQL text.
+        With SQLite the population is stored in an indexed temporary table, with Spark in a broadcast temporary view, 
+        with DuckDB the DataFrame is registered as a view without copy.
+        The table is named after the content of the population : registering the same population twice does not reload it.
+
+        Parameters
+        ----------
+        df_ID_PATIENT : DataFrame
+            DataFrame containing the columns "BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM", which holds the unique identifiers of the targeted population.
+
+        Returns
+        -------
+        cohort : str
+            Name of the table (or view) containing the targeted population.
+        '''
+
+        if set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}:
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
+
+        # Identifiers are compared as strings, as when they were written in the SQL text
+        df_cohort = df_ID_PATIENT[["BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"]].astype({"BEN_IDT_ANO": str, "BEN_NIR_PSA": str})
+        df_cohort = df_cohort.drop_duplicates().reset_index(drop=True)
+
+        hashes = np.sort(pd.util.hash_pandas_object(df_cohort.astype(str), index=False).values)
+        cohort = "COHORT_" + hashlib.sha1(hashes.tobytes()).hexdigest()[:16]
+
+        if self.backend == "spark" and cohort not in self._cohorts:
+            from pyspark.sql.functions import broadcast
+            broadcast(self.conn.createDataFrame(df_cohort)).createOrReplaceTempView(cohort)
+
+        if self.backend == "duckdb" and cohort not in self._cohorts:
+            self.conn.register(cohort, df_cohort)
+
+        if self.backend == "sqlite":
+            self._load_cohort(self.conn, cohort, df_cohort)
+
+        self._cohorts[cohort] = df_cohort
+        return cohort
+
+
+    @staticmethod
+    def _load_cohort(conn, cohort, df_cohort):
+        '''
+        Load a population in an indexed temporary table of a SQLite connection, unless it is already there.
+        '''
+
+        cursor = conn.cursor()
+        # The table may already have been loaded on this connection by another instance
+        cursor.execute("SELECT name FROM sqlite_temp_master WHERE type='table' AND name=?", (cohort,))
+        if cursor.fetchone() is not None:
+            cursor.close()
+            return
+        in_transaction = conn.in_transaction
+        cursor.execute(f"CREATE TEMP TABLE {cohort} (BEN_IDT_ANO TEXT, BEN_NIR_PSA TEXT, BEN_RNG_GEM)")
+        cursor.executemany(f"INSERT INTO {cohort} VALUES (?, ?, ?)", df_cohort.astype(object).itertuples(index=False, name=None))
+        cursor.execute(f"CREATE INDEX {cohort}_IDT ON {cohort} (BEN_IDT_ANO)")
+        cursor.execute(f"CREATE INDEX {cohort}_PSA ON {cohort} (BEN_NIR_PSA, BEN_RNG_GEM)")
+        cursor.close()
+        # Do not leave open a transaction the user did not start
+        if not in_transaction:
+            conn.commit()
+
+
+    @staticmethod
+    def _create_stays(conn, stays, query):
+        '''
+        Store the hospital stays selected by query in an indexed temporary table of a SQLite connection, unless it is already there.
+        '''
+
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_temp_master WHERE type='table' AND name=?", (stays,))
+        if cursor.fetchone() is not None:
+            cursor.close()
+            return
+        in_transaction = conn.in_transaction
+        cursor.execute(f"CREATE TEMP TABLE {stays} AS {query}")
+        cursor.execute(f"CREATE INDEX {stays}_KEY ON {stays} (ETA_NUM, RSA_NUM)")
+        cursor.close()
+        if not in_transaction:
+            conn.commit()
+
+
+    @staticmethod
+    def _load_stays(conn, stays, columns, rows):
+        '''
+        Load the rows of hospital stays fetched from another connection in an indexed temporary table of a SQLite connection, unless it is already there.
+        '''
+
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_temp_master WHERE type='table' AND name=?", (stays,))
+        if cursor.fetchone() is not None:
+            cursor.close()
+            return
+        in_transaction = conn.in_transaction
+        # Columns without declared type keep the values as they are stored in the PMSI
+        cursor.execute(f"CREATE TEMP TABLE {stays} ({', '.join(columns)})")
+        cursor.executemany(f"INSERT INTO {stays} VALUES ({', '.join('?' * len(columns))})", rows)
+        cursor.execute(f"CREATE INDEX {stays}_KEY ON {stays} (ETA_NUM, RSA_NUM)")
+        cursor.close()
+        if not in_transaction:
+            conn.commit()
+
+
+    def drop_cohorts(self):
+        '''
+        Method for removing from the database all the populations loaded with register_cohort, and the hospital stays resolved for them in the PMSI.
+        '''
+
+        self._drop_tables(list(self._stays) + list(self._cohorts))
+
+
+    def _drop_tables(self, names):
+        '''
+        Remove from the database the populations (COHORT_*) and hospital stays (STAYS_*) of names, on the main connection and the read-only ones.
+        '''
+
+        for name in names:
+            if self.backend == "spark":
+                self.conn.catalog.dropTempView(name)
+            if self.backend == "duckdb":
+                if name in self._stays:
+                    self.conn.execute(f"DROP TABLE IF EXISTS {name}")
+                else:
+                    self.conn.unregister(name)
+            if self.backend == "sqlite":
+                for conn in [self.conn] + self._reader_connections():
+                    conn.execute(f"DROP TABLE IF EXISTS temp.{name}")
+            self._stays.pop(name, None)
+            self._stays_rows.pop(name, None)
+            self._cohorts.pop(name, None)
+            self._identities.pop(name, None)
+
+
+    def close(self):
+        '''
+        Method for closing the read-only SQLite connections opened for parallel execution (see max_workers). 
+        The connection given at initialization is left open.
+        '''
+
+        for conn in self._reader_connections():
+            conn.close()
+        self._readers = None
+
+
+    def cache_info(self):
+        '''
+        Method for describing the query cache (see cache).
+
+        Returns
+        -------
+        info : dict
+            Number of hits and misses of this instance, number of results stored in cache_dir and their total size in bytes.
+        '''
+
+        entries = self._cache_entries()
+        return {"hits": self.cache_hits, "misses": self.cache_misses, 
+                "files": len(entries), "size": sum(size for _, size, _ in entries)}
+
+
+    def clear_cache(self):
+        '''
+        Method for deleting every result stored in cache_dir, e.g. after the tables of a Spark catalog have been reloaded.
+        '''
+
+        with self._cache_lock:
+            for _, _, path in self._cache_entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+    def memo_info(self):
+        '''
+        Method for describing the memo of the session (see memo).
+
+        Returns
+        -------
+        info : dict
+            Number of calls answered from the memo (hits) or not (misses), number of results kept and their total size in bytes.
+        '''
+
+        return self._memo.info()
+
+
+    def clear_memo(self):
+        '''
+        Method for deleting the results kept in the memo, e.g. after the tables of the database have been modified.
+        '''
+
+        self._memo.clear()
+
+
+    def _memoized(self, method, source, df_ID_PATIENT, years, codes, code_columns, extract, dev=False, date_column='EXE_SOI_DTD'):
+        '''
+        Return the result of extract (the extraction of a call of method) from the memo when a previous result contains it, filtered in memory,
+        otherwise run extract and keep its result in the memo. source ('DCIR' or 'PMSI') gives the partitions read for the period, codes are the codes of the call
+        (None or an empty list for all the codes), held by the columns code_columns of the result, and date_column is the date filtered by the period.
+        '''
+
+        # The calls that extract rejects are not memoized
+        if (not self.memo) or self.lazy or ((codes is not None) and (type(codes) != list)) or (years is None) or (not isinstance(years, list)):
+            return extract()
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            return extract()
+
+        codes = frozenset(str(code) for code in codes) if codes else None
+        population = None
+        if (df_ID_PATIENT is not None) and (not df_ID_PATIENT.empty):
+            population = (frozenset(df_ID_PATIENT['BEN_IDT_ANO'].astype(str)), frozenset(df_ID_PATIENT['BEN_NIR_PSA'].astype(str)))
+        # The queries compare the dates without their time
+        period = tuple(date.date() for date in self._period(years))
+        partitions = None
+        if source == 'DCIR':
+            partitions = repr(self._dcir_partitions(years, 'A'))
+        if source == 'PMSI':
+            partitions = repr(self._pmsi_partitions(years, dev))
+
+        df = self._memo.lookup(method, codes, population, period, partitions, dev)
+        if df is None:
+            df = extract()
+            self._memo.store(method, codes, population, period, partitions, dev, df, code_columns, date_column)
+        return df
+
+
+    def _cached_query(self, query, arrow):
+        '''
+        Return the result of query from the cache if it holds it, otherwise execute it and store its result as a Parquet file.
+        The key is the hash of the normalized SQL text, of the fingerprint of the data and of the arrow option.
+        '''
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is not installed, impossible to cache query results.")
+
+        fingerprint = self._backend_fingerprint()
+        if fingerprint is None:
+            # in-memory database : its content cannot be identified across sessions
+            return self._execute_query(query, arrow)
+
+        key = hashlib.sha1("\n".join([fingerprint, str(bool(arrow)), self._normalize_sql(query)]).encode()).hexdigest()
+        path = os.path.join(self.cache_dir, key + ".parquet")
+
+        try:
+            table = pq.read_table(path)
+            os.utime(path)
+        except (OSError, pa.ArrowException):
+            table = None
+
+        if table is not None:
+            self._local.cache_hit = True
+            with self._cache_lock:
+                self.cache_hits += 1
+            return table.to_pandas(types_mapper=pd.ArrowDtype) if arrow else table.to_pandas()
+
+        with self._cache_lock:
+            self.cache_misses += 1
+
+        df, table = self._query_table(query, arrow)
+        if table is not None:
+            self._write_table(table, path)
+            self._evict_cache()
+
+        return df
+
+
+    def _stored_query(self, query, arrow):
+        '''
+        Return the result of query from the incremental store (see incremental) or the query cache (see cache) if they are enabled, otherwise execute it.
+        '''
+
+        if self.incremental and len(self._partitions(query)) > 0:
+            return self._incremental_query(query, arrow)
+        return self._cached_query(query, arrow) if self.cache else self._execute_query(query, arrow)
+
+
+    def _query_table(self, query, arrow):
+        '''
+        Execute query and return its result as a DataFrame and as an Arrow table, or None if the result cannot be stored in Parquet.
+        '''
+
+        import pyarrow as pa
+
+        if arrow:
+            table = self.GetArrow(query)
+            return table.to_pandas(types_mapper=pd.ArrowDtype), table
+
+        df = self._execute_query(query, arrow)
+        try:
+            return df, pa.Table.from_pandas(df, preserve_index=False)
+        except pa.ArrowException:
+            # columns mixing Python types cannot be stored in Parquet
+            return df, None
+
+
+    @staticmethod
+    def _write_table(table, path):
+        '''
+        Write an Arrow table in a Parquet file, through a temporary file so that concurrent readers never see a partial file.
+        '''
+
+        import pyarrow.parquet as pq
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+
+    def _incremental_query(self, query, arrow):
+        '''
+        Return the result of a query of the DCIR or the PMSI from the incremental store if the months of flux and years it reads were complete when it was stored, 
+        i.e. earlier than the watermarks of the database at that time. Otherwise execute it and store its result with the current watermarks.
+        The key is the hash of the normalized SQL text, which holds the codes, the population and the period, of the database and of the arrow option.
+        '''
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is not installed, impossible to store query results incrementally.")
+
+        database = self._database_identity()
+        if database is None:
+            # in-memory database : its content cannot be identified across sessions
+            return self._cached_query(query, arrow) if self.cache else self._execute_query(query, arrow)
+
+        key = hashlib.sha1("\n".join([database, str(bool(arrow)), self._normalize_sql(query)]).encode()).hexdigest()
+        path = os.path.join(self.cache_dir, "incremental", key + ".parquet")
+
+        try:
+            table = pq.read_table(path)
+            stored = json.loads(table.schema.metadata[b"pysnds_watermarks"])
+        except (OSError, KeyError, ValueError, TypeError, pa.ArrowException):
+            table = None
+
+        if (table is not None) and all((stored.get(kind) is not None) and (value < stored[kind]) for kind, value in self._partitions(query).items()):
+            self._local.cache_hit = True
+            return table.to_pandas(types_mapper=pd.ArrowDtype) if arrow else table.to_pandas()
+
+        df, table = self._query_table(query, arrow)
+        if table is not None:
+            metadata = dict(table.schema.metadata or {})
+            metadata[b"pysnds_watermarks"] = json.dumps(self.watermarks()).encode()
+            self._write_table(table.replace_schema_metadata(metadata), path)
+
+        return df
+
+
+    @staticmethod
+    def _partitions(query):
+        '''
+        Return the last month of flux (FLX_DIS_DTD), year of ER_PRS_F_yyyy and year of T_MCOyy* read by query, as a dictionary keyed as the watermarks.
+        '''
+
+        partitions = {}
+        months = re.findall(r"'(\d{4}-\d{2}-\d{2})'", " ".join(re.findall(r"FLX_DIS_DTD\s*(?:=\s*'[\d-]+'|IN\s*\([^)]*\))", query)))
+        if len(months) > 0:
+            partitions["FLX_DIS_DTD"] = max(months)
+        dcir_years = re.findall(r"\bER_PRS_F_(\d{4})\b", query)
+        if len(dcir_years) > 0:
+            partitions["ER_PRS_F"] = max(int(year) for year in dcir_years)
+        pmsi_years = re.findall(r"\bT_MCO(\d{2})", query)
+        if len(pmsi_years) > 0:
+            partitions["T_MCO"] = max(int(year) for year in pmsi_years)
+        return partitions
+
+
+    def watermarks(self):
+        '''
+        Method for retrieving the last partitions available in the database, which are still incomplete for the incremental store (see incremental) : 
+        the last month of flux of ER_PRS_F ('FLX_DIS_DTD'), the last year of the tables ER_PRS_F_yyyy ('ER_PRS_F') and of the tables T_MCOyy* ('T_MCO'). 
+        They are read once, with the catalog.
+
+        Returns
+        -------
+        watermarks : dict
+            Last month of flux ('YYYY-MM-DD'), years of the DCIR and of the PMSI (yy), None when the database has no such table.
+        '''
+
+        catalog = self.catalog()
+        if self._watermarks is None:
+            last_flux = None
+            if catalog['dcir_flux']:
+                last_flux = self.conn.sql("SELECT MAX(FLX_DIS_DTD) AS FLX FROM ER_PRS_F").collect()[0][0] if self.backend == "spark" \
+                    else self.conn.execute("SELECT MAX(FLX_DIS_DTD) FROM ER_PRS_F").fetchone()[0]
+            self._watermarks = {
+                'FLX_DIS_DTD': None if last_flux is None else str(last_flux)[:10],
+                'ER_PRS_F': max(catalog['dcir_years']) if len(catalog['dcir_years']) > 0 else None,
+                'T_MCO': max(int(year) for year in catalog['pmsi_years']) if len(catalog['pmsi_years']) > 0 else None,
+            }
+        return self._watermarks
+
+
+    def clear_incremental(self):
+        '''
+        Method for deleting every result stored in cache_dir/incremental (see incremental), e.g. after past months of flux have been reloaded.
+        '''
+
+        directory = os.path.join(self.cache_dir, "incremental")
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+    def _database_identity(self):
+        '''
+        Return a string identifying the database queried through the connection whatever its content, or None if it cannot be identified across sessions.
+        '''
+
+        if self.backend == "spark":
+            return f"spark:{self.conn.conf.get('spark.sql.warehouse.dir', '')}:{self.conn.catalog.currentDatabase()}"
+
+        if self.backend == "duckdb":
+            path = self.conn.execute("SELECT path FROM duckdb_databases() WHERE database_name = current_database()").fetchone()[0]
+            if path is not None:
+                return f"duckdb:{path}"
+            # views created by register_parquet are identified by their Parquet files
+            views = self.conn.execute("SELECT view_name, sql FROM duckdb_views() WHERE NOT internal AND NOT temporary ORDER BY view_name").fetchall()
+            return f"duckdb:{views}" if len(views) > 0 else None
+
+        if self.backend == "sqlite":
+            path = self._connection().execute("PRAGMA database_list").fetchone()[2]
+            return f"sqlite:{path}" if path else None
+
+
+    def _cache_entries(self):
+        '''
+        Return the (last access time, size, path) of the results stored in cache_dir.
+        '''
+
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".parquet"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+
+    def _evict_cache(self):
+        '''
+        Delete the least recently used results of cache_dir until its size is below cache_size.
+        '''
+
+        with self._cache_lock:
+            entries = sorted(self._cache_entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.cache_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+    @staticmethod
+    def _normalize_sql(query):
+        '''
+        Collapse the whitespace of query outside its string literals, so that the indentation of a query does not change its cache key.
+        '''
+
+        parts = re.split(r"('(?:[^']|'')*')", query)
+        return "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts)).strip()
+
+
+    def _backend_fingerprint(self):
+        '''
+        Return a string identifying the data queried through the connection, or None if it cannot be identified across sessions.
+        With SQLite and DuckDB databases stored in files, it changes whenever the files are modified. 
+        With DuckDB, views created by register_parquet carry the modification times of their Parquet files. 
+        With Spark, tables are only identified by their catalog : clear_cache must be called after reloading them.
+        '''
+
+        if self.backend == "spark":
+            return f"spark:{self.conn.version}:{self.conn.conf.get('spark.sql.warehouse.dir', '')}:{self.conn.catalog.currentDatabase()}"
+
+        if self.backend == "duckdb":
+            path = self.conn.execute("SELECT path FROM duckdb_databases() WHERE database_name = current_database()").fetchone()[0]
+            views = self.conn.execute("SELECT view_name, sql, comment FROM duckdb_views() WHERE NOT internal AND NOT temporary ORDER BY view_name").fetchall()
+            if path is None:
+                n_tables = self.conn.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE database_name = current_database()").fetchone()[0]
+                if n_tables > 0 or len(views) == 0:
+                    return None
+                return f"duckdb:{views}"
+            stat = os.stat(path)
+            return f"duckdb:{path}:{stat.st_mtime_ns}:{stat.st_size}:{views}"
+
+        if self.backend == "sqlite":
+            path = self._connection().execute("PRAGMA database_list").fetchone()[2]
+            if not path:
+                return None
+            stats = [os.stat(file) for file in [path, path + "-wal"] if os.path.exists(file)]
+            return f"sqlite:{path}:" + ":".join(f"{stat.st_mtime_ns}:{stat.st_size}" for stat in stats)
+
+
+    def _connection(self):
+        '''
+        Return the SQLite connection used by the current thread : its read-only connection in a worker, the main connection otherwise.
+        '''
+
+        return getattr(self._local, "conn", None) or self.conn
+
+
+    def _reader_connections(self):
+        '''
+        Return the read-only SQLite connections opened for parallel execution.
+        '''
+
+        return [] if self._readers is None else list(self._readers.queue)
+
+
+    def _run_queries(self, queries):
+        '''
+        Execute a list of SQL queries and return the list of their results, in the same order.
+        The queries run concurrently when max_workers is greater than 1 : as Spark jobs with Spark, 
+        or on read-only connections to the database file with SQLite (an in-memory database is always queried sequentially).
+        '''
+
+        queries = list(queries)
+        if self.incremental:
+            # read on the main connection, before the workers need them
+            self.watermarks()
+        # DuckDB already runs each query on all cores
+        parallel = (self.max_workers > 1) and (len(queries) > 1) and (self.backend != "duckdb")
+
+        if parallel and self.backend == "sqlite":
+            path = self.conn.execute("PRAGMA database_list").fetchone()[2]
+            if not path:
+                parallel = False
+            elif self._readers is None:
+                self._readers = queue.Queue()
+                for _ in range(self.max_workers):
+                    self._readers.put(sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False))
+
+        if parallel and self.backend == "sqlite":
+            # The stays read by the queries are fetched once from the main connection, instead of being computed again on each read-only connection
+            for stays in sorted(set(re.findall(r"\bSTAYS_[0-9a-f]{16}\b", " ".join(queries)))):
+                if (stays in self._stays) and (stays not in self._stays_rows):
+                    cursor = self.conn.execute(f"SELECT * FROM {stays}")
+                    self._stays_rows[stays] = ([description[0] for description in cursor.description], cursor.fetchall())
+                    cursor.close()
+
+        if not parallel:
+            return [self.GetQuery(query) for query in queries]
+
+        # the workers do not see the stack of the calling method, it is given to the profiler explicitly
+        method = self._calling_method() if self.profiler is not None else None
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(queries))) as executor:
+            return list(executor.map(self._run_worker_query, queries, itertools.repeat(method)))
+
+
+    def _run_worker_query(self, query, method=None):
+        '''
+        Execute a SQL query in a worker thread, on a read-only connection with SQLite.
+        '''
+
+        self._local.method = method
+        if self.backend != "sqlite":
+            try:
+                return self.GetQuery(query)
+            finally:
+                self._local.method = None
+
+        conn = self._readers.get()
+        try:
+            # The populations and stays registered on the main connection are temporary tables, the ones read by the query must be copied on its connection
+            for name in set(re.findall(r"\b(?:COHORT|STAYS)_[0-9a-f]{16}\b", query)):
+                if name in self._cohorts:
+                    self._load_cohort(conn, name, self._cohorts[name])
+                elif name in self._stays_rows:
+                    self._load_stays(conn, name, *self._stays_rows[name])
+            self._local.conn = conn
+            return self.GetQuery(query)
+        finally:
+            self._local.conn = None
+            self._local.method = None
+            self._readers.put(conn)
+
+
+    def _calling_method(self):
+        '''
+        Return the name of the innermost public method of the package in the call stack (e.g. 'loc_ccam_dcir'), recorded by the profiler.
+        '''
+
+        method = getattr(self._local, "method", None)
+        if method is not None:
+            return method
+
+        frame = sys._getframe(1)
+        while frame is not None:
+            name = frame.f_code.co_name
+            instance = frame.f_locals.get("self")
+            if (not name.startswith("_")) and (name not in ("GetQuery", "GetArrow")) and isinstance(instance, SNDS_Query):
+                # comprehensions and nested functions of a method also see self
+                if getattr(getattr(type(instance), name, None), "__code__", None) is frame.f_code:
+                    return name
+            frame = frame.f_back
+        return None
+
+
+    def _profile_chunks(self, query, chunks, method):
+        '''
+        Generator yielding the chunks of a query and recording it in the profiler once they are exhausted. 
+        The time spent by the caller between two chunks is not counted, the time before the first chunk is considered as the execution.
+        '''
+
+        start = datetime.now()
+        n_chunks, rows, size, wall_time, fetch_time = 0, 0, 0, 0.0, 0.0
+        try:
+            while True:
+                wall_start = time.perf_counter()
+                try:
+                    df_chunk = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed = time.perf_counter() - wall_start
+                    wall_time += elapsed
+                    fetch_time += elapsed if n_chunks > 0 else 0.0
+                n_chunks += 1
+                rows += len(df_chunk)
+                size += int(df_chunk.memory_usage(index=False, deep=True).sum())
+                yield df_chunk
+        finally:
+            self.profiler.record(query, method, self.backend, rows, size, wall_time, fetch_time, start=start)
+
+
+    def _iter_query(self, query, chunksize, arrow):
+        '''
+        Generator executing a SQL query and yielding its result by chunks of at most chunksize rows.
+        With SQLite rows are fetched with fetchmany, with Spark they are streamed partition by partition with toLocalIterator.
+        '''
+
+        if self.backend == "spark":
+            df = self.conn.sql(query)
+            columns = df.columns
+            rows = df.toLocalIterator()
+            while True:
+                batch = list(itertools.islice(rows, chunksize))
+                if not batch:
+                    break
+                yield self._chunk_frame([tuple(row) for row in batch], columns, arrow)
+
+        if self.backend == "duckdb":
+            result = self.conn.execute(query)
+            reader = result.to_arrow_reader(chunksize) if hasattr(result, "to_arrow_reader") else result.fetch_record_batch(chunksize)
+            for batch in reader:
+                yield batch.to_pandas(types_mapper=pd.ArrowDtype) if arrow else batch.to_pandas()
+
+        if self.backend == "sqlite":
+            cursor = self._connection().cursor()
+            try:
+                cursor.execute(query)
+                columns = [description[0] for description in cursor.description]
+                while True:
+                    batch = cursor.fetchmany(chunksize)
+                    if not batch:
+                        break
+                    yield self._chunk_frame(batch, columns, arrow)
+            finally:
+                cursor.close()
+
+
+    def _chunk_frame(self, rows, columns, arrow):
+        '''
+        Convert a batch of rows into a DataFrame, backed by pyarrow types if arrow is True.
+        '''
+
+        if arrow:
+            try:
+                import pyarrow as pa
+            except ImportError:
+                raise ImportError("pyarrow is not installed, impossible to fetch results with Arrow.")
+            table = pa.table({col: self._arrow_array(values) for col, values in zip(columns, zip(*rows))})
+            return table.to_pandas(types_mapper=pd.ArrowDtype)
+        return pd.DataFrame(rows, columns=columns)
+
+
+    def _collect(self, queries, columns=None, distinct=True):
+        '''
+        Execute a list of SQL queries and gather their results in a single DataFrame without duplicates (unless distinct is False).
+        If columns is given, the result starts with these columns, even when no row is returned.
+        The results are concatenated and deduplicated once, after the last query, so the cost stays linear in the number of rows.
+        '''
+
+        if self.lazy:
+            # Spark DataFrames are only planned here, nothing is executed until an action is called on the result
+            df = reduce(lambda df_1, df_2: df_1.unionByName(df_2), [self.conn.sql(query) for query in queries])
+            if columns is not None:
+                df = df.select(self._ordered_columns(columns, df.columns))
+            return df.distinct() if distinct else df
+
+        frames = self._run_queries(queries)
+        if columns is not None:
+            frames = [pd.DataFrame(columns=columns)] + frames
+
+        df = pd.concat(frames, ignore_index=True)
+        if distinct:
+            df.drop_duplicates(inplace=True)
+            df.reset_index(drop=True, inplace=True)
+        return df
+
+
+    def _collect_batches(self, build, df_ID_PATIENT, columns=None, distinct=True, identities=None):
+        '''
+        Execute the SQL queries built by build (a function of the targeted population) and gather their results as _collect.
+        If identities is given, the queries of a population skip the join with IR_BEN_R (see _use_identity_index) : 
+        their rows are mapped to the patients with the identity index, matching the columns identities as the join would.
+        A population larger than batch_size is split into ceil(n / batch_size) batches of patients by ranges of a hash of BEN_NIR_PSA : the patients sharing a BEN_NIR_PSA 
+        are in the same batch, and the batches are spread evenly over the identifiers. Up to max_workers batches are queried at a time, 
+        fewer when a round of batches takes longer than batch_time seconds ; the cohort and stays tables of a batch are dropped once its results are collected.
+        '''
+
+        if (identities is not None) and self._use_identity_index(df_ID_PATIENT):
+            df_index = self.identity_index(df_ID_PATIENT)
+            df = self._collect_batches(build, df_ID_PATIENT, columns=columns, distinct=False)
+            df = self._map_identities(df, df_index, identities)
+            if distinct:
+                df.drop_duplicates(inplace=True)
+                df.reset_index(drop=True, inplace=True)
+            return df
+
+        if (df_ID_PATIENT is None) or (len(df_ID_PATIENT) <= self.batch_size) or ("BEN_NIR_PSA" not in df_ID_PATIENT.columns):
+            return self._collect(build(df_ID_PATIENT), columns=columns, distinct=distinct)
+
+        # The batches are consecutive ranges of the hash of BEN_NIR_PSA, so that a BEN_NIR_PSA is never split. 
+        # They only depend on the population and batch_size : a query run again reads the same cohort tables, and its cached results are reused
+        hashes = pd.util.hash_pandas_object(df_ID_PATIENT["BEN_NIR_PSA"].astype(str), index=False).values.astype(np.uint64)
+        n_buckets = -(-len(df_ID_PATIENT) // self.batch_size)
+        buckets = ((hashes >> np.uint64(32)) * np.uint64(n_buckets)) >> np.uint64(32)
+        batches = [df_ID_PATIENT.iloc[np.flatnonzero(buckets == bucket)] for bucket in range(n_buckets)]
+        batches = [df_batch for df_batch in batches if not df_batch.empty]
+
+        if self.lazy:
+            # Spark only plans the queries : all the batches are united in a single DataFrame
+            queries = [query for df_batch in batches for query in build(df_batch)]
+            return self._collect(queries, columns=columns, distinct=distinct)
+
+        frames = [] if columns is None else [pd.DataFrame(columns=columns)]
+        position, n_concurrent = 0, self.max_workers
+        while position < len(batches):
+            known = set(self._cohorts) | set(self._stays)
+            queries = [query for df_batch in batches[position:position + n_concurrent] for query in build(df_batch)]
+            position += n_concurrent
+
+            start_time = time.perf_counter()
+            frames += self._run_queries(queries)
+            duration = time.perf_counter() - start_time
+
+            # The tables of the batches are not read again once their results are collected
+            self._drop_tables([name for name in list(self._stays) + list(self._cohorts) if name not in known])
+
+            # The batches of a round run concurrently : fewer batches are run at a time when a round is slower than batch_time
+            if duration > self.batch_time:
+                n_concurrent = max(1, n_concurrent // 2)
+            elif duration < self.batch_time / 2:
+                n_concurrent = min(self.max_workers, n_concurrent * 2)
+
+        df = pd.concat(frames, ignore_index=True)
+        if distinct:
+            df.drop_duplicates(inplace=True)
+            df.reset_index(drop=True, inplace=True)
+        return df
+
+
+    def collect(self, df):
+        '''
+        Method for retrieving the result of a loc_* method as a pandas DataFrame. 
+        In lazy mode this triggers the execution of the Spark DataFrame and collects it to the driver, otherwise df is returned as is.
+
+        Parameters
+        ----------
+        df : DataFrame or pyspark.sql.DataFrame
+            Result of a loc_* method.
+
+        Returns
+        -------
+        df : DataFrame
+            pandas DataFrame.
+        '''
+
+        if not self._is_spark_frame(df):
+            return df
+        if self.arrow:
+            self.conn.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+        return df.toPandas()
+
+
+    @staticmethod
+    def _is_spark_frame(df):
+        '''
+        Return True if df is a Spark DataFrame.
+        '''
+
+        return "pyspark" in str(type(df))
+
+
+    @staticmethod
+    def _ordered_columns(columns, df_columns):
+        '''
+        Return df_columns ordered as in columns, the columns absent from columns being kept at the end.
+        '''
+
+        return [col for col in columns if col in df_columns] + [col for col in df_columns if col not in columns]
+
+
+    def _empty_frame(self, columns):
+        '''
+        Return an empty DataFrame with the given columns, a Spark DataFrame in lazy mode.
+        '''
+
+        if self.lazy:
+            return self.conn.createDataFrame([], ", ".join(f"{col} string" for col in columns))
+        return pd.DataFrame(columns=columns)
+
+
+    def _union(self, frames):
+        '''
+        Concatenate DataFrames by column names and remove duplicates, with pandas or Spark.
+        '''
+
+        if self.lazy:
+            return reduce(lambda df_1, df_2: df_1.unionByName(df_2, allowMissingColumns=True), frames).distinct()
+        return pd.concat(frames).drop_duplicates().reset_index(drop=True)
+
+
+    def _n_patients(self, df):
+        '''
+        Return the number of distinct patients (BEN_IDT_ANO) of a pandas or Spark DataFrame.
+        '''
+
+        if self._is_spark_frame(df):
+            return df.select('BEN_IDT_ANO').distinct().count()
+        return len(np.unique(df['BEN_IDT_ANO']))
+
+
+    def _iter_collect(self, queries, chunksize, columns):
+        '''
+        Generator executing a list of SQL queries one after the other and yielding their results by chunks.
+        The columns of the chunks are ordered as in columns, extra columns being kept at the end.
+        '''
+
+        if (type(chunksize) != int) or (chunksize <= 0):
+            raise ValueError("chunksize must be a positive integer.")
+
+        # the chunks are produced once the caller has returned, its name is given to the profiler explicitly
+        method = self._calling_method() if self.profiler is not None else None
+
+        def chunks():
+            for query in queries:
+                previous, self._local.method = getattr(self._local, "method", None), method
+                try:
+                    df_chunks = self.GetQuery(query, chunksize=chunksize)
+                finally:
+                    self._local.method = previous
+                for df_chunk in df_chunks:
+                    yield df_chunk[[col for col in columns if col in df_chunk.columns] + [col for col in df_chunk.columns if col not in columns]]
+        return chunks()
+
+
+    @staticmethod
+    def _period(years):
+        '''
+        Return the start and end dates of the period defined by years.
+        '''
+
+        if (years is None) or (not isinstance(years, list)):
+            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
+
+        deb = years[0] if isinstance(years[0], datetime) else datetime(years[0], 1, 1)
+        end = years[1] if isinstance(years[1], datetime) else datetime(years[1], 12, 31)
+        return deb, end
+
+
+    @staticmethod
+    def _first_date_queries(queries):
+        '''
+        Wrap the SQL queries of a loc_* method so that the database returns the first execution date ('DATE', minimum of EXE_SOI_DTD)
+        of each patient instead of all the rows.
+        '''
+
+        return [f"""
+                SELECT
+                Q.BEN_IDT_ANO,
+                Q.BEN_NIR_PSA,
+                Q.BEN_RNG_GEM,
+                MIN(Q.EXE_SOI_DTD) AS DATE
+                FROM ({query}) Q
+                GROUP BY Q.BEN_IDT_ANO, Q.BEN_NIR_PSA, Q.BEN_RNG_GEM
+            """ for query in queries]
+
+
+    @staticmethod
+    def _presence_queries(queries, columns=None):
+        '''
+        Wrap the SQL queries of a loc_* method so that the database only returns the distinct values of columns
+        (by default the identifiers 'BEN_IDT_ANO', 'BEN_NIR_PSA' and 'BEN_RNG_GEM') instead of all the rows.
+        '''
+
+        if columns is None:
+            columns = ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM']
+        select_columns = ",\n                ".join(f"Q.{col}" for col in columns)
+
+        return [f"""
+                SELECT DISTINCT
+                {select_columns}
+                FROM ({query}) Q
+            """ for query in queries]
+
+
+    def _patient_conditions(self, df_ID_PATIENT, alias):
+        '''
+        Return the SQL conditions restricting the table alias to the targeted population, registered as a cohort table.
+        '''
+
+        conditions = []
+        if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
+            cohort = self.register_cohort(df_ID_PATIENT)
+            conditions.append(f"{alias}.BEN_IDT_ANO IN (SELECT BEN_IDT_ANO FROM {cohort})")
+            conditions.append(f"{alias}.BEN_NIR_PSA IN (SELECT BEN_NIR_PSA FROM {cohort})")
+        return conditions
+
+
+    def identity_index(self, df_ID_PATIENT=None):
+        '''
+        Method for loading the identities of IR_BEN_R once for the session. The index of a targeted population holds the rows of IR_BEN_R 
+        sharing a BEN_NIR_PSA with the population : the queries of the DCIR filter the claims on their pseudonymized keys (BEN_NIR_PSA, BEN_RNG_GEM) 
+        instead of joining IR_BEN_R, and the keys are mapped to the patients with this index. 
+        Without population, the whole IR_BEN_R is loaded, and the indexes of the populations are then taken from it without querying the database.
+
+        Parameters
+        ----------
+        df_ID_PATIENT : DataFrame, optional
+            DataFrame containing the columns "BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM", which holds the unique identifiers of the targeted population. Default is None.
+
+        Returns
+        -------
+        df_index : DataFrame
+            DataFrame containing the identifiers of IR_BEN_R ('BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'), whether the patient belongs to the population ('IN_POPULATION') 
+            and whether the BEN_NIR_PSA is shared by several BEN_RNG_GEM, i.e. twins ('TWIN').
+        '''
+
+        if (df_ID_PATIENT is None) or df_ID_PATIENT.empty:
+            if None not in self._identities:
+                df_index = self.GetQuery("SELECT BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM FROM IR_BEN_R", arrow=False)
+                df_index['IN_POPULATION'] = True
+                self._identities[None] = self._flag_twins(df_index)
+            return self._identities[None]
+
+        cohort = self.register_cohort(df_ID_PATIENT)
+        if cohort in self._identities:
+            return self._identities[cohort]
+
+        df_cohort = self._cohorts[cohort]
+        if None in self._identities:
+            df_index = self._identities[None]
+            df_index = df_index.loc[df_index['BEN_NIR_PSA'].astype(str).isin(df_cohort['BEN_NIR_PSA']), ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM']].reset_index(drop=True)
+        else:
+            df_index = self.GetQuery(f"SELECT BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM FROM IR_BEN_R WHERE BEN_NIR_PSA IN (SELECT BEN_NIR_PSA FROM {cohort})", arrow=False)
+
+        # Identifiers are compared as strings, as in the cohort table
+        df_index['IN_POPULATION'] = df_index['BEN_IDT_ANO'].astype(str).isin(df_cohort['BEN_IDT_ANO']).values
+        self._identities[cohort] = self._flag_twins(df_index)
+        return self._identities[cohort]
+
+
+    @staticmethod
+    def _flag_twins(df_index):
+        '''
+        Add to an identity index the column TWIN, True for the rows whose BEN_NIR_PSA has several distinct BEN_RNG_GEM.
+        '''
+
+        df_index['TWIN'] = (df_index.groupby('BEN_NIR_PSA')['BEN_RNG_GEM'].transform('nunique') > 1).values
+        return df_index
+
+
+    def _identity_sql(self, df_ID_PATIENT, claims, alias, on):
+        '''
+        Return the parts of a query of the DCIR identifying the patients of the claims of the table alias claims : 
+        the expressions of the columns 'BEN_IDT_ANO', 'BEN_NIR_PSA' and 'BEN_RNG_GEM' (dict), the join with IR_BEN_R (as alias) on the columns on, 
+        and the conditions restricting the claims to the targeted population. 
+        When the identity index is used (see _use_identity_index), there is no join : BEN_IDT_ANO is NULL and the claims are filtered on BEN_NIR_PSA.
+        '''
+
+        if self._use_identity_index(df_ID_PATIENT):
+            cohort = self.register_cohort(df_ID_PATIENT)
+            columns = {'BEN_IDT_ANO': "NULL AS BEN_IDT_ANO", 'BEN_NIR_PSA': f"{claims}.BEN_NIR_PSA", 'BEN_RNG_GEM': f"{claims}.BEN_RNG_GEM"}
+            return columns, "", [f"{claims}.BEN_NIR_PSA IN (SELECT BEN_NIR_PSA FROM {cohort})"]
+
+        columns = {col: f"{alias}.{col}" for col in ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM']}
+        join = f"INNER JOIN IR_BEN_R {alias}\n                ON " + " AND ".join(f"{claims}.{col} = {alias}.{col}" for col in on)
+        return columns, join, self._patient_conditions(df_ID_PATIENT, alias)
 
-        else:
-            raise TypeError(
-                f"Paramètre conn invalide : {type(conn)}. "
-                f"Attendu SparkSession ou sqlite3.Connection."
-            )
-            
-            
 
-    def GetQuery(self, query):
+    def _iter_identities(self, chunks, df_ID_PATIENT, on, chunksize):
+        '''
+        Map the chunks of a generator to the patients with the identity index, when the queries of the population skip the join with IR_BEN_R.
+        A claim may be mapped to several patients (twins), so the mapped chunks are sliced again to at most chunksize rows.
         '''
-        Method to execute a SQL query.
-        
-        Parameters
-        ----------
-        query : string
-            SQL query.
 
-        Returns
-        -------
-        df : DataFrame
-            DataFrame containing the targeted population.
+        if not self._use_identity_index(df_ID_PATIENT):
+            return chunks
+        df_index = self.identity_index(df_ID_PATIENT)
+        return self._bounded_chunks((self._map_identities(df_chunk, df_index, on) for df_chunk in chunks), chunksize)
+
+
+    @staticmethod
+    def _bounded_chunks(chunks, chunksize):
         '''
-        
+        Slice the DataFrames of a generator larger than chunksize rows into chunks of at most chunksize rows.
+        '''
+
+        for df_chunk in chunks:
+            if len(df_chunk) <= chunksize:
+                yield df_chunk
+                continue
+            for start in range(0, len(df_chunk), chunksize):
+                yield df_chunk.iloc[start:start + chunksize].reset_index(drop=True)
+
+
+    def _use_identity_index(self, df_ID_PATIENT):
+        '''
+        Return True if the queries of the targeted population skip the join with IR_BEN_R, their rows being mapped to the patients with the identity index. 
+        Lazy Spark DataFrames keep the join, as well as queries without population.
+        '''
+
+        return (not self.lazy) and (df_ID_PATIENT is not None) and (not df_ID_PATIENT.empty)
+
+
+    @staticmethod
+    def _map_identities(df, df_index, on):
+        '''
+        Map the rows of df to the patients of the population in the identity index df_index, as the INNER JOIN with IR_BEN_R on the columns on it replaces : 
+        'BEN_IDT_ANO', 'BEN_NIR_PSA' and 'BEN_RNG_GEM' are taken from the index, in the place of the columns of df. 
+        If df has a column SAME_GEM, it is set to 1 when BEN_RNG_GEM of the row is the one of the patient.
+        '''
+
+        columns = list(df.columns)
+        df_index = df_index.loc[df_index['IN_POPULATION'], ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM']]
+
+        # Keys are compared as strings when the claims and IR_BEN_R do not store them with the same type
+        left = df.drop(columns=[col for col in ['BEN_IDT_ANO', 'SAME_GEM'] if col in columns]).rename(columns={'BEN_NIR_PSA': '_NIR_PSA', 'BEN_RNG_GEM': '_RNG_GEM'})
+        keys = []
+        for col in on:
+            key = '_' + col[4:]
+            if left[key].dtype != df_index[col].dtype:
+                left[key] = left[key].astype(str).where(left[key].notna())
+                df_index = df_index.assign(**{key: df_index[col].astype(str).where(df_index[col].notna())})
+            else:
+                df_index = df_index.assign(**{key: df_index[col]})
+            keys.append(key)
+
+        df_mapped = left.merge(df_index, on=keys, how='inner')
+        if 'SAME_GEM' in columns:
+            claim_gem, patient_gem = df_mapped['_RNG_GEM'], df_mapped['BEN_RNG_GEM']
+            if claim_gem.dtype != patient_gem.dtype:
+                claim_gem, patient_gem = claim_gem.astype(str), patient_gem.astype(str)
+            df_mapped['SAME_GEM'] = ((claim_gem == patient_gem) & df_mapped['_RNG_GEM'].notna() & df_mapped['BEN_RNG_GEM'].notna()).astype(int)
+        return df_mapped[columns]
+
+
+    def _dcir_partitions(self, years, alias):
+        '''
+        Return the partitions of the DCIR covering the period defined by years, as a list of (table suffix, SQL conditions).
+        When ER_PRS_F exists, the months of flux (FLX_DIS_DTD) of alias go from January of the first year up to 6 months after the end of the period, 
+        and are gathered in a single partition unless flux_loop is True. Otherwise there is one partition per yearly table of the period found in the catalog.
+        '''
+
+        deb, end = self._period(years)
+        catalog = self.catalog()
+
+        if catalog['dcir_flux'] == False:
+            years_dcir = [year for year in range(deb.year, end.year + 1) if year in catalog['dcir_years']]
+            if len(years_dcir) == 0:
+                raise ValueError(f"No table of the DCIR found for the period : the database has neither ER_PRS_F nor ER_PRS_F_yyyy for the years {deb.year} to {end.year}.")
+            return [(f"_{year}", []) for year in years_dcir]
+
+        flxmax_date = (end + relativedelta(months=6)).replace(day=1)
+        vecflx = []
+        current_date = datetime(deb.year, 1, 1)
+        while current_date <= flxmax_date:
+            vecflx.append(current_date.strftime("%Y-%m-%d"))
+            current_date += relativedelta(months=1)
+
+        # The incremental store keeps the results of each month of flux apart
+        if (self.flux_loop == True) or self.incremental:
+            return [("", [f"{alias}.FLX_DIS_DTD = '{flux}'"]) for flux in vecflx]
+
+        liste_flux_str = ', '.join(f"'{flux}'" for flux in vecflx)
+        return [("", [f"{alias}.FLX_DIS_DTD IN ({liste_flux_str})"])]
+
+
+    def _pmsi_partitions(self, years, dev):
+        '''
+        Return the year suffixes (yy) of the PMSI tables T_MCOyy* covering the period defined by years and found in the catalog, or 'aa' for a simulated dataset.
+        '''
+
+        if dev == True:
+            return ['aa']
+
+        year_deb = int(str(years[0].year if isinstance(years[0], datetime) else years[0])[-2:])
+        year_end = int(str(years[1].year if isinstance(years[1], datetime) else years[1])[-2:])
+
+        catalog = self.catalog()
+        years_pmsi = [year for year in range(year_deb, year_end + 1) if f"T_MCO{year}C" in catalog['tables']]
+        if len(years_pmsi) == 0:
+            message = f"No table of the PMSI found for the period : the database has no table T_MCOyyC for the years {year_deb} to {year_end}."
+            if catalog['pmsi_simulated']:
+                message += " The tables T_MCOaa* of a simulated dataset exist, use dev=True."
+            raise ValueError(message)
+        return years_pmsi
+
+
+    def _pmsi_stays(self, df_ID_PATIENT, years, year):
+        '''
+        Return the table of the hospital stays of T_MCO{year}C starting during the period defined by years, 
+        resolved to the patients of the targeted population : stay key (ETA_NUM, RSA_NUM), identifiers and dates of the stay.
+        For a targeted population the stays are computed once and kept in the database for the session (an indexed temporary table with SQLite, 
+        a cached temporary view with Spark), so that the lookups of CCAM, ICD-10 and UCD codes only join the small set of stays of the population. 
+        Without population, the stays are returned as a subquery.
+        '''
+
+        query = self._pmsi_stays_query(df_ID_PATIENT, years, year)
+
+        if df_ID_PATIENT is None or df_ID_PATIENT.empty:
+            return f"({query})"
+
+        # The table is named after its query, which holds the population, the year and the period
+        stays = "STAYS_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+        if stays in self._stays:
+            return stays
+
         if self.backend == "spark":
-            df = self.conn.sql(query)
-            return df.toPandas()
-        
+            self.conn.sql(f"CACHE TABLE {stays} AS {query}")
+        if self.backend == "duckdb":
+            self.conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {stays} AS {query}")
         if self.backend == "sqlite":
-            cursor = self.conn.cursor()
-            cursor.execute(query)
-            columns = [description[0] for description in cursor.description]
-            data = cursor.fetchall()
-            df = pd.DataFrame(data, columns=columns)
-            cursor.close()
-            return df
+            self._create_stays(self.conn, stays, query)
+
+        self._stays[stays] = query
+        return stays
+
+
+    def _pmsi_stays_query(self, df_ID_PATIENT, years, year):
+        '''
+        Build the SQL query selecting the hospital stays of T_MCO{year}C of the targeted population during the period defined by years (see _pmsi_stays).
+        '''
+
+        deb, end = self._period(years)
+
+        conditions = self._patient_conditions(df_ID_PATIENT, 'C')
+        conditions.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
+
+        query = f"""
+                SELECT
+                A.ETA_NUM,
+                A.RSA_NUM,
+                C.BEN_IDT_ANO,
+                C.BEN_RNG_GEM,
+                C.BEN_NIR_PSA,
+                A.EXE_SOI_DTD,
+                A.EXE_SOI_DTF
+                FROM T_MCO{year}C A
+
+                INNER JOIN IR_BEN_R C
+                ON A.NIR_ANO_17 = C.BEN_NIR_PSA
+
+                WHERE {" AND ".join(conditions)}
+        """
+        return query
     
     
     def Identify_Twins(self, df_ID_PATIENT=None):
@@ -93,24 +1763,9 @@ class SNDS_Query() :
         if set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}:
             raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
         
-        liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-        
-        query_JUM = f"""
-           WITH MultiGem AS (
-            SELECT BEN_NIR_PSA
-            FROM IR_BEN_R
-            WHERE BEN_NIR_PSA IN ({liste_bennirpsa_str})
-            GROUP BY BEN_NIR_PSA
-            HAVING COUNT(DISTINCT BEN_RNG_GEM) > 1
-            )
-            SELECT BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM
-            FROM IR_BEN_R
-            WHERE BEN_NIR_PSA IN ({liste_bennirpsa_str})
-              AND BEN_NIR_PSA IN (SELECT BEN_NIR_PSA FROM MultiGem)
-            ORDER BY BEN_NIR_PSA
-            """
-        
-        df_jum = self.GetQuery(query_JUM)
+        # Twins share a BEN_NIR_PSA with several BEN_RNG_GEM, which the identity index flags
+        df_index = self.identity_index(df_ID_PATIENT)
+        df_jum = df_index.loc[df_index['TWIN'], ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM']].sort_values('BEN_NIR_PSA', kind='stable').reset_index(drop=True)
        
     
         print('We have ' + str(len(np.unique(df_jum.BEN_IDT_ANO))) + ' twins in the targeted population.')
@@ -136,169 +1791,99 @@ class SNDS_Query() :
         Returns
         -------
         df_ccam_dcir : DataFrame
-            DataFrame containing CCAM codes ('CAM_PRS_IDE') from the DCIR, 
+            DataFrame containing CCAM codes ('CAM_PRS_IDE') from the DCIR,
             along with their corresponding execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'),
             for each patient ('BEN_IDT_ANO').
         '''
 
-        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
-            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
+        def extract():
+            return self._collect_batches(lambda df_batch: self._ccam_dcir_queries(df_batch, years, list_CCAM), df_ID_PATIENT, columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'CAM_PRS_IDE', 'EXE_SOI_DTD', 'EXE_SOI_DTF'], 
+                                                 identities=['BEN_NIR_PSA', 'BEN_RNG_GEM'])
 
-        if list_CCAM is not None :
-            if type(list_CCAM) != list :
-                raise ValueError("list_CCAM must be a list of CCAM medical codes.")
+        df_ccam_dcir = self._memoized('loc_ccam_dcir', 'DCIR', df_ID_PATIENT, years, list_CCAM, ['CAM_PRS_IDE'], extract)
 
-        if (years is None) or (not isinstance(years, list)):
-            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
+        if print_option==True :
+            print(str(self._n_patients(df_ccam_dcir)) + ' patients identified using CCAM code in the DCIR.')
 
+        return df_ccam_dcir
 
-        if isinstance(years[0], datetime):
-            flxmin_year = years[0].year
-            deb = years[0]
-        else:
-            flxmin_year = years[0]
-            deb = datetime(years[0], 1, 1)
 
-        if isinstance(years[1], datetime):
-            flxmax_year = years[1].year
-            end = years[1]
-        else:
-            flxmax_year = years[1]
-            end = datetime(years[1], 12, 31)
+    def iter_ccam_dcir(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_CCAM=None, chunksize=100000):
+        '''
+        Generator version of loc_ccam_dcir, yielding the CCAM data of the DCIR by chunks of bounded size.
 
-        flxmin = datetime(flxmin_year, 1, 1)
-        flxmax_date = (end + relativedelta(months=6)).replace(day=1)
-        vecflx = []
-        current_date = flxmin
-        while current_date <= flxmax_date:
-            vecflx.append(current_date.strftime("%Y-%m-%d"))
-            current_date += relativedelta(months=1)
+        Parameters
+        ----------
+        df_ID_PATIENT, years, list_CCAM :
+            See loc_ccam_dcir.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunk with the columns of loc_ccam_dcir. Chunks are not deduplicated against each other.
+        '''
 
-        df_ccam_dcir = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'CAM_PRS_IDE', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
+        queries = self._ccam_dcir_queries(df_ID_PATIENT, years, list_CCAM)
+        chunks = self._iter_collect(queries, chunksize, columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'CAM_PRS_IDE', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
+        return self._iter_identities(chunks, df_ID_PATIENT, ['BEN_NIR_PSA', 'BEN_RNG_GEM'], chunksize)
 
-        top_ER_PRS_F = True
-        
-        # if self.backend == 'sqlite':
-        #     cursor = self.conn.cursor()
-        #     cursor.execute(
-        #     "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
-        #     ('E_PRS_F',)
-        #     )
-        #     top_ER_PRS_F = cursor.fetchone() is not None
-
-        if self.backend == 'spark':
-            top_ER_PRS_F = self.conn.catalog.tableExists('ER_PRS_F')
-
-
-        if top_ER_PRS_F==True :
-
-            for flux in vecflx:
-
-                conditions = []
-                if list_CCAM:
-                    liste_ccam_str = ', '.join(f"'{valeur}'" for valeur in list_CCAM)
-                    conditions.append(f"A.CAM_PRS_IDE IN ({liste_ccam_str})")
-
-                if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-                    liste_benidtano_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-                    conditions.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-                    liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-                    conditions.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
-
-                conditions.append(f"B.FLX_DIS_DTD = '{flux}'")
-                conditions.append(f"B.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
-
-                where_condition = "WHERE " + " AND ".join(conditions)
-
-                query_CCAM_DCIR = f"""
-
-                    SELECT  
-                    C.BEN_IDT_ANO,      
-                    C.BEN_NIR_PSA,
-                    C.BEN_RNG_GEM,  
-                    A.CAM_PRS_IDE,
-                    B.EXE_SOI_DTD,
-                    B.EXE_SOI_DTF
-                    FROM ER_CAM_F A
-
-                    INNER JOIN ER_PRS_F B
-                    ON A.DCT_ORD_NUM = B.DCT_ORD_NUM
-                    AND A.FLX_DIS_DTD = B.FLX_DIS_DTD
-                    AND A.FLX_EMT_NUM = B.FLX_EMT_NUM
-                    AND A.FLX_EMT_ORD = B.FLX_EMT_ORD
-                    AND A.FLX_EMT_TYP = B.FLX_EMT_TYP
-                    AND A.FLX_TRT_DTD = B.FLX_TRT_DTD
-                    AND A.ORG_CLE_NUM = B.ORG_CLE_NUM
-                    AND A.PRS_ORD_NUM = B.PRS_ORD_NUM
-                    AND A.REM_TYP_AFF = B.REM_TYP_AFF
-
-                    INNER JOIN IR_BEN_R C
-                    ON B.BEN_NIR_PSA = C.BEN_NIR_PSA AND B.BEN_RNG_GEM = C.BEN_RNG_GEM
 
-                    {where_condition}
-                """
-                df_flux = self.GetQuery(query_CCAM_DCIR)
-                df_ccam_dcir = pd.concat([df_ccam_dcir, df_flux], ignore_index=True)
-                df_ccam_dcir.drop_duplicates(inplace=True)
-                df_ccam_dcir.reset_index(drop=True, inplace=True)
+    def _ccam_dcir_queries(self, df_ID_PATIENT, years, list_CCAM):
+        '''
+        Build the SQL queries of loc_ccam_dcir, one for each partition of the DCIR.
+        '''
 
-        else :
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-            conditions = []
-            if list_CCAM:
-                liste_ccam_str = ', '.join(f"'{valeur}'" for valeur in list_CCAM)
-                conditions.append(f"A.CAM_PRS_IDE IN ({liste_ccam_str})")
-
-            if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-                liste_benidtano_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-                conditions.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-                liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-                conditions.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
-                    
-            conditions.append(f"B.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
-
-            where_condition = "WHERE " + " AND ".join(conditions)
-
-            yy = list(range(int(flxmin_year), (int(flxmax_year)+1)))
-
-            for year in yy :
-
-                query_CCAM_DCIR = f"""
-
-                    SELECT  
-                    C.BEN_IDT_ANO,      
-                    C.BEN_NIR_PSA,
-                    C.BEN_RNG_GEM,  
-                    A.CAM_PRS_IDE,
-                    B.EXE_SOI_DTD,
-                    B.EXE_SOI_DTF
-                    FROM ER_CAM_F_{year} A
-
-                    INNER JOIN ER_PRS_F_{year} B
-                    ON A.DCT_ORD_NUM = B.DCT_ORD_NUM
-                    AND A.FLX_DIS_DTD = B.FLX_DIS_DTD
-                    AND A.FLX_EMT_NUM = B.FLX_EMT_NUM
-                    AND A.FLX_EMT_ORD = B.FLX_EMT_ORD
-                    AND A.FLX_EMT_TYP = B.FLX_EMT_TYP
-                    AND A.FLX_TRT_DTD = B.FLX_TRT_DTD
-                    AND A.ORG_CLE_NUM = B.ORG_CLE_NUM
-                    AND A.PRS_ORD_NUM = B.PRS_ORD_NUM
-                    AND A.REM_TYP_AFF = B.REM_TYP_AFF
-
-                    INNER JOIN IR_BEN_R C
-                    ON B.BEN_NIR_PSA = C.BEN_NIR_PSA AND B.BEN_RNG_GEM = C.BEN_RNG_GEM
+        if list_CCAM is not None :
+            if type(list_CCAM) != list :
+                raise ValueError("list_CCAM must be a list of CCAM medical codes.")
 
-                    {where_condition}
-                """
-                df_flux = self.GetQuery(query_CCAM_DCIR)
-                df_ccam_dcir = pd.concat([df_ccam_dcir, df_flux], ignore_index=True)
-                df_ccam_dcir.drop_duplicates(inplace=True)
-                df_ccam_dcir.reset_index(drop=True, inplace=True)
+        deb, end = self._period(years)
 
-        if print_option==True :
-            print(str(len(np.unique(df_ccam_dcir['BEN_IDT_ANO']))) + ' patients identified using CCAM code in the DCIR.')
+        conditions = []
+        if list_CCAM:
+            liste_ccam_str = ', '.join(f"'{valeur}'" for valeur in list_CCAM)
+            conditions.append(f"A.CAM_PRS_IDE IN ({liste_ccam_str})")
+        identity_columns, identity_join, patient_conditions = self._identity_sql(df_ID_PATIENT, 'B', 'C', ['BEN_NIR_PSA', 'BEN_RNG_GEM'])
+        conditions += patient_conditions
+
+        queries = []
+        for suffix, flux_conditions in self._dcir_partitions(years, 'B'):
+
+            where_condition = "WHERE " + " AND ".join(conditions + flux_conditions + [f"B.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'"])
+
+            queries.append(f"""
+
+                SELECT
+                {identity_columns['BEN_IDT_ANO']},
+                {identity_columns['BEN_NIR_PSA']},
+                {identity_columns['BEN_RNG_GEM']},
+                A.CAM_PRS_IDE,
+                B.EXE_SOI_DTD,
+                B.EXE_SOI_DTF
+                FROM ER_CAM_F{suffix} A
+
+                INNER JOIN ER_PRS_F{suffix} B
+                ON A.DCT_ORD_NUM = B.DCT_ORD_NUM
+                AND A.FLX_DIS_DTD = B.FLX_DIS_DTD
+                AND A.FLX_EMT_NUM = B.FLX_EMT_NUM
+                AND A.FLX_EMT_ORD = B.FLX_EMT_ORD
+                AND A.FLX_EMT_TYP = B.FLX_EMT_TYP
+                AND A.FLX_TRT_DTD = B.FLX_TRT_DTD
+                AND A.ORG_CLE_NUM = B.ORG_CLE_NUM
+                AND A.PRS_ORD_NUM = B.PRS_ORD_NUM
+                AND A.REM_TYP_AFF = B.REM_TYP_AFF
+
+                {identity_join}
 
-        return df_ccam_dcir
+                {where_condition}
+            """)
+
+        return queries
 
 
     def loc_ccam_pmsi(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_CCAM=None, print_option=True, dev=False):
@@ -322,112 +1907,91 @@ class SNDS_Query() :
         Returns
         -------
         df_ccam_pmsi : DataFrame
-            DataFrame containing CCAM codes ('CDC_ACT') from the PMSI, 
+            DataFrame containing CCAM codes ('CDC_ACT') from the PMSI,
             along with their execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF', and 'ENT_DAT_DEL'),
             for each patient ('BEN_IDT_ANO') and specific hospital stays ('ETA_NUM', 'RSA_NUM').
         '''
 
+        def extract():
+            return self._collect_batches(lambda df_batch: self._ccam_pmsi_queries(df_batch, years, list_CCAM, dev), df_ID_PATIENT, columns=None if dev else ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'CDC_ACT', 'ENT_DAT_DEL', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
+
+        df_ccam_pmsi = self._memoized('loc_ccam_pmsi', 'PMSI', df_ID_PATIENT, years, list_CCAM, ['CDC_ACT'], extract, dev=dev)
+
+        if print_option==True:
+            print(str(self._n_patients(df_ccam_pmsi)) + ' patient identified using CCAM code in the PMSI.')
+
+        return df_ccam_pmsi
+
+
+    def iter_ccam_pmsi(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_CCAM=None, dev=False, chunksize=100000):
+        '''
+        Generator version of loc_ccam_pmsi, yielding the CCAM data of the PMSI by chunks of bounded size.
+
+        Parameters
+        ----------
+        df_ID_PATIENT, years, list_CCAM, dev :
+            See loc_ccam_pmsi.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunk with the columns of loc_ccam_pmsi. Chunks are not deduplicated against each other.
+        '''
+
+        queries = self._ccam_pmsi_queries(df_ID_PATIENT, years, list_CCAM, dev)
+        return self._iter_collect(queries, chunksize, columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'CDC_ACT', 'ENT_DAT_DEL', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
+
+
+    def _ccam_pmsi_queries(self, df_ID_PATIENT, years, list_CCAM, dev):
+        '''
+        Build the SQL queries of loc_ccam_pmsi, one for each year of the PMSI.
+        '''
+
         if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
             raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-        if (years is None) or (not isinstance(years, list)): 
+        if (years is None) or (not isinstance(years, list)):
             raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
-                                
+
         if (list_CCAM is not None) and (type(list_CCAM) != list) :
                 raise ValueError("list_CCAM must be a list of CCAM medical codes.")
 
-        if isinstance(years[0], datetime):
-            year_deb = int(str(years[0].year)[-2:])
-            deb = years[0]
-        else:
-            year_deb = str(years[0])[-2:]
-            deb = datetime(years[0], 1, 1)
-
-        if isinstance(years[1], datetime):
-            year_end = int(str(years[1].year)[-2:])
-            end = years[1]
-        else:
-            year_end = str(years[1])[-2:]
-            end = datetime(years[1], 12, 31)
-
-        conditions = []
+        where_condition = ""
         if list_CCAM:
             liste_ccam_str = ', '.join(f"'{val}'" for val in list_CCAM)
-            conditions.append(f"B.CDC_ACT IN ({liste_ccam_str})")
-        if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-            liste_benidtano_str = ', '.join(f"'{val}'" for val in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-            conditions.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-            liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-            conditions.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
-                
-        conditions.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
-        where_condition = "WHERE " + " AND ".join(conditions)
-    
-        if dev == True :
-            query_CCAM_PMSI = f"""
+            where_condition = f"WHERE B.CDC_ACT IN ({liste_ccam_str})"
+
+        # The simulated dataset does not keep the stay identifiers
+        stay_columns = "" if dev else """
+                B.ETA_NUM,
+                B.RSA_NUM, """
+
+        queries = []
+        for year in self._pmsi_partitions(years, dev):
+            queries.append(f"""
 
                 SELECT DISTINCT
-                    C.BEN_IDT_ANO, 
-                    C.BEN_RNG_GEM, 
-                    C.BEN_NIR_PSA, 
-                    B.CDC_ACT, 
-                    B.ENT_DAT_DEL, 
-                    A.EXE_SOI_DTD, 
-                    A.EXE_SOI_DTF
-                FROM T_MCOaaA B
+                S.BEN_IDT_ANO,
+                S.BEN_RNG_GEM,
+                S.BEN_NIR_PSA, {stay_columns}
+                B.CDC_ACT,
+                B.ENT_DAT_DEL,
+                S.EXE_SOI_DTD,
+                S.EXE_SOI_DTF
+                FROM T_MCO{year}A B
+
+                INNER JOIN {self._pmsi_stays(df_ID_PATIENT, years, year)} S
+                ON B.ETA_NUM = S.ETA_NUM AND B.RSA_NUM = S.RSA_NUM
 
-                INNER JOIN T_MCOaaC A 
-                    ON B.ETA_NUM = A.ETA_NUM AND B.RSA_NUM = A.RSA_NUM
+                {where_condition}
+            """)
+
+        return queries
 
-                INNER JOIN IR_BEN_R C
-                    ON A.NIR_ANO_17 = C.BEN_NIR_PSA
- 
-                {where_condition} 
-            """
-            df_ccam_pmsi = self.GetQuery(query_CCAM_PMSI)
-            df_ccam_pmsi.drop_duplicates(inplace=True)
-            df_ccam_pmsi.reset_index(drop=True, inplace=True)
 
-        else :
-            df_ccam_pmsi = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'CDC_ACT', 'ENT_DAT_DEL', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
-            yy = list(range(int(year_deb), int(year_end)+1))
-            for year in yy :
-                table_nameA = f"T_MCO{year}A"
-                table_nameC = f"T_MCO{year}C"
-                query_CCAM_PMSI = f"""
-                    
-                    SELECT DISTINCT
-                        C.BEN_IDT_ANO, 
-                        C.BEN_RNG_GEM, 
-                        C.BEN_NIR_PSA, 
-                        B.ETA_NUM, 
-                        B.RSA_NUM, 
-                        B.CDC_ACT, 
-                        B.ENT_DAT_DEL, 
-                        A.EXE_SOI_DTD, 
-                        A.EXE_SOI_DTF
-                    FROM {table_nameA} B
-
-                    INNER JOIN {table_nameC} A 
-                        ON B.ETA_NUM = A.ETA_NUM AND B.RSA_NUM = A.RSA_NUM
-
-                    INNER JOIN IR_BEN_R C
-                        ON A.NIR_ANO_17 = C.BEN_NIR_PSA
- 
-                    {where_condition} 
-                """
-                df_flux = self.GetQuery(query_CCAM_PMSI)
-                df_ccam_pmsi = pd.concat([df_ccam_pmsi, df_flux], ignore_index=True)
-                df_ccam_pmsi.drop_duplicates(inplace=True)
-                df_ccam_pmsi.reset_index(drop=True, inplace=True)
 
-        if print_option==True:
-            print(str(len(np.unique(df_ccam_pmsi['BEN_IDT_ANO']))) + ' patient identified using CCAM code in the PMSI.')
-        
-        return df_ccam_pmsi
-    
-    
-    
     def loc_icd10_pmsi(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_ICD10=None, print_option=True, dev=False):
         '''
         Method for gathering specific ICD-10 data from the targeted population in the PMSI.
@@ -448,165 +2012,106 @@ class SNDS_Query() :
         Returns
         -------
         df_icd10_pmsi : DataFrame
-            DataFrame containing ICD-10 codes ('DGN_PAL', 'DGN_REL', 'ASS_DGN') from the PMSI, 
-            along with their execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'), 
+            DataFrame containing ICD-10 codes ('DGN_PAL', 'DGN_REL', 'ASS_DGN') from the PMSI,
+            along with their execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'),
             for each patient ('BEN_IDT_ANO') and specific hospital stays ('ETA_NUM', 'RSA_NUM').
         '''
 
-        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
-            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
+        def extract():
+            return self._collect_batches(lambda df_batch: self._icd10_pmsi_queries(df_batch, years, list_ICD10, dev), df_ID_PATIENT, columns=None if dev else ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'DGN_PAL', 'DGN_REL', 'ASS_DGN', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
 
-        if (years is None) or (not isinstance(years, list)): 
-            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")    
+        df_icd10_pmsi = self._memoized('loc_icd10_pmsi', 'PMSI', df_ID_PATIENT, years, list_ICD10, ['DGN_PAL', 'DGN_REL', 'ASS_DGN'], extract, dev=dev)
 
-        if (list_ICD10 is not None) and (type(list_ICD10) != list) :
-                raise ValueError("list_ICD10 must be a list of ICD-10 medical codes.")
+        if print_option==True :
+            print(str(self._n_patients(df_icd10_pmsi)) + ' patients identified using ICD10 code in the PMSI.')
 
-    
-        if isinstance(years[0], datetime):
-            year_deb = int(str(years[0].year)[-2:])
-            deb = years[0]
-        else:
-            year_deb = str(years[0])[-2:]
-            deb = datetime(years[0], 1, 1)
+        return df_icd10_pmsi
 
-        if isinstance(years[1], datetime):
-            year_end = int(str(years[1].year)[-2:])
-            end = years[1]
-        else:
-            year_end = str(years[1])[-2:]
-            end = datetime(years[1], 12, 31)
 
+    def iter_icd10_pmsi(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_ICD10=None, dev=False, chunksize=100000):
+        '''
+        Generator version of loc_icd10_pmsi, yielding the ICD-10 data of the PMSI by chunks of bounded size.
+
+        Parameters
+        ----------
+        df_ID_PATIENT, years, list_ICD10, dev :
+            See loc_icd10_pmsi.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunk with the columns of loc_icd10_pmsi. Chunks are not deduplicated against each other.
+        '''
+
+        queries = self._icd10_pmsi_queries(df_ID_PATIENT, years, list_ICD10, dev)
+        return self._iter_collect(queries, chunksize, columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'DGN_PAL', 'DGN_REL', 'ASS_DGN', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
 
-        condition_icd10_1, condition_icd10_2 = [], []
 
-        if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-            liste_benidtano_str = ', '.join(f"'{val}'" for val in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-            condition_icd10_1.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-            condition_icd10_2.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-            
-            liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-            condition_icd10_1.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
-            condition_icd10_2.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
+    def _icd10_pmsi_queries(self, df_ID_PATIENT, years, list_ICD10, dev):
+        '''
+        Build the SQL queries of loc_icd10_pmsi, one for each year of the PMSI.
+        '''
+
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
+
+        if (years is None) or (not isinstance(years, list)):
+            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
 
+        if (list_ICD10 is not None) and (type(list_ICD10) != list) :
+                raise ValueError("list_ICD10 must be a list of ICD-10 medical codes.")
+
+        where_condition_1 = ""
+        where_condition_2 = ""
         if list_ICD10:
             liste_icd10_str = ', '.join(f"'{valeur}'" for valeur in list_ICD10)
-            condition_icd10_1.append(f"(B.DGN_PAL IN ({liste_icd10_str}) OR B.DGN_REL IN ({liste_icd10_str}))")
-            condition_icd10_2.append(f"E.ASS_DGN IN ({liste_icd10_str})")
-       
-        condition_icd10_1.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
-        condition_icd10_2.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
+            where_condition_1 = f"WHERE (B.DGN_PAL IN ({liste_icd10_str}) OR B.DGN_REL IN ({liste_icd10_str}))"
+            where_condition_2 = f"WHERE E.ASS_DGN IN ({liste_icd10_str})"
+
+        queries = []
+        for year in self._pmsi_partitions(years, dev):
+            stays = self._pmsi_stays(df_ID_PATIENT, years, year)
+            queries.append(f"""
 
-        where_condition_1 = "WHERE " + " AND ".join(condition_icd10_1)
-        where_condition_2 = "WHERE " + " AND ".join(condition_icd10_2)
-    
-        if dev == True :
-            query_ICD10_PMSI = f"""
-    
                 SELECT DISTINCT
-                C.BEN_IDT_ANO, 
-                C.BEN_RNG_GEM, 
-                C.BEN_NIR_PSA, 
-                B.DGN_PAL, 
-                B.DGN_REL, 
+                S.BEN_IDT_ANO,
+                S.BEN_RNG_GEM,
+                S.BEN_NIR_PSA,
+                B.DGN_PAL,
+                B.DGN_REL,
                 NULL AS ASS_DGN,
-                A.EXE_SOI_DTD, 
-                A.EXE_SOI_DTF
-                FROM T_MCOaaB B
+                S.EXE_SOI_DTD,
+                S.EXE_SOI_DTF
+                FROM T_MCO{year}B B
 
-                INNER JOIN T_MCOaaC A 
-                ON B.ETA_NUM = A.ETA_NUM AND B.RSA_NUM = A.RSA_NUM
+                INNER JOIN {stays} S
+                ON B.ETA_NUM = S.ETA_NUM AND B.RSA_NUM = S.RSA_NUM
 
-                INNER JOIN IR_BEN_R C
-                ON A.NIR_ANO_17 = C.BEN_NIR_PSA
+                {where_condition_1}
 
-                {where_condition_1} 
-                
                 UNION ALL
-                
-                SELECT 
-                C.BEN_IDT_ANO,
-                C.BEN_RNG_GEM, 
-                C.BEN_NIR_PSA, 
+
+                SELECT
+                S.BEN_IDT_ANO,
+                S.BEN_RNG_GEM,
+                S.BEN_NIR_PSA,
                 NULL AS DGN_PAL,
                 NULL AS DGN_REL,
-                E.ASS_DGN, 
-                A.EXE_SOI_DTD, 
-                A.EXE_SOI_DTF
-                FROM T_MCOaaD E
-
-                INNER JOIN T_MCOaaC A 
-                ON E.ETA_NUM = A.ETA_NUM AND E.RSA_NUM = A.RSA_NUM
+                E.ASS_DGN,
+                S.EXE_SOI_DTD,
+                S.EXE_SOI_DTF
+                FROM T_MCO{year}D E
 
-                INNER JOIN IR_BEN_R C
-                ON A.NIR_ANO_17 = C.BEN_NIR_PSA
+                INNER JOIN {stays} S
+                ON E.ETA_NUM = S.ETA_NUM AND E.RSA_NUM = S.RSA_NUM
 
                 {where_condition_2}
-            """
-            df_icd10_pmsi = self.GetQuery(query_ICD10_PMSI) 
-            df_icd10_pmsi.drop_duplicates(inplace=True)
-            df_icd10_pmsi.reset_index(drop=True, inplace=True)
-
-
-        else :
-            df_icd10_pmsi = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'DGN_PAL', 'DGN_REL', 'ASS_DGN', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
-            yy = list(range(int(year_deb), int(year_end)+1))
-            for year in yy :
-                table_nameB = f"T_MCO{year}B"
-                table_nameC = f"T_MCO{year}C"
-                table_nameD = f"T_MCO{year}D"
-                query_ICD10_PMSI = f"""
-                    
-                    SELECT DISTINCT
-                    C.BEN_IDT_ANO, 
-                    C.BEN_RNG_GEM, 
-                    C.BEN_NIR_PSA, 
-                    B.DGN_PAL, 
-                    B.DGN_REL, 
-                    NULL AS ASS_DGN,
-                    A.EXE_SOI_DTD, 
-                    A.EXE_SOI_DTF
-                    FROM {table_nameB} B
-
-                    INNER JOIN {table_nameC} A 
-                    ON B.ETA_NUM = A.ETA_NUM AND B.RSA_NUM = A.RSA_NUM
-
-                    INNER JOIN IR_BEN_R C
-                    ON A.NIR_ANO_17 = C.BEN_NIR_PSA
-
-                    {where_condition_1}
-                    
-                    UNION ALL
-                    
-                    SELECT 
-                    C.BEN_IDT_ANO,
-                    C.BEN_RNG_GEM, 
-                    C.BEN_NIR_PSA, 
-                    NULL AS DGN_PAL,
-                    NULL AS DGN_REL,
-                    E.ASS_DGN, 
-                    A.EXE_SOI_DTD, 
-                    A.EXE_SOI_DTF
-                    FROM {table_nameD} E
-
-                    INNER JOIN {table_nameC} A 
-                    ON E.ETA_NUM = A.ETA_NUM AND E.RSA_NUM = A.RSA_NUM
+            """)
 
-                    INNER JOIN IR_BEN_R C
-                    ON A.NIR_ANO_17 = C.BEN_NIR_PSA
+        return queries
 
-                    {where_condition_2}
-                """
-                df_flux = self.GetQuery(query_ICD10_PMSI) 
-                df_icd10_pmsi = pd.concat([df_icd10_pmsi, df_flux], ignore_index=True)
-                df_icd10_pmsi.drop_duplicates(inplace=True)
-                df_icd10_pmsi.reset_index(drop=True, inplace=True)
-
-        if print_option==True :
-            print(str(len(np.unique(df_icd10_pmsi['BEN_IDT_ANO']))) + ' patients identified using ICD10 code in the PMSI.')
-        
-        return df_icd10_pmsi
-    
 
     def loc_ucd_pmsi(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_UCD=None, print_option=True, dev=False):
         '''
@@ -628,158 +2133,89 @@ class SNDS_Query() :
         Returns
         -------
         df_ucd_pmsi : DataFrame
-        DataFrame containing UCD codes ('UCD_UCD_COD', 'UCD_COD') from the PMSI, 
-        along with their execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF' and 'DELAI'), 
+        DataFrame containing UCD codes ('UCD_UCD_COD', 'UCD_COD') from the PMSI,
+        along with their execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF' and 'DELAI'),
         for each patient ('BEN_IDT_ANO') and specific hospital stays ('ETA_NUM', 'RSA_NUM').
         '''
 
-        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
-            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
-
-        if list_UCD is not None :
-            if type(list_UCD) != list :
-                raise ValueError("list_UCD must be a list of UCD medical codes.")
-
-        if (years is None) or (not isinstance(years, list)): 
-            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
-
-        if isinstance(years[0], datetime):
-            year_deb = int(str(years[0].year)[-2:])
-            deb = years[0]
-        else:
-            year_deb = str(years[0])[-2:]
-            deb = datetime(years[0], 1, 1)
-
-        if isinstance(years[1], datetime):
-            year_end = int(str(years[1].year)[-2:])
-            end = years[1]
-        else:
-            year_end = str(years[1])[-2:]
-            end = datetime(years[1], 12, 31)
-
-        conditions = []
-        if list_UCD:
-            liste_ucd_str = ', '.join(f"'{val}'" for val in list_UCD)
-            conditions.append(f"substr(B.UCD_UCD_COD, -7) IN ({liste_ucd_str})")
-        if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-            liste_benidtano_str = ', '.join(f"'{val}'" for val in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-            conditions.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-            liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-            conditions.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
-        conditions.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
-        where_condition = "WHERE " + " AND ".join(conditions)        
-
-        if dev == True :
-            query_UCD_PMSIMED = f"""
-
-                SELECT DISTINCT
-                C.BEN_IDT_ANO, 
-                C.BEN_RNG_GEM, 
-                C.BEN_NIR_PSA, 
-                B.UCD_UCD_COD,
-                substr(B.UCD_UCD_COD, -7) AS COD_UCD,
-                D.PHA_ATC_CLA,
-                D.PHA_ATC_LIB,
-                D.PHA_ATC_C07,
-                D.PHA_ATC_L07,
-                A.EXE_SOI_DTD, 
-                A.EXE_SOI_DTF
-                FROM T_MCOaaMED B
-
-                INNER JOIN T_MCOaaC A 
-                ON B.ETA_NUM = A.ETA_NUM AND B.RSA_NUM = A.RSA_NUM
-
-                INNER JOIN IR_BEN_R C
-                ON A.NIR_ANO_17 = C.BEN_NIR_PSA
+        def extract():
+            df_ucd_pmsi = self._collect_batches(lambda df_batch: self._ucd_pmsi_queries(df_batch, years, list_UCD, dev), df_ID_PATIENT, columns=None if dev else ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'UCD_UCD_COD', 'COD_UCD', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
+            return self._enrich_atc(df_ucd_pmsi, 'COD_UCD', 'PHA_CIP_UCD', ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'UCD_UCD_COD', 'COD_UCD', 'PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
 
-                LEFT JOIN IR_PHA_R D
-                ON substr(B.UCD_UCD_COD, -7)= D.PHA_CIP_UCD
+        df_ucd_pmsi = self._memoized('loc_ucd_pmsi', 'PMSI', df_ID_PATIENT, years, list_UCD, ['COD_UCD'], extract, dev=dev)
 
-                {where_condition}
-            """
-            df_ucd_pmsi = self.GetQuery(query_UCD_PMSIMED)
-            df_ucd_pmsi.drop_duplicates(inplace=True)
-            df_ucd_pmsi.reset_index(drop=True, inplace=True)
+        if print_option==True :
+            print(str(self._n_patients(df_ucd_pmsi)) + ' patients identified using UCD code in the PMSI.')
 
-        else :
+        return df_ucd_pmsi
 
-            df_ucd_pmsi = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'UCD_UCD_COD', 'COD_UCD', 'PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07', 'EXE_SOI_DTD', 'EXE_SOI_DTF'])
-            yy = list(range(int(year_deb), int(year_end)+1))
 
-            for year in yy :
+    def iter_ucd_pmsi(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_UCD=None, dev=False, chunksize=100000):
+        '''
+        Generator version of loc_ucd_pmsi, yielding the UCD data of the PMSI by chunks of bounded size.
 
-                table_nameMED = f"T_MCO{year}MED"
-                table_nameFH = f"T_MCO{year}FH"
-                table_nameC = f"T_MCO{year}C"
+        Parameters
+        ----------
+        df_ID_PATIENT, years, list_UCD, dev :
+            See loc_ucd_pmsi.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunk with the columns of loc_ucd_pmsi. Chunks are not deduplicated against each other.
+        '''
 
-                query_UCD_PMSIMED = f"""
+        queries = self._ucd_pmsi_queries(df_ID_PATIENT, years, list_UCD, dev)
+        columns = ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA', 'UCD_UCD_COD', 'COD_UCD', 'PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07', 'EXE_SOI_DTD', 'EXE_SOI_DTF']
+        return (self._enrich_atc(df_chunk, 'COD_UCD', 'PHA_CIP_UCD', columns) for df_chunk in self._iter_collect(queries, chunksize, columns=columns))
 
-                    SELECT DISTINCT
-                    C.BEN_IDT_ANO, 
-                    C.BEN_RNG_GEM, 
-                    C.BEN_NIR_PSA, 
-                    B.UCD_UCD_COD,
-                    substr(B.UCD_UCD_COD, -7) AS COD_UCD,
-                    D.PHA_ATC_CLA,
-                    D.PHA_ATC_LIB,
-                    D.PHA_ATC_C07,
-                    D.PHA_ATC_L07,
-                    A.EXE_SOI_DTD, 
-                    A.EXE_SOI_DTF
-                    FROM {table_nameMED} B
 
-                    INNER JOIN {table_nameC} A 
-                    ON B.ETA_NUM = A.ETA_NUM AND B.RSA_NUM = A.RSA_NUM
+    def _ucd_pmsi_queries(self, df_ID_PATIENT, years, list_UCD, dev):
+        '''
+        Build the SQL queries of loc_ucd_pmsi, one for each year and table (MED, FH) of the PMSI. The ATC classes are added by _enrich_atc.
+        '''
+
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-                    INNER JOIN IR_BEN_R C
-                    ON A.NIR_ANO_17 = C.BEN_NIR_PSA
+        if list_UCD is not None :
+            if type(list_UCD) != list :
+                raise ValueError("list_UCD must be a list of UCD medical codes.")
 
-                    LEFT JOIN IR_PHA_R D
-                    ON substr(B.UCD_UCD_COD, -7) = D.PHA_CIP_UCD
+        where_condition = ""
+        if list_UCD:
+            liste_ucd_str = ', '.join(f"'{val}'" for val in list_UCD)
+            where_condition = f"WHERE substr(B.UCD_UCD_COD, -7) IN ({liste_ucd_str})"
 
-                    {where_condition}
-                """
-                df_flux_MED = self.GetQuery(query_UCD_PMSIMED)
-                df_ucd_pmsi = pd.concat([df_ucd_pmsi, df_flux_MED], ignore_index=True)
-                df_ucd_pmsi.drop_duplicates(inplace=True)
-                df_ucd_pmsi.reset_index(drop=True, inplace=True)
+        # The simulated dataset only has the MED table
+        tables = ['MED'] if dev else ['MED', 'FH']
+        catalog = self.catalog()
 
-                query_UCD_PMSIFH = f"""
+        queries = []
+        for year in self._pmsi_partitions(years, dev):
+            stays = self._pmsi_stays(df_ID_PATIENT, years, year)
+            for table in [table for table in tables if f"T_MCO{year}{table}".upper() in catalog['tables']]:
+                queries.append(f"""
 
                     SELECT DISTINCT
-                    C.BEN_IDT_ANO, 
-                    C.BEN_RNG_GEM, 
-                    C.BEN_NIR_PSA, 
+                    S.BEN_IDT_ANO,
+                    S.BEN_RNG_GEM,
+                    S.BEN_NIR_PSA,
                     B.UCD_UCD_COD,
                     substr(B.UCD_UCD_COD, -7) AS COD_UCD,
-                    D.PHA_ATC_CLA,
-                    D.PHA_ATC_LIB,
-                    D.PHA_ATC_C07,
-                    D.PHA_ATC_L07,
-                    A.EXE_SOI_DTD, 
-                    A.EXE_SOI_DTF
-                    FROM {table_nameFH} B
-
-                    INNER JOIN {table_nameC} A 
-                    ON B.ETA_NUM = A.ETA_NUM AND B.RSA_NUM = A.RSA_NUM
-
-                    INNER JOIN IR_BEN_R C
-                    ON A.NIR_ANO_17 = C.BEN_NIR_PSA
+                    S.EXE_SOI_DTD,
+                    S.EXE_SOI_DTF
+                    FROM T_MCO{year}{table} B
 
-                    LEFT JOIN IR_PHA_R D
-                    ON substr(B.UCD_UCD_COD, -7) = D.PHA_CIP_UCD
+                    INNER JOIN {stays} S
+                    ON B.ETA_NUM = S.ETA_NUM AND B.RSA_NUM = S.RSA_NUM
 
                     {where_condition}
-                """
-                df_flux_FH = self.GetQuery(query_UCD_PMSIFH)
-                df_ucd_pmsi = pd.concat([df_ucd_pmsi, df_flux_FH], ignore_index=True)
-                df_ucd_pmsi.drop_duplicates(inplace=True)
-                df_ucd_pmsi.reset_index(drop=True, inplace=True)
+                """)
 
-        if print_option==True :
-            print(str(len(np.unique(df_ucd_pmsi['BEN_IDT_ANO']))) + ' patients identified using UCD code in the PMSI.')
-
-        return df_ucd_pmsi
+        return queries
 
 
     def loc_cip_dcir(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_CIP13=None, print_option=True):
@@ -796,196 +2232,110 @@ class SNDS_Query() :
             List of CIP-13 codes to be retrieved. If None all CIP-13 codes will be returned for the targeted population. Default is None.
         print_option : bool, optional
             If True, prints the number of unique patients identified with at least one of the specified CIP-13 codes. Default is True.
-        
+
         Returns
         -------
         df_cip_dcir : DataFrame
-            DataFrame containing CIP-13 codes ('PHA_CIP_C13') from the DCIR, 
-            with their equivalence in ATC coding ('PHA_ATC_CLA', 'PHA_ATC_LIB'), 
-            along with their corresponding execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'), 
+            DataFrame containing CIP-13 codes ('PHA_CIP_C13') from the DCIR,
+            with their equivalence in ATC coding ('PHA_ATC_CLA', 'PHA_ATC_LIB'),
+            along with their corresponding execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'),
             for each patient ('BEN_IDT_ANO').
         '''
-        
-        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
-            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
-
-        if list_CIP13 is not None :
-            if type(list_CIP13) != list :
-                raise ValueError("list_CIP13 must be a list of CIP-13 medical codes.")
-
-        if (years is None) or (not isinstance(years, list)): 
-            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
-
-        if isinstance(years[0], datetime):
-            flxmin_year = years[0].year
-            deb = years[0]
-        else:
-            flxmin_year = years[0]
-            deb = datetime(years[0], 1, 1)
-
-        if isinstance(years[1], datetime):
-            flxmax_year = years[1].year
-            end = years[1]
-        else:
-            flxmax_year = years[1]
-            end = datetime(years[1], 12, 31)
-
-        flxmin = datetime(flxmin_year, 1, 1)
-        flxmax_date = (end + relativedelta(months=6)).replace(day=1)
-        vecflx = []
-        current_date = flxmin
-        while current_date <= flxmax_date:
-            vecflx.append(current_date.strftime("%Y-%m-%d"))
-            current_date += relativedelta(months=1)
-
-        df_cip_dcir = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'PHA_CIP_C13', 'PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07'])
-
-
-        top_ER_PRS_F = True
-        
-        # if self.backend == 'sqlite':
-        #     cursor = self.conn.cursor()
-        #     cursor.execute(
-        #     "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
-        #     ('E_PRS_F',)
-        #     )
-        #     top_ER_PRS_F = cursor.fetchone() is not None
-
-        if self.backend == 'spark':
-            top_ER_PRS_F = self.conn.catalog.tableExists('ER_PRS_F')
-
-            
-        if top_ER_PRS_F==True :
-
-            for flux in vecflx:
-
-                conditions = []
-
-                if list_CIP13:
-                    liste_cip13_str = ', '.join(f"'{valeur}'" for valeur in list_CIP13)
-                    conditions.append(f"D.PHA_PRS_C13 IN ({liste_cip13_str})")
 
-                if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-                    liste_benidtano_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-                    conditions.append(f"B.BEN_IDT_ANO IN ({liste_benidtano_str})")
-                    liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-                    conditions.append(f"B.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
+        def extract():
+            df_cip_dcir = self._collect_batches(lambda df_batch: self._cip_dcir_queries(df_batch, years, list_CIP13), df_ID_PATIENT, columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'PHA_CIP_C13'], 
+                                                identities=['BEN_NIR_PSA', 'BEN_RNG_GEM'])
+            return self._enrich_atc(df_cip_dcir, 'PHA_CIP_C13', 'PHA_CIP_C13', ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'PHA_CIP_C13', 'PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07'])
 
-                conditions.append(f"A.FLX_DIS_DTD = '{flux}'")
-                conditions.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
+        df_cip_dcir = self._memoized('loc_cip_dcir', 'DCIR', df_ID_PATIENT, years, list_CIP13, ['PHA_CIP_C13'], extract)
 
-                where_condition = "WHERE " + " AND ".join(conditions)
+        if print_option==True :
+            print(str(self._n_patients(df_cip_dcir)) + ' patients identified using CIP code in the DCIR.')
 
-                query_CIP13_DCIR = f"""
+        return df_cip_dcir
 
-                    SELECT DISTINCT
-                    B.BEN_IDT_ANO,
-                    A.BEN_NIR_PSA, 
-                    A.BEN_RNG_GEM, 
-                    A.EXE_SOI_DTD,
-                    A.EXE_SOI_DTF,
-                    D.PHA_PRS_C13 AS PHA_CIP_C13,
-                    E.PHA_ATC_CLA,
-                    E.PHA_ATC_LIB,
-                    E.PHA_ATC_C07,
-                    E.PHA_ATC_L07
-                    FROM ER_PRS_F A
-
-                    INNER JOIN IR_BEN_R B
-                    ON (A.BEN_NIR_PSA = B.BEN_NIR_PSA AND A.BEN_RNG_GEM = B.BEN_RNG_GEM)
-
-                    INNER JOIN ER_PHA_F D ON (
-                    A.FLX_DIS_DTD = D.FLX_DIS_DTD 
-                    AND A.FLX_TRT_DTD = D.FLX_TRT_DTD
-                    AND A.FLX_EMT_TYP = D.FLX_EMT_TYP
-                    AND A.FLX_EMT_NUM = D.FLX_EMT_NUM
-                    AND A.FLX_EMT_ORD = D.FLX_EMT_ORD
-                    AND A.ORG_CLE_NUM = D.ORG_CLE_NUM
-                    AND A.DCT_ORD_NUM = D.DCT_ORD_NUM
-                    AND A.PRS_ORD_NUM = D.PRS_ORD_NUM
-                    AND A.REM_TYP_AFF = D.REM_TYP_AFF
-                    )
 
-                    LEFT JOIN IR_PHA_R E ON 
-                    D.PHA_PRS_C13 = E.PHA_CIP_C13
+    def iter_cip_dcir(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_CIP13=None, chunksize=100000):
+        '''
+        Generator version of loc_cip_dcir, yielding the CIP-13 data of the DCIR by chunks of bounded size.
 
-                    {where_condition}
-                """
-                df_flux = self.GetQuery(query_CIP13_DCIR)
-                df_cip_dcir = pd.concat([df_cip_dcir, df_flux], ignore_index=True)
-                df_cip_dcir.drop_duplicates(inplace=True)
-                df_cip_dcir.reset_index(drop=True, inplace=True)
+        Parameters
+        ----------
+        df_ID_PATIENT, years, list_CIP13 :
+            See loc_cip_dcir.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunk with the columns of loc_cip_dcir. Chunks are not deduplicated against each other.
+        '''
 
+        queries = self._cip_dcir_queries(df_ID_PATIENT, years, list_CIP13)
+        columns = ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'PHA_CIP_C13', 'PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07']
+        chunks = self._iter_identities(self._iter_collect(queries, chunksize, columns=columns), df_ID_PATIENT, ['BEN_NIR_PSA', 'BEN_RNG_GEM'], chunksize)
+        # a code may have several ATC classes in IR_PHA_R
+        return self._bounded_chunks((self._enrich_atc(df_chunk, 'PHA_CIP_C13', 'PHA_CIP_C13', columns) for df_chunk in chunks), chunksize)
 
-        else :
 
-            conditions = []
+    def _cip_dcir_queries(self, df_ID_PATIENT, years, list_CIP13):
+        '''
+        Build the SQL queries of loc_cip_dcir, one for each partition of the DCIR. The ATC classes are added by _enrich_atc.
+        '''
 
-            if list_CIP13:
-                liste_cip13_str = ', '.join(f"'{valeur}'" for valeur in list_CIP13)
-                conditions.append(f"D.PHA_PRS_C13 IN ({liste_cip13_str})")
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-            if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-                liste_benidtano_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-                conditions.append(f"B.BEN_IDT_ANO IN ({liste_benidtano_str})")
-                liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-                conditions.append(f"B.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
+        if list_CIP13 is not None :
+            if type(list_CIP13) != list :
+                raise ValueError("list_CIP13 must be a list of CIP-13 medical codes.")
 
-            conditions.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
+        deb, end = self._period(years)
 
-            where_condition = "WHERE " + " AND ".join(conditions)
+        conditions = []
+        if list_CIP13:
+            liste_cip13_str = ', '.join(f"'{valeur}'" for valeur in list_CIP13)
+            conditions.append(f"D.PHA_PRS_C13 IN ({liste_cip13_str})")
+        identity_columns, identity_join, patient_conditions = self._identity_sql(df_ID_PATIENT, 'A', 'B', ['BEN_NIR_PSA', 'BEN_RNG_GEM'])
+        conditions += patient_conditions
 
-            yy = list(range(int(flxmin_year), (int(flxmax_year)+1)))
+        queries = []
+        for suffix, flux_conditions in self._dcir_partitions(years, 'A'):
 
-            for year in yy :
+            where_condition = "WHERE " + " AND ".join(conditions + flux_conditions + [f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'"])
 
-                query_CIP13_DCIR = f"""
+            queries.append(f"""
 
-                    SELECT DISTINCT
-                    B.BEN_IDT_ANO,
-                    A.BEN_NIR_PSA, 
-                    A.BEN_RNG_GEM, 
-                    A.EXE_SOI_DTD,
-                    A.EXE_SOI_DTF,
-                    D.PHA_PRS_C13 AS PHA_CIP_C13,
-                    E.PHA_ATC_CLA,
-                    E.PHA_ATC_LIB,
-                    E.PHA_ATC_C07,
-                    E.PHA_ATC_L07
-                    FROM ER_PRS_F_{year} A
-
-                    INNER JOIN IR_BEN_R B
-                    ON (A.BEN_NIR_PSA = B.BEN_NIR_PSA AND A.BEN_RNG_GEM = B.BEN_RNG_GEM)
-
-                    INNER JOIN ER_PHA_F_{year} D ON (
-                    A.FLX_DIS_DTD = D.FLX_DIS_DTD 
-                    AND A.FLX_TRT_DTD = D.FLX_TRT_DTD
-                    AND A.FLX_EMT_TYP = D.FLX_EMT_TYP
-                    AND A.FLX_EMT_NUM = D.FLX_EMT_NUM
-                    AND A.FLX_EMT_ORD = D.FLX_EMT_ORD
-                    AND A.ORG_CLE_NUM = D.ORG_CLE_NUM
-                    AND A.DCT_ORD_NUM = D.DCT_ORD_NUM
-                    AND A.PRS_ORD_NUM = D.PRS_ORD_NUM
-                    AND A.REM_TYP_AFF = D.REM_TYP_AFF
-                    )
+                SELECT DISTINCT
+                {identity_columns['BEN_IDT_ANO']},
+                A.BEN_NIR_PSA,
+                A.BEN_RNG_GEM,
+                A.EXE_SOI_DTD,
+                A.EXE_SOI_DTF,
+                D.PHA_PRS_C13 AS PHA_CIP_C13
+                FROM ER_PRS_F{suffix} A
+
+                {identity_join}
+
+                INNER JOIN ER_PHA_F{suffix} D ON (
+                A.FLX_DIS_DTD = D.FLX_DIS_DTD
+                AND A.FLX_TRT_DTD = D.FLX_TRT_DTD
+                AND A.FLX_EMT_TYP = D.FLX_EMT_TYP
+                AND A.FLX_EMT_NUM = D.FLX_EMT_NUM
+                AND A.FLX_EMT_ORD = D.FLX_EMT_ORD
+                AND A.ORG_CLE_NUM = D.ORG_CLE_NUM
+                AND A.DCT_ORD_NUM = D.DCT_ORD_NUM
+                AND A.PRS_ORD_NUM = D.PRS_ORD_NUM
+                AND A.REM_TYP_AFF = D.REM_TYP_AFF
+                )
 
-                    LEFT JOIN IR_PHA_R E ON 
-                    D.PHA_PRS_C13 = E.PHA_CIP_C13
+                {where_condition}
+            """)
 
-                    {where_condition}
-                """
-                df_flux = self.GetQuery(query_CIP13_DCIR)
-                df_cip_dcir = pd.concat([df_cip_dcir, df_flux], ignore_index=True)
-                df_cip_dcir.drop_duplicates(inplace=True)
-                df_cip_dcir.reset_index(drop=True, inplace=True)
+        return queries
 
 
-        if print_option==True :
-            print(str(len(np.unique(df_cip_dcir['BEN_IDT_ANO']))) + ' patients identified using CIP code in the DCIR.')
-    
-        return df_cip_dcir
-    
-    
     def loc_ucd_dcir(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_UCD=None, print_option=True):
         '''
         Method for gathering specific UCD data from the targeted population in the DCIR.
@@ -1004,194 +2354,260 @@ class SNDS_Query() :
         Returns
         -------
         df_ucd_dcir : DataFrame
-        DataFrame containing UCD codes from the DCIR, 
-        with their equivalence in ATC coding ('PHA_ATC_CLA', 'PHA_ATC_LIB'), 
-        along with their corresponding execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'), 
+        DataFrame containing UCD codes from the DCIR,
+        with their equivalence in ATC coding ('PHA_ATC_CLA', 'PHA_ATC_LIB'),
+        along with their corresponding execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'),
         for each patient ('BEN_IDT_ANO').
         '''
-        
-        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
-            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-        if list_UCD is not None :
-            if type(list_UCD) != list :
-                raise ValueError("list_UCD must be a list of UCD medical codes.")
+        def extract():
+            df_ucd_dcir = self._collect_batches(lambda df_batch: self._ucd_dcir_queries(df_batch, years, list_UCD), df_ID_PATIENT, columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'UCD_UCD_COD', 'COD_UCD'], 
+                                                identities=['BEN_NIR_PSA'])
+            return self._enrich_atc(df_ucd_dcir, 'COD_UCD', 'PHA_CIP_UCD', ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'UCD_UCD_COD', 'COD_UCD', 'PHA_ATC_CLA', 'PHA_ATC_LIB','PHA_ATC_C07', 'PHA_ATC_L07'])
 
-        if (years is None) or (not isinstance(years, list)): 
-            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
+        df_ucd_dcir = self._memoized('loc_ucd_dcir', 'DCIR', df_ID_PATIENT, years, list_UCD, ['COD_UCD'], extract)
 
-        if isinstance(years[0], datetime):
-            flxmin_year = years[0].year
-            deb = years[0]
-        else:
-            flxmin_year = years[0]
-            deb = datetime(years[0], 1, 1)
+        if print_option==True :
+            print(str(self._n_patients(df_ucd_dcir)) + ' patients identified using UCD code in the DCIR.')
 
-        if isinstance(years[1], datetime):
-            flxmax_year = years[1].year
-            end = years[1]
-        else:
-            flxmax_year = years[1]
-            end = datetime(years[1], 12, 31)
+        return df_ucd_dcir
 
-        flxmin = datetime(flxmin_year, 1, 1)
-        flxmax_date = (end + relativedelta(months=6)).replace(day=1)
-        vecflx = []
-        current_date = flxmin
-        while current_date <= flxmax_date:
-            vecflx.append(current_date.strftime("%Y-%m-%d"))
-            current_date += relativedelta(months=1)
 
-        df_ucd_dcir = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'UCD_UCD_COD', 'COD_UCD', 'PHA_ATC_CLA', 'PHA_ATC_LIB','PHA_ATC_C07', 'PHA_ATC_L07'])
+    def iter_ucd_dcir(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_UCD=None, chunksize=100000):
+        '''
+        Generator version of loc_ucd_dcir, yielding the UCD data of the DCIR by chunks of bounded size.
 
+        Parameters
+        ----------
+        df_ID_PATIENT, years, list_UCD :
+            See loc_ucd_dcir.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunk with the columns of loc_ucd_dcir. Chunks are not deduplicated against each other.
+        '''
 
-        top_ER_PRS_F = True
-        
-        # if self.backend == 'sqlite':
-        #     cursor = self.conn.cursor()
-        #     cursor.execute(
-        #     "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
-        #     ('E_PRS_F',)
-        #     )
-        #     top_ER_PRS_F = cursor.fetchone() is not None
+        queries = self._ucd_dcir_queries(df_ID_PATIENT, years, list_UCD)
+        columns = ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'EXE_SOI_DTF', 'UCD_UCD_COD', 'COD_UCD', 'PHA_ATC_CLA', 'PHA_ATC_LIB','PHA_ATC_C07', 'PHA_ATC_L07']
+        chunks = self._iter_identities(self._iter_collect(queries, chunksize, columns=columns), df_ID_PATIENT, ['BEN_NIR_PSA'], chunksize)
+        # a code may have several ATC classes in IR_PHA_R
+        return self._bounded_chunks((self._enrich_atc(df_chunk, 'COD_UCD', 'PHA_CIP_UCD', columns) for df_chunk in chunks), chunksize)
 
 
-        if self.backend == 'spark':
-            top_ER_PRS_F = self.conn.catalog.tableExists('ER_PRS_F')
+    def _ucd_dcir_queries(self, df_ID_PATIENT, years, list_UCD):
+        '''
+        Build the SQL queries of loc_ucd_dcir, one for each partition of the DCIR. The ATC classes are added by _enrich_atc.
+        '''
 
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-        if top_ER_PRS_F==True :
+        if list_UCD is not None :
+            if type(list_UCD) != list :
+                raise ValueError("list_UCD must be a list of UCD medical codes.")
 
-            for flux in vecflx:
+        deb, end = self._period(years)
 
-                conditions = []
-                if list_UCD:
-                    liste_ucd_str = ', '.join(f"'{val}'" for val in list_UCD)
-                    conditions.append(f"substr(B.UCD_UCD_COD, -7) IN ({liste_ucd_str})")
-                if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-                    liste_benidtano_str = ', '.join(f"'{val}'" for val in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-                    conditions.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-                    liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-                    conditions.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
-                    
-                conditions.append(f"A.FLX_DIS_DTD = '{flux}'")
-                conditions.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
+        conditions = []
+        if list_UCD:
+            liste_ucd_str = ', '.join(f"'{val}'" for val in list_UCD)
+            conditions.append(f"substr(B.UCD_UCD_COD, -7) IN ({liste_ucd_str})")
+        identity_columns, identity_join, patient_conditions = self._identity_sql(df_ID_PATIENT, 'A', 'C', ['BEN_NIR_PSA'])
+        conditions += patient_conditions
 
-                where_condition = "WHERE " + " AND ".join(conditions)        
+        queries = []
+        for suffix, flux_conditions in self._dcir_partitions(years, 'A'):
 
-                query_UCD_ER_UCD_F = f"""
+            where_condition = "WHERE " + " AND ".join(conditions + flux_conditions + [f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'"])
 
-                    SELECT DISTINCT
-                        C.BEN_IDT_ANO, 
-                        C.BEN_RNG_GEM, 
-                        C.BEN_NIR_PSA, 
-                        B.UCD_UCD_COD,
-                        substr(B.UCD_UCD_COD, -7) AS COD_UCD,
-                        D.PHA_ATC_CLA,
-                        D.PHA_ATC_LIB,
-                        D.PHA_ATC_C07,
-                        D.PHA_ATC_L07,
-                        A.EXE_SOI_DTD, 
-                        A.EXE_SOI_DTF
-                    FROM ER_UCD_F B
-
-                    INNER JOIN ER_PRS_F A ON (
-                            A.FLX_DIS_DTD = B.FLX_DIS_DTD 
-                            AND A.FLX_TRT_DTD = B.FLX_TRT_DTD
-                            AND A.FLX_EMT_TYP = B.FLX_EMT_TYP
-                            AND A.FLX_EMT_NUM = B.FLX_EMT_NUM
-                            AND A.FLX_EMT_ORD = B.FLX_EMT_ORD
-                            AND A.ORG_CLE_NUM = B.ORG_CLE_NUM
-                            AND A.DCT_ORD_NUM = B.DCT_ORD_NUM
-                            AND A.PRS_ORD_NUM = B.PRS_ORD_NUM
-                            AND A.REM_TYP_AFF = B.REM_TYP_AFF
-                        )
-
-                    INNER JOIN IR_BEN_R C
-                        ON A.BEN_NIR_PSA = C.BEN_NIR_PSA
-
-                    LEFT JOIN IR_PHA_R D
-                        ON substr(B.UCD_UCD_COD, -7) = D.PHA_CIP_UCD
+            queries.append(f"""
 
-                    {where_condition}
+                SELECT DISTINCT
+                    {identity_columns['BEN_IDT_ANO']},
+                    {identity_columns['BEN_RNG_GEM']},
+                    {identity_columns['BEN_NIR_PSA']},
+                    B.UCD_UCD_COD,
+                    substr(B.UCD_UCD_COD, -7) AS COD_UCD,
+                    A.EXE_SOI_DTD,
+                    A.EXE_SOI_DTF
+                FROM ER_UCD_F{suffix} B
+
+                INNER JOIN ER_PRS_F{suffix} A ON (
+                        A.FLX_DIS_DTD = B.FLX_DIS_DTD
+                        AND A.FLX_TRT_DTD = B.FLX_TRT_DTD
+                        AND A.FLX_EMT_TYP = B.FLX_EMT_TYP
+                        AND A.FLX_EMT_NUM = B.FLX_EMT_NUM
+                        AND A.FLX_EMT_ORD = B.FLX_EMT_ORD
+                        AND A.ORG_CLE_NUM = B.ORG_CLE_NUM
+                        AND A.DCT_ORD_NUM = B.DCT_ORD_NUM
+                        AND A.PRS_ORD_NUM = B.PRS_ORD_NUM
+                        AND A.REM_TYP_AFF = B.REM_TYP_AFF
+                    )
 
-                """
+                {identity_join}
 
-                df_flux = self.GetQuery(query_UCD_ER_UCD_F)
-                df_ucd_dcir = pd.concat([df_ucd_dcir, df_flux], ignore_index=True)
-                df_ucd_dcir.drop_duplicates(inplace=True)
-                df_ucd_dcir.reset_index(drop=True, inplace=True)
+                {where_condition}
 
+            """)
 
-        else :
+        return queries
 
-            conditions = []
-            if list_UCD:
-                liste_ucd_str = ', '.join(f"'{val}'" for val in list_UCD)
-                conditions.append(f"substr(B.UCD_UCD_COD, -7) IN ({liste_ucd_str})")
-            if df_ID_PATIENT is not None and not df_ID_PATIENT.empty:
-                liste_benidtano_str = ', '.join(f"'{val}'" for val in np.unique(df_ID_PATIENT.BEN_IDT_ANO))
-                conditions.append(f"C.BEN_IDT_ANO IN ({liste_benidtano_str})")
-                liste_bennirpsa_str = ', '.join(f"'{valeur}'" for valeur in np.unique(df_ID_PATIENT.BEN_NIR_PSA))
-                conditions.append(f"C.BEN_NIR_PSA IN ({liste_bennirpsa_str})")
 
-            conditions.append(f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'")
 
-            where_condition = "WHERE " + " AND ".join(conditions)      
 
-            yy = list(range(int(flxmin_year), (int(flxmax_year)+1)))
-            
-            for year in yy :
+    def loc_dcir(self, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], dict_code={'CCAM': None, 'CIP13': None, 'UCD': None}, print_option=True):
+        '''
+        Method for gathering CCAM, CIP-13 and UCD data from the targeted population in a single pass over the DCIR : 
+        ER_PRS_F is joined once with IR_BEN_R (or mapped with the identity index), ER_CAM_F, ER_PHA_F and ER_UCD_F are left joined on the claim key, 
+        and the rows are split back by type of code. The results are the same as those of loc_ccam_dcir, loc_cip_dcir and loc_ucd_dcir.
 
-                query_UCD_ER_UCD_F = f"""
+        Parameters
+        ----------
+        df_ID_PATIENT : DataFrame
+            DataFrame containing the columns "BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM", which holds the unique identifiers of the targeted population. If None, no filter is applied on patients identifiers.
+        years : list
+            List of dates (either years as integers or datetime(yyyy, mm, dd)) defining the period during which to search for codes. By default 1st of January 2020 and 31 of December 2020.
+        dict_code : dict
+            Dictionary whose keys are the types of code to retrieve (possible keys: {'CCAM', 'CIP13', 'UCD'}), mapping to a list of codes, 
+            or to None to retrieve all the codes of this type. Default is all the codes of the three types.
+        print_option : bool, optional
+            If True, prints the number of unique patients identified with each type of code. Default is True.
 
-                    SELECT DISTINCT
-                    C.BEN_IDT_ANO, 
-                    C.BEN_RNG_GEM, 
-                    C.BEN_NIR_PSA, 
-                    B.UCD_UCD_COD,
-                    substr(B.UCD_UCD_COD, -7) AS COD_UCD,
-                    D.PHA_ATC_CLA,
-                    D.PHA_ATC_LIB,
-                    D.PHA_ATC_C07,
-                    D.PHA_ATC_L07,
-                    A.EXE_SOI_DTD, 
-                    A.EXE_SOI_DTF
-                    FROM ER_UCD_F_{year} B
-
-                    INNER JOIN ER_PRS_F_{year} A ON (
-                    A.FLX_DIS_DTD = B.FLX_DIS_DTD 
-                    AND A.FLX_TRT_DTD = B.FLX_TRT_DTD
-                    AND A.FLX_EMT_TYP = B.FLX_EMT_TYP
-                    AND A.FLX_EMT_NUM = B.FLX_EMT_NUM
-                    AND A.FLX_EMT_ORD = B.FLX_EMT_ORD
-                    AND A.ORG_CLE_NUM = B.ORG_CLE_NUM
-                    AND A.DCT_ORD_NUM = B.DCT_ORD_NUM
-                    AND A.PRS_ORD_NUM = B.PRS_ORD_NUM
-                    AND A.REM_TYP_AFF = B.REM_TYP_AFF
-                    )
+        Returns
+        -------
+        dict_dcir : dict
+            Dictionary mapping each key of dict_code to the DataFrame that loc_ccam_dcir ('CCAM'), loc_cip_dcir ('CIP13') or loc_ucd_dcir ('UCD') would return.
+        '''
 
-                    INNER JOIN IR_BEN_R C
-                    ON A.BEN_NIR_PSA = C.BEN_NIR_PSA
+        if (type(dict_code) != dict) or (not set(dict_code) <= {'CCAM', 'CIP13', 'UCD'}):
+            raise ValueError("dict_code must be a dictionnary with keys 'CCAM', 'CIP13' and/or 'UCD'.")
+
+        if len(dict_code) == 0:
+            return {}
+
+        # the rows are deduplicated after the split, on the columns of each type of code
+        df_dcir = self._collect_batches(lambda df_batch: self._dcir_queries(df_batch, years, dict_code), df_ID_PATIENT, distinct=False, identities=['BEN_NIR_PSA'])
+
+        # (flag of the rows of the type of code, columns of the output with their name in df_dcir, message)
+        outputs = {
+            'CCAM': ('IS_CCAM', [('BEN_IDT_ANO', 'BEN_IDT_ANO'), ('BEN_NIR_PSA', 'BEN_NIR_PSA'), ('BEN_RNG_GEM', 'BEN_RNG_GEM'), ('CAM_PRS_IDE', 'CAM_PRS_IDE'), 
+                                 ('EXE_SOI_DTD', 'EXE_SOI_DTD'), ('EXE_SOI_DTF', 'EXE_SOI_DTF')], 'CCAM'),
+            'CIP13': ('IS_CIP13', [('BEN_IDT_ANO', 'BEN_IDT_ANO'), ('BEN_NIR_PSA', 'BEN_NIR_PSA'), ('BEN_RNG_GEM', 'BEN_RNG_GEM'), ('EXE_SOI_DTD', 'EXE_SOI_DTD'), ('EXE_SOI_DTF', 'EXE_SOI_DTF'), 
+                                   ('PHA_CIP_C13', 'PHA_CIP_C13')], 'CIP'),
+            'UCD': ('IS_UCD', [('BEN_IDT_ANO', 'BEN_IDT_ANO'), ('BEN_NIR_PSA', 'BEN_NIR_PSA'), ('BEN_RNG_GEM', 'BEN_RNG_GEM'), ('EXE_SOI_DTD', 'EXE_SOI_DTD'), ('EXE_SOI_DTF', 'EXE_SOI_DTF'), 
+                               ('UCD_UCD_COD', 'UCD_UCD_COD'), ('COD_UCD', 'COD_UCD')], 'UCD'),
+        }
+
+        dict_dcir = {}
+        for key in dict_code:
+            flag, columns, name = outputs[key]
+            # As in loc_ucd_dcir, UCD rows are matched to IR_BEN_R on BEN_NIR_PSA only
+            dict_dcir[key] = self._split_frame(df_dcir, flag, 'SAME_GEM' if key != 'UCD' else None, columns)
+            if key != 'CCAM':
+                code = 'PHA_CIP_C13' if key == 'CIP13' else 'COD_UCD'
+                dict_dcir[key] = self._enrich_atc(dict_dcir[key], code, 'PHA_CIP_UCD' if key == 'UCD' else 'PHA_CIP_C13', 
+                                                  [name for _, name in columns] + ['PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07'])
+            if print_option==True :
+                print(str(self._n_patients(dict_dcir[key])) + ' patients identified using ' + name + ' code in the DCIR.')
+
+        return dict_dcir
+
+
+    def _split_frame(self, df, flag, flag_gem, columns):
+        '''
+        Return the rows of df whose flag (and flag_gem if given) is 1, with the columns renamed as in columns (list of (name in df, output name)), without duplicates.
+        '''
 
-                    LEFT JOIN IR_PHA_R D
-                    ON substr(B.UCD_UCD_COD, -7) = D.PHA_CIP_UCD
+        if self._is_spark_frame(df):
+            from pyspark.sql import functions as F
+            condition = (F.col(flag) == 1) if flag_gem is None else ((F.col(flag) == 1) & (F.col(flag_gem) == 1))
+            return df.filter(condition).select(*[F.col(col).alias(name) for col, name in columns]).distinct()
 
-                    {where_condition}
+        mask = (df[flag] == 1) if flag_gem is None else ((df[flag] == 1) & (df[flag_gem] == 1))
+        df_split = df.loc[mask, [col for col, _ in columns]].rename(columns=dict(columns))
+        return df_split.drop_duplicates().reset_index(drop=True)
 
-                """
 
-                df_flux = self.GetQuery(query_UCD_ER_UCD_F)
-                df_ucd_dcir = pd.concat([df_ucd_dcir, df_flux], ignore_index=True)
-                df_ucd_dcir.drop_duplicates(inplace=True)
-                df_ucd_dcir.reset_index(drop=True, inplace=True)
+    def _dcir_queries(self, df_ID_PATIENT, years, dict_code):
+        '''
+        Build the SQL queries of loc_dcir, one for each partition of the DCIR.
+        '''
 
-        if print_option==True :
-            print(str(len(np.unique(df_ucd_dcir['BEN_IDT_ANO']))) + ' patients identified using UCD code in the DCIR.')
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
-        return df_ucd_dcir
+        for key, name in [('CCAM', 'CCAM'), ('CIP13', 'CIP-13'), ('UCD', 'UCD')]:
+            if (dict_code.get(key) is not None) and (type(dict_code[key]) != list):
+                raise ValueError(f"dict_code['{key}'] must be a list of {name} medical codes.")
+
+        deb, end = self._period(years)
+
+        flux_key = ['FLX_DIS_DTD', 'FLX_TRT_DTD', 'FLX_EMT_TYP', 'FLX_EMT_NUM', 'FLX_EMT_ORD', 'ORG_CLE_NUM', 'DCT_ORD_NUM', 'PRS_ORD_NUM', 'REM_TYP_AFF']
+
+        identity_columns, identity_join, conditions = self._identity_sql(df_ID_PATIENT, 'A', 'C', ['BEN_NIR_PSA'])
+        # SAME_GEM is computed by _map_identities when the identity index is used
+        same_gem = "NULL AS SAME_GEM" if identity_join == "" else "CASE WHEN A.BEN_RNG_GEM = C.BEN_RNG_GEM THEN 1 ELSE 0 END AS SAME_GEM"
+
+        queries = []
+        for suffix, flux_conditions in self._dcir_partitions(years, 'A'):
+
+            columns, joins, matches = [], [], []
+
+            if 'CCAM' in dict_code:
+                on_condition = [f"A.{col} = CAM.{col}" for col in flux_key]
+                if dict_code['CCAM']:
+                    liste_ccam_str = ', '.join(f"'{valeur}'" for valeur in dict_code['CCAM'])
+                    on_condition.append(f"CAM.CAM_PRS_IDE IN ({liste_ccam_str})")
+                joins.append(f"LEFT JOIN ER_CAM_F{suffix} CAM ON (" + " AND ".join(on_condition) + ")")
+                columns += ["CASE WHEN CAM.FLX_DIS_DTD IS NULL THEN 0 ELSE 1 END AS IS_CCAM", "CAM.CAM_PRS_IDE"]
+                matches.append("CAM.FLX_DIS_DTD IS NOT NULL")
+
+            if 'CIP13' in dict_code:
+                on_condition = [f"A.{col} = PHA.{col}" for col in flux_key]
+                if dict_code['CIP13']:
+                    liste_cip13_str = ', '.join(f"'{valeur}'" for valeur in dict_code['CIP13'])
+                    on_condition.append(f"PHA.PHA_PRS_C13 IN ({liste_cip13_str})")
+                joins.append(f"LEFT JOIN ER_PHA_F{suffix} PHA ON (" + " AND ".join(on_condition) + ")")
+                columns += ["CASE WHEN PHA.FLX_DIS_DTD IS NULL THEN 0 ELSE 1 END AS IS_CIP13", "PHA.PHA_PRS_C13 AS PHA_CIP_C13"]
+                matches.append("PHA.FLX_DIS_DTD IS NOT NULL")
+
+            if 'UCD' in dict_code:
+                on_condition = [f"A.{col} = UCD.{col}" for col in flux_key]
+                if dict_code['UCD']:
+                    liste_ucd_str = ', '.join(f"'{val}'" for val in dict_code['UCD'])
+                    on_condition.append(f"substr(UCD.UCD_UCD_COD, -7) IN ({liste_ucd_str})")
+                joins.append(f"LEFT JOIN ER_UCD_F{suffix} UCD ON (" + " AND ".join(on_condition) + ")")
+                columns += ["CASE WHEN UCD.FLX_DIS_DTD IS NULL THEN 0 ELSE 1 END AS IS_UCD", "UCD.UCD_UCD_COD", "substr(UCD.UCD_UCD_COD, -7) AS COD_UCD"]
+                matches.append("UCD.FLX_DIS_DTD IS NOT NULL")
+
+            where_condition = "WHERE " + " AND ".join(conditions + flux_conditions + [f"A.EXE_SOI_DTD BETWEEN '{deb.strftime('%Y-%m-%d')}' AND '{end.strftime('%Y-%m-%d')}'", 
+                                                                                       "(" + " OR ".join(matches) + ")"])
+            select_columns = ",\n                ".join(columns)
+            join_tables = "\n\n                ".join(joins)
+
+            queries.append(f"""
+
+                SELECT
+                {identity_columns['BEN_IDT_ANO']},
+                {identity_columns['BEN_NIR_PSA']},
+                {identity_columns['BEN_RNG_GEM']},
+                {same_gem},
+                A.EXE_SOI_DTD,
+                A.EXE_SOI_DTF,
+                {select_columns}
+                FROM ER_PRS_F{suffix} A
+
+                {identity_join}
+
+                {join_tables}
 
-    
+                {where_condition}
+            """)
+
+        return queries
 
 
     def loc_atc_pmsi(self, list_ATC, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], print_option=True, dev=False):
@@ -1216,63 +2632,50 @@ class SNDS_Query() :
         -------
         df_atc_pmsi : DataFrame
         DataFrame containing ATC codes and wording ('PHA_ATC_CLA', 'PHA_ATC_LIB') from the PMSI,
-        with their correspondance in UCD ('PHA_CIP_UCD') 
+        with their correspondance in UCD ('PHA_CIP_UCD')
         along with their execution dates ('EXE_SOI_DTD', 'EXE_SOI_DTF'),
         for each patient ('BEN_IDT_ANO') and specific hospital stays ('ETA_NUM', 'RSA_NUM').
         '''
 
-        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
-            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
-
-        if (list_ATC is None) or (type(list_ATC) != list):
-            raise ValueError("list_ATC must be a list of ATC medical codes.")
-
-        if (years is None) or (not isinstance(years, list)): 
-            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
-
-        if isinstance(years[0], datetime):
-            year_deb = int(str(years[0].year)[-2:])
-            deb = years[0]
-        else:
-            year_deb = str(years[0])[-2:]
-            deb = datetime(years[0], 1, 1)
-
-        if isinstance(years[1], datetime):
-            year_end = int(str(years[1].year)[-2:])
-            end = years[1]
-        else:
-            year_end = str(years[1])[-2:]
-            end = datetime(years[1], 12, 31)
-
-        liste_atc_str = ', '.join(f"'{valeur}'" for valeur in list_ATC)
-
-        query_ATC = f"""
-
-            SELECT DISTINCT
-            PHA_ATC_CLA,
-            PHA_ATC_LIB,
-            PHA_CIP_C13,
-            PHA_CIP_UCD
-            FROM IR_PHA_R
+        df_atc_cip_ucd = self._atc_codes(list_ATC, df_ID_PATIENT, years)
 
-            WHERE PHA_ATC_CLA IN ({liste_atc_str})
-        """ 
-        df_atc_cip_ucd = self.GetQuery(query_ATC)
-
-        if df_atc_cip_ucd.shape[0] !=0 : 
+        if df_atc_cip_ucd.shape[0] !=0 :
             list_UCD = df_atc_cip_ucd.PHA_CIP_UCD.tolist()
             df_atc_pmsi = self.loc_ucd_pmsi(df_ID_PATIENT, years=years, list_UCD=list_UCD, print_option=print_option, dev=dev)
-            df_atc_pmsi.drop_duplicates(inplace=True)
-            df_atc_pmsi.reset_index(drop=True, inplace=True)
+            df_atc_pmsi = self._union([df_atc_pmsi])
 
         else :
-            df_atc_pmsi = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'PHA_ATC_CO7', 'PHA_ATC_LO7'])
+            df_atc_pmsi = self._empty_frame(['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'PHA_ATC_CO7', 'PHA_ATC_LO7'])
             if print_option :
                 print('No patient identified using ATC codes in the PMSI.')
 
         return df_atc_pmsi
 
 
+    def iter_atc_pmsi(self, list_ATC, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], dev=False, chunksize=100000):
+        '''
+        Generator version of loc_atc_pmsi, yielding the ATC data of the PMSI by chunks of bounded size.
+
+        Parameters
+        ----------
+        list_ATC, df_ID_PATIENT, years, dev :
+            See loc_atc_pmsi.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunk with the columns of loc_ucd_pmsi. Chunks are not deduplicated against each other.
+        '''
+
+        df_atc_cip_ucd = self._atc_codes(list_ATC, df_ID_PATIENT, years)
+
+        if df_atc_cip_ucd.shape[0] == 0 :
+            return iter(())
+        return self.iter_ucd_pmsi(df_ID_PATIENT, years=years, list_UCD=df_atc_cip_ucd.PHA_CIP_UCD.tolist(), dev=dev, chunksize=chunksize)
+
+
     def loc_atc_dcir(self, list_ATC, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], print_option=True):
         '''
         Method for gathering specific ATC data from the targeted population in the DCIR.
@@ -1297,65 +2700,134 @@ class SNDS_Query() :
         for each patient ('BEN_IDT_ANO').
         '''
 
+        df_atc_cip_ucd = self._atc_codes(list_ATC, df_ID_PATIENT, years)
+
+        if df_atc_cip_ucd.shape[0] !=0 :
+            list_UCD = df_atc_cip_ucd.PHA_CIP_UCD.tolist()
+            list_CIP13 = df_atc_cip_ucd.PHA_CIP_C13.tolist()
+            df_ucd_dcir = self.loc_ucd_dcir(df_ID_PATIENT, years=years, list_UCD=list_UCD, print_option=print_option)
+            df_cip_dcir = self.loc_cip_dcir(df_ID_PATIENT, years=years, list_CIP13=list_CIP13, print_option=print_option)
+
+            df_atc_dcir = self._union([df_ucd_dcir, df_cip_dcir])
+
+        else :
+            df_atc_dcir = self._empty_frame(['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'PHA_ATC_CO7', 'PHA_ATC_LO7'])
+            if print_option :
+                print('No patient identified using ATC codes in the DCIR.')
+
+        return df_atc_dcir
+
+
+    def iter_atc_dcir(self, list_ATC, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], chunksize=100000):
+        '''
+        Generator version of loc_atc_dcir, yielding the ATC data of the DCIR by chunks of bounded size.
+
+        Parameters
+        ----------
+        list_ATC, df_ID_PATIENT, years :
+            See loc_atc_dcir.
+        chunksize : int, optional
+            Maximum number of rows of each chunk. Default is 100000.
+
+        Yields
+        ------
+        df_chunk : DataFrame
+            Chunks of iter_ucd_dcir followed by chunks of iter_cip_dcir. Chunks are not deduplicated against each other.
+        '''
+
+        df_atc_cip_ucd = self._atc_codes(list_ATC, df_ID_PATIENT, years)
+
+        if df_atc_cip_ucd.shape[0] == 0 :
+            return iter(())
+        return itertools.chain(self.iter_ucd_dcir(df_ID_PATIENT, years=years, list_UCD=df_atc_cip_ucd.PHA_CIP_UCD.tolist(), chunksize=chunksize),
+                               self.iter_cip_dcir(df_ID_PATIENT, years=years, list_CIP13=df_atc_cip_ucd.PHA_CIP_C13.tolist(), chunksize=chunksize))
+
+
+    def _atc_codes(self, list_ATC, df_ID_PATIENT, years):
+        '''
+        Retrieve the CIP-13 and UCD codes corresponding to a list of ATC codes in IR_PHA_R. 
+        An ATC code of a higher level of the hierarchy (e.g. 'L01') selects all the codes it contains.
+        '''
+
         if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
             raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
 
         if (list_ATC is None) or (type(list_ATC) != list):
             raise ValueError("list_ATC must be a list of ATC medical codes.")
 
-        if (years is None) or (not isinstance(years, list)): 
+        if (years is None) or (not isinstance(years, list)):
             raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
 
-        if isinstance(years[0], datetime):
-            year_deb = int(str(years[0].year)[-2:])
-            deb = years[0]
-        else:
-            year_deb = str(years[0])[-2:]
-            deb = datetime(years[0], 1, 1)
+        df_atc = self._referential()['ATC']
+        atc_codes = df_atc['PHA_ATC_CLA'].to_numpy(dtype=str)
 
-        if isinstance(years[1], datetime):
-            year_end = int(str(years[1].year)[-2:])
-            end = years[1]
-        else:
-            year_end = str(years[1])[-2:]
-            end = datetime(years[1], 12, 31)
+        # The codes are sorted : the codes starting with a prefix are contiguous
+        positions = [np.arange(np.searchsorted(atc_codes, str(code), side='left'), np.searchsorted(atc_codes, str(code) + '\uffff', side='left'))
+                     for code in list_ATC if str(code) != '']
+        positions = np.unique(np.concatenate(positions)) if len(positions) > 0 else np.array([], dtype=int)
 
-        liste_atc_str = ', '.join(f"'{valeur}'" for valeur in list_ATC)
+        df_atc_cip_ucd = df_atc.iloc[positions][['PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_CIP_C13', 'PHA_CIP_UCD']]
+        return df_atc_cip_ucd.drop_duplicates().reset_index(drop=True)
 
-        query_ATC = f"""
 
-            SELECT DISTINCT
-            PHA_ATC_CLA,
-            PHA_ATC_LIB,
-            PHA_CIP_C13,
-            PHA_CIP_UCD
-            FROM IR_PHA_R
+    def _referential(self):
+        '''
+        Return the IR_PHA_R referential, read once from the database and kept in memory : 
+        a dictionary with 'ATC' (all the rows, sorted by PHA_ATC_CLA for the lookups by prefix) 
+        and, for 'PHA_CIP_C13' and 'PHA_CIP_UCD', the ATC classes of each CIP-13 or UCD code.
+        '''
 
-            WHERE PHA_ATC_CLA IN ({liste_atc_str})
-        """ 
-        df_atc_cip_ucd = self.GetQuery(query_ATC)
+        if self._pha_r is None:
+            query_PHA = """
 
-        if df_atc_cip_ucd.shape[0] !=0 : 
-            list_UCD = df_atc_cip_ucd.PHA_CIP_UCD.tolist()
-            list_CIP13 = df_atc_cip_ucd.PHA_CIP_C13.tolist()
-            df_ucd_dcir = self.loc_ucd_dcir(df_ID_PATIENT, years=years, list_UCD=list_UCD, print_option=print_option)
-            df_cip_dcir = self.loc_cip_dcir(df_ID_PATIENT, years=years, list_CIP13=list_CIP13, print_option=print_option)
+                SELECT DISTINCT
+                PHA_CIP_C13,
+                PHA_CIP_UCD,
+                PHA_ATC_CLA,
+                PHA_ATC_LIB,
+                PHA_ATC_C07,
+                PHA_ATC_L07
+                FROM IR_PHA_R
+            """
+            df_pha = self.GetQuery(query_PHA)
 
-            df_atc_dcir = pd.concat([df_ucd_dcir, df_cip_dcir]).drop_duplicates().reset_index(drop=True)
-            df_atc_dcir.drop_duplicates(inplace=True)
-            df_atc_dcir.reset_index(drop=True, inplace=True)
+            pha_r = {'ATC': df_pha[df_pha['PHA_ATC_CLA'].notna()].sort_values('PHA_ATC_CLA', kind='stable').reset_index(drop=True)}
+            # As in a SQL join, codes which are missing do not match
+            for key in ['PHA_CIP_C13', 'PHA_CIP_UCD']:
+                df_key = df_pha.loc[df_pha[key].notna(), [key, 'PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07']]
+                pha_r[key] = df_key.drop_duplicates().reset_index(drop=True)
+            self._pha_r = pha_r
 
-        else :
-            df_atc_dcir = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'EXE_SOI_DTD', 'PHA_ATC_CO7', 'PHA_ATC_LO7'])
-            if print_option :
-                print('No patient identified using ATC codes in the DCIR.')
-        
-        return df_atc_dcir
+        return self._pha_r
+
+
+    def _enrich_atc(self, df, key, ref_key, columns):
+        '''
+        Add to df the ATC classes ('PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07') of its CIP-13 or UCD codes (column key), 
+        matched on the column ref_key of IR_PHA_R, with the columns ordered as in columns. Codes absent from IR_PHA_R get missing classes.
+        '''
+
+        atc_columns = ['PHA_ATC_CLA', 'PHA_ATC_LIB', 'PHA_ATC_C07', 'PHA_ATC_L07']
+
+        if self._is_spark_frame(df):
+            from pyspark.sql import functions as F
+            df_ref = self.conn.table("IR_PHA_R").where(F.col(ref_key).isNotNull()).select(F.col(ref_key).alias(key), *atc_columns).distinct()
+            df = df.join(F.broadcast(df_ref), on=key, how="left")
+            return df.select(self._ordered_columns(columns, df.columns))
+
+        df_ref = self._referential()[ref_key].rename(columns={ref_key: key})
+        # Codes stored as numbers in one table and as text in the other are converted as those of df
+        if pd.api.types.is_numeric_dtype(df_ref[key]) and not pd.api.types.is_numeric_dtype(df[key]):
+            df_ref = df_ref.astype({key: 'int64'}).astype({key: str})
+        elif pd.api.types.is_numeric_dtype(df[key]) and not pd.api.types.is_numeric_dtype(df_ref[key]):
+            df_ref = df_ref.assign(**{key: pd.to_numeric(df_ref[key], errors='coerce')}).dropna(subset=[key])
+        df = df.merge(df_ref, on=key, how="left")
+        return df[self._ordered_columns(columns, df.columns)]
 
 
 
 
-    def Get_records(self, df_ID_PATIENT, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_CCAM=None, list_ICD10=None, list_UCD=None, list_CIP13=None, list_ATC=None, export=False, path='', dev=False):
+    def Get_records(self, df_ID_PATIENT, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], list_CCAM=None, list_ICD10=None, list_UCD=None, list_CIP13=None, list_ATC=None, export=False, path='', dev=False, compact=False, export_format='pickle'):
         '''
         Method for getting patients records in a DataFrame and optionaly exporting it in pickle format.
 
@@ -1381,11 +2853,26 @@ class SNDS_Query() :
             The path where to export the dataframe.
         dev : bool, optional
             If True, this indicates that the study is performed on a simulated dataset, in which the PMSI does not have any tables referring to specific years. Default is False.
+        compact : bool, optional
+            If True, the records are returned in a long format using less memory : one row per code with the columns 'PATIENT_KEY' (int32), 
+            'DATE' (datetime64), 'CODE_SYSTEM' (categorical : 'CCAM', 'ICD10', 'UCD', 'CIP13', 'ATC') and 'CODE' (categorical), 
+            along with the DataFrame associating each 'PATIENT_KEY' with its 'BEN_IDT_ANO'. The memory used is printed. 
+            If export is True, the latter is exported as well (Patients.pkl). Default is False.
+        export_format : str, optional
+            Format of the export : 'pickle' (a single file Bdd.pkl) or 'parquet'. With 'parquet', the records of each code system are written 
+            as soon as they are extracted in the Parquet dataset path/Bdd, partitioned by code system and year (directories CODE_SYSTEM=.../YEAR=...), 
+            with the columns 'BEN_IDT_ANO', 'DATE' and 'CODE' (dictionary-encoded), compressed with zstd, and then released from memory : 
+            the dataset is returned instead of the records, and compact is not available. A dataset path/Bdd written by a previous export is replaced, 
+            any other content of path/Bdd raises an error. Requires pyarrow. Default is 'pickle'.
 
         Returns
         -------
         df_records : DataFrame
             Medical records of patients.
+        df_patients : DataFrame
+            Only if compact is True, identifiers ('BEN_IDT_ANO') of the patient keys ('PATIENT_KEY') of df_records.
+        dataset : pyarrow.dataset.Dataset
+            Only if export is True and export_format is 'parquet' (in the place of df_records), the Parquet dataset path/Bdd of the records.
         '''
 
         if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
@@ -1409,9 +2896,28 @@ class SNDS_Query() :
         if (years is None) or (not isinstance(years, list)): 
             raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
 
+        if export_format not in ['pickle', 'parquet']:
+            raise ValueError("export_format must be either 'pickle' or 'parquet'.")
+
+        # Records of each code system are written as soon as they are extracted, and not kept in memory
+        directory = None
+        if (export == True) and (export_format == 'parquet'):
+            if compact == True:
+                raise ValueError("compact is not available with export_format='parquet' : the records are written to the dataset instead of being kept in memory.")
+            directory = os.path.join(path, 'Bdd')
+            if os.path.lexists(directory):
+                # Only a dataset written by a previous export is replaced
+                if (not os.path.isdir(directory)) or os.path.islink(directory) or \
+                   any((not name.startswith('CODE_SYSTEM=')) or (not os.path.isdir(os.path.join(directory, name))) for name in os.listdir(directory)):
+                    raise ValueError(f"{directory} exists and is not a dataset of records exported by Get_records, remove it or choose another path.")
+                shutil.rmtree(directory)
+
+        # The DCIR is scanned once for the three types of code it holds
+        dcir = self.loc_dcir(df_ID_PATIENT, years=years, dict_code={'CCAM': list_CCAM, 'CIP13': list_CIP13, 'UCD': list_UCD}, print_option=True)
+
         # CCAM
-        CCAM_DCIR = self.loc_ccam_dcir(df_ID_PATIENT, years=years, list_CCAM=list_CCAM, print_option=True)
-        CCAM_PMSI = self.loc_ccam_pmsi(df_ID_PATIENT, years=years, list_CCAM=list_CCAM, print_option=True, dev=dev) 
+        CCAM_DCIR = self.collect(dcir.pop('CCAM'))
+        CCAM_PMSI = self.collect(self.loc_ccam_pmsi(df_ID_PATIENT, years=years, list_CCAM=list_CCAM, print_option=True, dev=dev)) 
         df_dcir = CCAM_DCIR[['BEN_IDT_ANO', 'CAM_PRS_IDE', 'EXE_SOI_DTD']].copy()
         df_dcir = df_dcir.rename(columns={
         'CAM_PRS_IDE': 'CODE',
@@ -1428,9 +2934,12 @@ class SNDS_Query() :
         df_ccam["COD_CCAM"] = df_ccam["CODE"]
         df_ccam["COD_ICD10"], df_ccam["COD_CIP"], df_ccam["COD_UCD"], df_ccam["COD_ATC"] = None, None, None, None
         df_ccam = df_ccam[["BEN_IDT_ANO", "DATE", "COD_CCAM", "COD_ICD10", "COD_CIP", "COD_UCD", "COD_ATC"]]
+        if directory is not None:
+            self._export_records(df_ccam, 'COD_CCAM', 'CCAM', directory)
+            del CCAM_DCIR, CCAM_PMSI, df_dcir, df_pmsi, CCAM_concat, df_ccam
 
         # ICD10
-        ICD10_PMSI = self.loc_icd10_pmsi(df_ID_PATIENT, years=years, list_ICD10=list_ICD10, print_option=True, dev=dev)
+        ICD10_PMSI = self.collect(self.loc_icd10_pmsi(df_ID_PATIENT, years=years, list_ICD10=list_ICD10, print_option=True, dev=dev))
         df_icd10 = pd.DataFrame({
         "BEN_IDT_ANO": ICD10_PMSI["BEN_IDT_ANO"],
         "DATE": ICD10_PMSI["EXE_SOI_DTD"],
@@ -1440,11 +2949,14 @@ class SNDS_Query() :
         "COD_UCD": None,
         "COD_ATC": None
         })
+        if directory is not None:
+            self._export_records(df_icd10, 'COD_ICD10', 'ICD10', directory)
+            del ICD10_PMSI, df_icd10
 
 
         # UCD
-        UCD_PMSI = self.loc_ucd_pmsi(df_ID_PATIENT, years=years, list_UCD=list_UCD, print_option=True, dev=dev)
-        UCD_DCIR = self.loc_ucd_dcir(df_ID_PATIENT, years=years, list_UCD=list_UCD, print_option=True)
+        UCD_PMSI = self.collect(self.loc_ucd_pmsi(df_ID_PATIENT, years=years, list_UCD=list_UCD, print_option=True, dev=dev))
+        UCD_DCIR = self.collect(dcir.pop('UCD'))
         UCD_concat = pd.concat([UCD_DCIR, UCD_PMSI], ignore_index=True)
         UCD_concat.sort_values(by=['BEN_IDT_ANO', 'EXE_SOI_DTD'], inplace=True)
 
@@ -1457,10 +2969,13 @@ class SNDS_Query() :
         "COD_UCD": UCD_concat["UCD_UCD_COD"],
         "COD_ATC": None
         })
+        if directory is not None:
+            self._export_records(df_ucd, 'COD_UCD', 'UCD', directory)
+            del UCD_PMSI, UCD_DCIR, UCD_concat, df_ucd
 
 
         # CIP
-        CIP_DCIR = self.loc_cip_dcir(df_ID_PATIENT, years=years, list_CIP13=list_CIP13, print_option=True)
+        CIP_DCIR = self.collect(dcir.pop('CIP13'))
         df_cip = pd.DataFrame({
         "BEN_IDT_ANO": CIP_DCIR["BEN_IDT_ANO"],
         "DATE": CIP_DCIR["EXE_SOI_DTD"],
@@ -1470,11 +2985,14 @@ class SNDS_Query() :
         "COD_UCD": None,
         "COD_ATC": None
         })
+        if directory is not None:
+            self._export_records(df_cip, 'COD_CIP', 'CIP13', directory)
+            del CIP_DCIR, df_cip
 
         # ATC
         if list_ATC is not None :
-            ATC_PMSI = self.loc_atc_pmsi(list_ATC=list_ATC, df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=True, dev=dev)
-            ATC_DCIR = self.loc_atc_dcir(list_ATC=list_ATC, df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=True)
+            ATC_PMSI = self.collect(self.loc_atc_pmsi(list_ATC=list_ATC, df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=True, dev=dev))
+            ATC_DCIR = self.collect(self.loc_atc_dcir(list_ATC=list_ATC, df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=True))
 
             ATC_concat = pd.concat([ATC_DCIR, ATC_PMSI], ignore_index=True)
             ATC_concat.sort_values(by=['BEN_IDT_ANO', 'EXE_SOI_DTD'], inplace=True)
@@ -1488,20 +3006,96 @@ class SNDS_Query() :
             "COD_UCD": None,
             "COD_ATC": ATC_concat["PHA_ATC_CLA"]
             })
+            if directory is not None:
+                self._export_records(df_atc, 'COD_ATC', 'ATC', directory)
+                del ATC_PMSI, ATC_DCIR, ATC_concat, df_atc
         else :
             df_atc = pd.DataFrame()
 
+        if directory is not None:
+            import pyarrow.dataset as ds
+            return ds.dataset(directory, format='parquet', partitioning='hive')
+
+
+        if compact == True:
+            df_records, df_patients = self._compact_records([(df_ccam, 'COD_CCAM', 'CCAM'), (df_icd10, 'COD_ICD10', 'ICD10'), (df_ucd, 'COD_UCD', 'UCD'), 
+                                                             (df_cip, 'COD_CIP', 'CIP13'), (df_atc, 'COD_ATC', 'ATC')])
+            size = df_records.memory_usage(index=True, deep=True).sum() + df_patients.memory_usage(index=True, deep=True).sum()
+            print(f"{len(df_records)} records of {len(df_patients)} patients, using {size / 2**20:.1f} MB in memory.")
+
+            if (export==True) and (export_format == 'pickle') :
+                df_records.to_pickle(path+'/Bdd.pkl')
+                df_patients.to_pickle(path+'/Patients.pkl')
+
+            return df_records, df_patients
 
         # Fusion
         df_records = pd.concat([df_ccam, df_icd10, df_ucd, df_cip, df_atc], ignore_index=True)
         df_records = df_records.sort_values(by=["BEN_IDT_ANO", "DATE"]).reset_index(drop=True)
 
-        if export==True :
+        if (export==True) and (export_format == 'pickle') :
             df_records.to_pickle(path+'/Bdd.pkl')
 
         return df_records
 
 
+    @staticmethod
+    def _export_records(df, column, system, directory):
+        '''
+        Append the records of a code system (column of the code in df) to the Parquet dataset directory, 
+        partitioned by code system and year of 'DATE', with dictionary-encoded codes and zstd compression.
+        '''
+
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is not installed, impossible to export the records in Parquet.")
+
+        if len(df) == 0:
+            return
+
+        dates = pd.to_datetime(df['DATE'], errors='coerce')
+        table = pa.table({
+            'BEN_IDT_ANO': pa.array(df['BEN_IDT_ANO'].astype(str).where(df['BEN_IDT_ANO'].notna()), type=pa.string()),
+            'DATE': pa.array(dates, type=pa.timestamp('ns')).cast(pa.date32()),
+            'CODE': pa.array(df[column].astype(str).where(df[column].notna()), type=pa.string()).dictionary_encode(),
+            'CODE_SYSTEM': pa.array([system] * len(df), type=pa.string()),
+            'YEAR': pa.array(dates.dt.year.astype('Int32'), type=pa.int32()),
+        })
+        pq.write_to_dataset(table, directory, partition_cols=['CODE_SYSTEM', 'YEAR'], basename_template=system + '-{i}.parquet', 
+                            existing_data_behavior='overwrite_or_ignore', compression='zstd', use_dictionary=['CODE'])
+
+
+    @staticmethod
+    def _compact_records(parts):
+        '''
+        Gather the records of Get_records in the long format of compact=True. 
+        parts is a list of (DataFrame with the columns 'BEN_IDT_ANO', 'DATE' and the column of the code, column of the code, name of the code system).
+        Return the records and the DataFrame of the patient keys.
+        '''
+
+        systems = [system for _, _, system in parts]
+        frames = [pd.DataFrame({'BEN_IDT_ANO': df['BEN_IDT_ANO'].to_numpy(), 'DATE': df['DATE'].to_numpy(), 
+                                'CODE_SYSTEM': pd.Categorical([system] * len(df), categories=systems), 'CODE': df[column].to_numpy()})
+                  for df, column, system in parts if len(df.columns) > 0]
+        df_long = pd.concat(frames, ignore_index=True)
+
+        # Patient keys follow the order of the identifiers, as the rows of the wide format
+        patient_keys, identifiers = pd.factorize(df_long['BEN_IDT_ANO'], sort=True)
+
+        df_records = pd.DataFrame({
+            'PATIENT_KEY': patient_keys.astype(np.int32),
+            'DATE': pd.to_datetime(df_long['DATE'], errors='coerce'),
+            'CODE_SYSTEM': df_long['CODE_SYSTEM'],
+            'CODE': df_long['CODE'].astype(str).where(df_long['CODE'].notna()).astype('category'),
+        })
+        df_records = df_records.sort_values(by=['PATIENT_KEY', 'DATE'], kind='stable').reset_index(drop=True)
+
+        df_patients = pd.DataFrame({'PATIENT_KEY': np.arange(len(identifiers), dtype=np.int32), 'BEN_IDT_ANO': identifiers})
+        return df_records, df_patients
+
+
 
         
 
@@ -1,15 +1,18 @@
 from .snds_query import SNDS_Query
+from .snds_event_store import SNDS_EventStore
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from functools import reduce
 
 class SNDS_Treatment(SNDS_Query) :
     """
     Class for detecting the presence of an event in the SNDS for a targeted population and determining its occurrence dates.
     """
 
-    def __init__(self, conn):
-        super().__init__(conn)
+    def __init__(self, conn, **kwargs):
+        super().__init__(conn, **kwargs)
+        self.event_store = None
 
     def Had_Treatment(self, dict_code, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], print_option=True, dev=False) :
         '''
@@ -45,42 +48,22 @@ class SNDS_Treatment(SNDS_Query) :
         if type(dict_code) != dict :
             raise ValueError("dict_code must be a dictionnary with keys 'CCAM', 'CIP13', 'UCD', 'ATC' and/or 'ICD10'.")
 
-        unique_identifier = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA'])
-
-        for key in dict_code :
+        if self.lazy:
+            return self._lazy_had_treatment(dict_code, df_ID_PATIENT, years, print_option, dev)
 
-            if key == 'CCAM' :
-                ccam_dcir = self.loc_ccam_dcir(list_CCAM=dict_code['CCAM'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option)
-                ccam_pmsi = self.loc_ccam_pmsi(list_CCAM=dict_code['CCAM'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev)
-            
-                unique_identifier_CCAM = pd.concat([ccam_dcir[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']], ccam_pmsi[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']]]).drop_duplicates().reset_index(drop=True)
-                unique_identifier = pd.DataFrame(pd.concat([unique_identifier, unique_identifier_CCAM], axis=0).drop_duplicates().reset_index(drop=True))
-                
-            if key == 'ICD10' :
-                icd10_pmsi = self.loc_icd10_pmsi(list_ICD10=dict_code['ICD10'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev)
-                unique_identifier_ICD10 = icd10_pmsi[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']].drop_duplicates().reset_index(drop=True)
-                unique_identifier = pd.DataFrame(pd.concat([unique_identifier, unique_identifier_ICD10], axis=0).drop_duplicates().reset_index(drop=True))
-                
-            if key == 'UCD' :
-                ucd_pmsi = self.loc_ucd_pmsi(list_UCD=dict_code['UCD'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev)
-                ucd_dcir = self.loc_ucd_dcir(df_ID_PATIENT=df_ID_PATIENT, years=years, list_UCD=dict_code['UCD'], print_option=print_option)
-                
-                unique_identifier_UCD = pd.concat([ucd_dcir[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']], ucd_pmsi[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']]]).drop_duplicates().reset_index(drop=True)
-                unique_identifier = pd.DataFrame(pd.concat([unique_identifier, unique_identifier_UCD], axis=0).drop_duplicates().reset_index(drop=True))
+        unique_identifier = pd.DataFrame(columns=['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA'])
 
-            if key == 'CIP13' :
-                cip13_dcir = self.loc_cip_dcir(list_CIP13=dict_code['CIP13'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option)
-                unique_identifier_CIP13 = cip13_dcir[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']].drop_duplicates().reset_index(drop=True)
-                unique_identifier = pd.DataFrame(pd.concat([unique_identifier, unique_identifier_CIP13], axis=0).drop_duplicates().reset_index(drop=True))
+        stored = self._stored_events(dict_code, df_ID_PATIENT, years, dev)
+        if stored is not None :
+            # The events are selected from the event store
+            for key, frames in stored :
+                unique_identifier = pd.concat([unique_identifier] + [df[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']] for df in frames], axis=0).drop_duplicates().reset_index(drop=True)
+                if print_option==True :
+                    print(str(self._n_patients(pd.concat(frames))) + ' patients identified using ' + key + ' code in the event store.')
 
-            if key == 'ATC' :
-                atc_pmsi = self.loc_atc_pmsi(list_ATC=dict_code['ATC'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev)
-                atc_dcir = self.loc_atc_dcir(df_ID_PATIENT=df_ID_PATIENT, years=years, list_ATC=dict_code['ATC'], print_option=print_option)
-                
-                unique_identifier_ATC = pd.concat([atc_dcir[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']], atc_pmsi[['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']]]).drop_duplicates().reset_index(drop=True)
-                unique_identifier = pd.DataFrame(pd.concat([unique_identifier, unique_identifier_ATC], axis=0).drop_duplicates().reset_index(drop=True))
+        else :
+            unique_identifier = self._event_patients(dict_code, df_ID_PATIENT, years, print_option, dev)
 
-                
         if df_ID_PATIENT is None :
             df_Treatment = unique_identifier.copy()
             df_Treatment["Response"] = 1
@@ -98,6 +81,289 @@ class SNDS_Treatment(SNDS_Query) :
         return df_Treatment
 
 
+    def _event_patients(self, dict_code, df_ID_PATIENT, years, print_option, dev):
+        '''
+        Return the patients having at least one code of dict_code in the DCIR or the PMSI, found with presence queries : the database only returns 
+        the distinct identifiers of the patients of each table (see _presence_queries), without the dates of the events nor their ATC classes.
+        The DCIR is scanned once for the CCAM, CIP-13 and UCD codes, its rows keeping the flags of the types of code of their claim.
+        '''
+
+        id_columns = ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']
+
+        def presence(build, identities, columns=None):
+            return self._collect_batches(lambda df_batch: self._presence_queries(build(df_batch), columns), df_ID_PATIENT, columns=columns or id_columns, identities=identities)
+
+        dict_dcir = {key: dict_code[key] for key in ['CCAM', 'CIP13', 'UCD'] if key in dict_code}
+        if len(dict_dcir) > 0 :
+            df_dcir = presence(lambda df: self._dcir_queries(df, years, dict_dcir), ['BEN_NIR_PSA'], ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'SAME_GEM'] + ['IS_' + key for key in dict_dcir])
+
+        frames = [pd.DataFrame(columns=id_columns)]
+        for key in dict_code :
+
+            sources = []
+            if key in dict_dcir :
+                # As in loc_dcir, UCD rows are matched to IR_BEN_R on BEN_NIR_PSA only
+                mask = (df_dcir['IS_' + key] == 1) if key == 'UCD' else ((df_dcir['IS_' + key] == 1) & (df_dcir['SAME_GEM'] == 1))
+                sources.append(('DCIR', df_dcir.loc[mask]))
+
+            if key == 'CCAM' :
+                sources.append(('PMSI', presence(lambda df: self._ccam_pmsi_queries(df, years, dict_code['CCAM'], dev), None)))
+
+            if key == 'ICD10' :
+                sources.append(('PMSI', presence(lambda df: self._icd10_pmsi_queries(df, years, dict_code['ICD10'], dev), None)))
+
+            if key == 'UCD' :
+                sources.append(('PMSI', presence(lambda df: self._ucd_pmsi_queries(df, years, dict_code['UCD'], dev), None)))
+
+            if key == 'ATC' :
+                df_atc_cip_ucd = self._atc_codes(dict_code['ATC'], df_ID_PATIENT, years)
+                if df_atc_cip_ucd.shape[0] != 0 :
+                    list_UCD, list_CIP13 = df_atc_cip_ucd.PHA_CIP_UCD.tolist(), df_atc_cip_ucd.PHA_CIP_C13.tolist()
+                    sources.append(('PMSI', presence(lambda df: self._ucd_pmsi_queries(df, years, list_UCD, dev), None)))
+                    sources.append(('DCIR', pd.concat([presence(lambda df: self._ucd_dcir_queries(df, years, list_UCD), ['BEN_NIR_PSA']), 
+                                                       presence(lambda df: self._cip_dcir_queries(df, years, list_CIP13), ['BEN_NIR_PSA', 'BEN_RNG_GEM'])], ignore_index=True)))
+
+            for source, df in sources :
+                frames.append(df[id_columns])
+                if print_option==True :
+                    print(str(self._n_patients(df)) + ' patients identified using ' + key + ' code in the ' + source + '.')
+
+        return pd.concat(frames, ignore_index=True).drop_duplicates().reset_index(drop=True)
+
+
+    def Had_Treatments(self, dict_treatments, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], print_option=True, dev=False) :
+        '''
+        Method to determine whether several events occur for a targeted population, in a single pass : the codes of all the events are gathered 
+        by type of code, each extraction of the DCIR and the PMSI is run once, and the patients of each event are found by membership tests on the codes.
+        The flag of each event is the response that Had_Treatment would return for its dictionary of codes.
+
+        Parameters
+        ----------
+        dict_treatments : dict
+            Dictionary mapping the name of each event to its dictionary of codes (see dict_code in Had_Treatment).
+        df_ID_PATIENT : DataFrame
+            DataFrame containing the columns "BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM", which holds the unique identifiers of the targeted population in the PMSI. If None, no filter is applied on patients identifiers.
+        years : list
+            List of dates (either years as integers or datetime(yyyy, mm, dd)) defining the period during which to search for codes. By default 1st of January 2020 and 31 of December 2020.
+        print_option : bool, optional
+            If True, prints the number of unique patients identified for each event. Default is True.
+        dev : bool, optional
+            If True, this indicates that the study is performed on a simulated dataset, in which the PMSI does not have any tables referring to specific years. Default is False.
+
+        Returns
+        -------
+        df_Treatments : DataFrame
+            DataFrame containing, for each patient in the targeted population ('BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA'), 
+            one column per event named after it, equal to 1 if the event occurs and 0 otherwise.
+        '''
+
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
+
+        if (years is None) or (not isinstance(years, list)):
+            raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
+
+        if (type(dict_treatments) != dict) or any(type(dict_code) != dict for dict_code in dict_treatments.values()):
+            raise ValueError("dict_treatments must be a dictionnary mapping the name of each event to a dictionnary with keys 'CCAM', 'CIP13', 'UCD', 'ATC' and/or 'ICD10'.")
+
+        id_columns = ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']
+
+        if self.lazy:
+            frames = [self._lazy_had_treatment(dict_code, df_ID_PATIENT, years, print_option, dev).withColumnRenamed("Response", name) for name, dict_code in dict_treatments.items()]
+            if len(frames) == 0:
+                return self._empty_frame(id_columns)
+            return reduce(lambda df_1, df_2: df_1.join(df_2, on=id_columns, how="outer"), frames).fillna(0, subset=list(dict_treatments))
+
+        stored = {name: self._stored_events(dict_code, df_ID_PATIENT, years, dev) for name, dict_code in dict_treatments.items()}
+        hits = {name: [] for name in dict_treatments}
+
+        if all(blocks is not None for blocks in stored.values()):
+            # Patients of each event, from the event store
+            for name, blocks in stored.items():
+                hits[name] = [df[id_columns] for _, frames in blocks for df in frames]
+
+        else:
+            # Codes of each event by type of code, the ATC codes being searched through their UCD and CIP-13 codes
+            matchers = {name: self._merge_atc(self._code_sets(dict_code, df_ID_PATIENT, years)) for name, dict_code in dict_treatments.items()}
+
+            # Patients of each event, from a single extraction of the codes of all the events
+            for df, columns, key, _ in self._extract_events(list(matchers.values()), df_ID_PATIENT, years, dev):
+                codes = {column: df[column].astype(str).where(df[column].notna()) for column in columns}
+                for name, matcher in matchers.items():
+                    if matcher[key] is None:
+                        continue
+                    if matcher[key] is True:
+                        hits[name].append(df[id_columns])
+                        continue
+                    mask = np.zeros(len(df), dtype=bool)
+                    for column in columns:
+                        mask |= codes[column].isin(matcher[key]).to_numpy()
+                    hits[name].append(df.loc[mask, id_columns])
+
+        hits = {name: pd.concat([pd.DataFrame(columns=id_columns)] + frames, ignore_index=True).drop_duplicates() for name, frames in hits.items()}
+
+        if df_ID_PATIENT is None :
+            df_Treatments = pd.concat([pd.DataFrame(columns=id_columns)] + list(hits.values()), ignore_index=True).drop_duplicates().reset_index(drop=True)
+        else :
+            df_Treatments = df_ID_PATIENT[id_columns].copy().reset_index(drop=True)
+            df_Treatments["BEN_RNG_GEM"] = df_Treatments["BEN_RNG_GEM"].astype(int)
+
+        patients = pd.MultiIndex.from_frame(df_Treatments[id_columns])
+        for name, df_hits in hits.items():
+            if df_ID_PATIENT is not None:
+                df_hits = df_hits.astype({"BEN_RNG_GEM": int})
+            df_Treatments[name] = patients.isin(pd.MultiIndex.from_frame(df_hits[id_columns])).astype(int)
+            if print_option==True :
+                print(str(df_Treatments[name].sum()) + ' unique patients identified for ' + str(name) + '.')
+
+        return df_Treatments
+
+
+    def build_event_store(self, dict_code, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], dev=False):
+        '''
+        Method for extracting once the events of the targeted population for a dictionary of codes, e.g. BC_medical_codes['All_BC_Codes'], 
+        and keeping them in memory for the session (attribute event_store). Had_Treatment, Had_Treatments, treatment_dates and first_date_treatment 
+        are then answered from the store with vectorized filters, instead of SQL queries, for any dictionary of codes it contains, 
+        the same period and dataset, and a population included in df_ID_PATIENT. Set event_store to None to query the database again.
+
+        Parameters
+        ----------
+        dict_code : dict
+            Dictionary of codes to extract. Each key represents a code type (possible keys: {'CCAM', 'CIP13', 'UCD', 'ATC', 'ICD10'}) and maps to a list of corresponding codes.
+        df_ID_PATIENT : DataFrame
+            DataFrame containing the columns "BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM", which holds the unique identifiers of the targeted population. If None, no filter is applied on patients identifiers.
+        years : list
+            List of dates (either years as integers or datetime(yyyy, mm, dd)) defining the period during which to search for codes. By default 1st of January 2020 and 31 of December 2020.
+        dev : bool, optional
+            If True, this indicates that the study is performed on a simulated dataset, in which the PMSI does not have any tables referring to specific years. Default is False.
+
+        Returns
+        -------
+        event_store : SNDS_EventStore
+            Events of the population, one row per event with the identifiers of the patient, its date ('DATE'), its source ('SOURCE', 'DCIR' or 'PMSI'), 
+            its type of code ('CODE_SYSTEM') and its code ('CODE'), sorted by patient and date.
+        '''
+
+        if (df_ID_PATIENT is not None) and (set(df_ID_PATIENT.columns) != {"BEN_IDT_ANO", "BEN_NIR_PSA", "BEN_RNG_GEM"}):
+            raise ValueError(f"df_ID_PATIENT must at least contain the following columns : BEN_IDT_ANO, BEN_NIR_PSA, BEN_RNG_GEM")
+
+        if type(dict_code) != dict :
+            raise ValueError("dict_code must be a dictionnary with keys 'CCAM', 'CIP13', 'UCD', 'ATC' and/or 'ICD10'.")
+
+        if self.lazy:
+            raise ValueError("The event store is kept in memory with pandas and is not available with lazy=True.")
+
+        code_sets = self._merge_atc(self._code_sets(dict_code, df_ID_PATIENT, years))
+
+        frames = [pd.DataFrame(columns=SNDS_EventStore.COLUMNS)]
+        for df, columns, key, source in self._extract_events([code_sets], df_ID_PATIENT, years, dev):
+            frames.append(pd.DataFrame({'BEN_IDT_ANO': df['BEN_IDT_ANO'], 
+                                        'BEN_NIR_PSA': df['BEN_NIR_PSA'], 
+                                        'BEN_RNG_GEM': df['BEN_RNG_GEM'], 
+                                        'DATE': pd.to_datetime(df['EXE_SOI_DTD']),
+                                        'SOURCE': source,
+                                        'CODE_SYSTEM': key,
+                                        'CODE': df[columns[0]],
+                                        'DGN_REL': df['DGN_REL'] if key == 'ICD10' else None,
+                                        'ASS_DGN': df['ASS_DGN'] if key == 'ICD10' else None,
+                                        'ATC': df['PHA_ATC_C07'] if 'PHA_ATC_C07' in df.columns else None}))
+
+        population = None
+        if (df_ID_PATIENT is not None) and (not df_ID_PATIENT.empty):
+            population = self._cohorts[self.register_cohort(df_ID_PATIENT)]
+
+        self.event_store = SNDS_EventStore(pd.concat([df for df in frames if not df.empty] or frames, ignore_index=True), code_sets, population, self._period(years), dev)
+        return self.event_store
+
+
+    def _code_sets(self, dict_code, df_ID_PATIENT, years):
+        '''
+        Return the codes of dict_code by type of code : for 'CCAM', 'ICD10', 'UCD' and 'CIP13', None if the type is not searched, True for all the codes of the type 
+        (empty list or None, as in the loc_* methods) or the set of codes ; for 'ATC', None or the sets of UCD and CIP-13 codes of the ATC classes, 
+        which loc_atc_pmsi and loc_atc_dcir search.
+        '''
+
+        code_sets = {key: None for key in ['CCAM', 'ICD10', 'UCD', 'CIP13', 'ATC']}
+        for key in ['CCAM', 'ICD10', 'UCD', 'CIP13']:
+            if key in dict_code:
+                code_sets[key] = True if not dict_code[key] else set(str(code) for code in dict_code[key])
+        if 'ATC' in dict_code:
+            df_atc_cip_ucd = self._atc_codes(dict_code['ATC'], df_ID_PATIENT, years)
+            code_sets['ATC'] = (set(df_atc_cip_ucd['PHA_CIP_UCD'].dropna().astype(str)), set(df_atc_cip_ucd['PHA_CIP_C13'].dropna().astype(str)))
+        return code_sets
+
+
+    @staticmethod
+    def _merge_atc(code_sets):
+        '''
+        Return the codes of code_sets (see _code_sets) by type of code of the DCIR and the PMSI, the UCD and CIP-13 codes of the ATC classes being added to 'UCD' and 'CIP13'.
+        '''
+
+        merged = {key: code_sets[key] for key in ['CCAM', 'ICD10', 'UCD', 'CIP13']}
+        if code_sets['ATC'] is not None:
+            for key, codes in zip(['UCD', 'CIP13'], code_sets['ATC']):
+                if (merged[key] is not True) and (len(codes) > 0):
+                    merged[key] = codes if merged[key] is None else merged[key] | codes
+        return merged
+
+
+    def _extract_events(self, list_code_sets, df_ID_PATIENT, years, dev):
+        '''
+        Run once the extractions of the DCIR and the PMSI for the union of the codes of list_code_sets (codes by type, see _merge_atc), 
+        and return a list of (DataFrame, code columns, type of code, source) for each extraction.
+        '''
+
+        # Codes to extract for each type of code, None for all the codes
+        dict_union = {}
+        for key in ['CCAM', 'ICD10', 'UCD', 'CIP13']:
+            codes = [code_sets[key] for code_sets in list_code_sets if code_sets[key] is not None]
+            if len(codes) > 0:
+                dict_union[key] = None if any(code is True for code in codes) else sorted(set().union(*codes))
+
+        events = []
+        dcir = self.loc_dcir(df_ID_PATIENT=df_ID_PATIENT, years=years, dict_code={key: dict_union[key] for key in ['CCAM', 'CIP13', 'UCD'] if key in dict_union}, print_option=False)
+        if 'CCAM' in dict_union:
+            events.append((dcir['CCAM'], ['CAM_PRS_IDE'], 'CCAM', 'DCIR'))
+            events.append((self.loc_ccam_pmsi(list_CCAM=dict_union['CCAM'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False, dev=dev), ['CDC_ACT'], 'CCAM', 'PMSI'))
+        if 'ICD10' in dict_union:
+            events.append((self.loc_icd10_pmsi(list_ICD10=dict_union['ICD10'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False, dev=dev), ['DGN_PAL', 'DGN_REL', 'ASS_DGN'], 'ICD10', 'PMSI'))
+        if 'UCD' in dict_union:
+            events.append((dcir['UCD'], ['COD_UCD'], 'UCD', 'DCIR'))
+            events.append((self.loc_ucd_pmsi(list_UCD=dict_union['UCD'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False, dev=dev), ['COD_UCD'], 'UCD', 'PMSI'))
+        if 'CIP13' in dict_union:
+            events.append((dcir['CIP13'], ['PHA_CIP_C13'], 'CIP13', 'DCIR'))
+        return events
+
+
+    def _stored_events(self, dict_code, df_ID_PATIENT, years, dev):
+        '''
+        Return the events of dict_code from the event store, as a list of (key of dict_code, list of DataFrames) in the order of the loc_* methods of treatment_dates, 
+        or None if there is no event store or it does not contain these events.
+        '''
+
+        if (self.event_store is None) or self.lazy:
+            return None
+
+        code_sets = self._code_sets(dict_code, df_ID_PATIENT, years)
+        if not self.event_store.covers(self._merge_atc(code_sets), df_ID_PATIENT, self._period(years), dev):
+            return None
+
+        # (type of code, source) of the loc_* methods used for each key, the ATC classes being searched through their UCD and CIP-13 codes
+        sources = {'CCAM': [('CCAM', 'DCIR'), ('CCAM', 'PMSI')], 'ICD10': [('ICD10', 'PMSI')], 'UCD': [('UCD', 'PMSI'), ('UCD', 'DCIR')], 'CIP13': [('CIP13', 'DCIR')], 
+                   'ATC': [('UCD', 'PMSI'), ('UCD', 'DCIR'), ('CIP13', 'DCIR')]}
+
+        blocks = []
+        for key in dict_code:
+            if key not in sources:
+                continue
+            frames = []
+            for code_system, source in sources[key]:
+                codes = code_sets[code_system] if key != 'ATC' else code_sets['ATC'][0 if code_system == 'UCD' else 1]
+                frames.append(self.event_store.select(code_system, codes, source, df_ID_PATIENT))
+            blocks.append((key, frames))
+        return blocks
+
+
     def treatment_dates(self, dict_code, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], dev=False) :
         '''
         Method to retrieve the occurrence dates of a specific event for the targeted population.
@@ -130,12 +396,22 @@ class SNDS_Treatment(SNDS_Query) :
         if type(dict_code) != dict :
             raise ValueError("dict_code must be a dictionnary with keys 'CCAM', 'CIP13', 'UCD', 'ATC',  and/or 'ICD10'.")
 
+        if self.lazy:
+            return self._lazy_treatment_dates(dict_code, df_ID_PATIENT, years, dev)
+
+        stored = self._stored_events(dict_code, df_ID_PATIENT, years, dev)
+        if stored is not None:
+            return self._stored_treatment_dates(stored)
+
+        # The DCIR is scanned once for all the types of code it holds
+        dcir = self.loc_dcir(df_ID_PATIENT=df_ID_PATIENT, years=years, dict_code={key: dict_code[key] for key in ['CCAM', 'CIP13', 'UCD'] if key in dict_code}, print_option=False)
+
         df_date = pd.DataFrame(columns=['BEN_IDT_ANO', 'COD_ACT', 'COD_DIAG', 'COD_UCD', 'COD_CIP', 'COD_ATC', 'DATE'])
         
         for key in dict_code :
 
             if key == 'CCAM' :
-                ccam_dcir = self.loc_ccam_dcir(list_CCAM=dict_code['CCAM'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False)
+                ccam_dcir = dcir['CCAM']
                 ccam_pmsi = self.loc_ccam_pmsi(list_CCAM=dict_code['CCAM'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False, dev=dev)
                 ccam_pmsi['DATE'] = pd.to_datetime(ccam_pmsi['EXE_SOI_DTD']) #+ pd.to_timedelta(ccam_pmsi['ENT_DAT_DEL'], unit='days')
                 
@@ -169,7 +445,7 @@ class SNDS_Treatment(SNDS_Query) :
             if key == 'UCD' :
                 ucd_pmsi = self.loc_ucd_pmsi(list_UCD=dict_code['UCD'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False, dev=dev)
                 ucd_pmsi['DATE'] = pd.to_datetime(ucd_pmsi['EXE_SOI_DTD']) #+ pd.to_timedelta(ucd_pmsi['DELAI'], unit='days')
-                ucd_dcir = self.loc_ucd_dcir(list_UCD=dict_code['UCD'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False)
+                ucd_dcir = dcir['UCD']
 
                 df_ucd = pd.DataFrame({'BEN_IDT_ANO' : np.concatenate((ucd_pmsi.BEN_IDT_ANO, ucd_dcir.BEN_IDT_ANO)),
                                        'BEN_NIR_PSA' : np.concatenate((ucd_pmsi.BEN_NIR_PSA, ucd_dcir.BEN_NIR_PSA)),
@@ -184,7 +460,7 @@ class SNDS_Treatment(SNDS_Query) :
                 df_date = pd.concat([d for d in [df_date, df_ucd] if not d.empty], ignore_index=True)
 
             if key == 'CIP13' :
-                cip_dcir = self.loc_cip_dcir(list_CIP13=dict_code['CIP13'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=False)
+                cip_dcir = dcir['CIP13']
 
                 df_cip = pd.DataFrame({'BEN_IDT_ANO' : cip_dcir.BEN_IDT_ANO,
                                        'BEN_NIR_PSA' : cip_dcir.BEN_NIR_PSA,
@@ -220,6 +496,39 @@ class SNDS_Treatment(SNDS_Query) :
         return df_date
     
 
+    @staticmethod
+    def _stored_treatment_dates(stored):
+        '''
+        Build the result of treatment_dates from the events selected in the event store (see _stored_events).
+        '''
+
+        code_columns = {'CCAM': 'COD_ACT', 'ICD10': 'COD_DIAG', 'UCD': 'COD_UCD', 'CIP13': 'COD_CIP', 'ATC': 'COD_ATC'}
+
+        df_date = pd.DataFrame(columns=['BEN_IDT_ANO', 'COD_ACT', 'COD_DIAG', 'COD_UCD', 'COD_CIP', 'COD_ATC', 'DATE'])
+
+        for key, frames in stored :
+            df = pd.concat(frames)
+            if (key == 'ATC') and df.empty :
+                continue
+
+            df_key = pd.DataFrame({'BEN_IDT_ANO' : df.BEN_IDT_ANO.to_numpy(),
+                                   'BEN_NIR_PSA' : df.BEN_NIR_PSA.to_numpy(),
+                                   'BEN_RNG_GEM' : df.BEN_RNG_GEM.to_numpy(),
+                                   'COD_ACT' : np.nan,
+                                   'COD_DIAG' : np.nan,
+                                   'COD_UCD' : np.nan,
+                                   'COD_CIP' : np.nan,
+                                   'COD_ATC' : np.nan,
+                                   'DATE' : df.DATE.dt.strftime('%Y-%m-%d').to_numpy()})
+            df_key[code_columns[key]] = np.asarray(df['ATC' if key == 'ATC' else 'CODE'], dtype=object)
+
+            df_date = pd.concat([d for d in [df_date, df_key] if not d.empty], ignore_index=True)
+            if key == 'ATC' :
+                df_date["DATE"] = pd.to_datetime(df_date["DATE"], format="%Y-%m-%d", errors="coerce")
+
+        return df_date
+
+
     def first_date_treatment(self, dict_code, df_ID_PATIENT=None, years=[datetime(2020, 1, 1), datetime(2020, 12, 31)], dev=False):
         '''
         Method to retrieve the firt occurrence date of a specific event for the targeted population.
@@ -251,7 +560,148 @@ class SNDS_Treatment(SNDS_Query) :
         if (years is None) or (not isinstance(years, list)):
             raise ValueError("`years` must be a list containing the start and end dates, either as integers (years) or as datetime objects (e.g., datetime(yyyy, mm, dd)).")
        
-        df_date = self.treatment_dates(dict_code=dict_code, df_ID_PATIENT=df_ID_PATIENT, years=years, dev=dev)
-        df_date["DATE"] = pd.to_datetime(df_date["DATE"], format="%Y-%m-%d", errors="coerce")
-        
-        return df_date.groupby(['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'])['DATE'].min().reset_index()
+        if self.lazy:
+            from pyspark.sql import functions as F
+            df_date = self.treatment_dates(dict_code=dict_code, df_ID_PATIENT=df_ID_PATIENT, years=years, dev=dev)
+            return df_date.groupBy('BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM').agg(F.min('DATE').alias('DATE'))
+
+        def extract():
+            stored = self._stored_events(dict_code, df_ID_PATIENT, years, dev)
+            if stored is not None:
+                df_date = self._stored_treatment_dates(stored)
+            else:
+                df_date = self._first_dates(dict_code, df_ID_PATIENT, years, dev)
+
+            df_date["DATE"] = pd.to_datetime(df_date["DATE"], format="%Y-%m-%d", errors="coerce")
+
+            return df_date.groupby(['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM'])['DATE'].min().reset_index()
+
+        # The first dates of a patient only serve the same codes and period, e.g. the date of surgery computed by each call of treatment_setting
+        codes = [f"{key}:{code}" for key in dict_code for code in (dict_code[key] or ['*'])]
+        return self._memoized('first_date_treatment', None, df_ID_PATIENT, years, codes, None, extract, dev=dev, date_column=None)
+
+
+    def _first_dates(self, dict_code, df_ID_PATIENT, years, dev):
+        '''
+        Return the first occurrence dates of the event computed by the database : each query of the DCIR and the PMSI returns 
+        the minimum date of each patient (see _first_date_queries) instead of all the rows of treatment_dates, which are not transferred. 
+        The DCIR queries are mapped to the patients as in the loc_* methods, so a patient may have one date per source, reduced by first_date_treatment.
+        '''
+
+        # (queries of a population, identities of the DCIR rows as in _collect_batches)
+        sources = []
+        for key in dict_code :
+
+            if key == 'CCAM' :
+                sources.append((lambda df, codes=dict_code['CCAM']: self._ccam_dcir_queries(df, years, codes), ['BEN_NIR_PSA', 'BEN_RNG_GEM']))
+                sources.append((lambda df, codes=dict_code['CCAM']: self._ccam_pmsi_queries(df, years, codes, dev), None))
+
+            if key == 'ICD10' :
+                sources.append((lambda df, codes=dict_code['ICD10']: self._icd10_pmsi_queries(df, years, codes, dev), None))
+
+            if key == 'UCD' :
+                sources.append((lambda df, codes=dict_code['UCD']: self._ucd_pmsi_queries(df, years, codes, dev), None))
+                sources.append((lambda df, codes=dict_code['UCD']: self._ucd_dcir_queries(df, years, codes), ['BEN_NIR_PSA']))
+
+            if key == 'CIP13' :
+                sources.append((lambda df, codes=dict_code['CIP13']: self._cip_dcir_queries(df, years, codes), ['BEN_NIR_PSA', 'BEN_RNG_GEM']))
+
+            if key == 'ATC' :
+                df_atc_cip_ucd = self._atc_codes(dict_code['ATC'], df_ID_PATIENT, years)
+                if df_atc_cip_ucd.shape[0] != 0 :
+                    list_UCD, list_CIP13 = df_atc_cip_ucd.PHA_CIP_UCD.tolist(), df_atc_cip_ucd.PHA_CIP_C13.tolist()
+                    sources.append((lambda df, codes=list_UCD: self._ucd_pmsi_queries(df, years, codes, dev), None))
+                    sources.append((lambda df, codes=list_UCD: self._ucd_dcir_queries(df, years, codes), ['BEN_NIR_PSA']))
+                    sources.append((lambda df, codes=list_CIP13: self._cip_dcir_queries(df, years, codes), ['BEN_NIR_PSA', 'BEN_RNG_GEM']))
+
+        columns = ['BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM', 'DATE']
+        frames = [pd.DataFrame(columns=columns)]
+        for build, identities in sources :
+            df_source = self._collect_batches(lambda df_batch, build=build: self._first_date_queries(build(df_batch)), df_ID_PATIENT, columns=columns, distinct=False, identities=identities)
+            frames.append(df_source[columns])
+
+        df_date = pd.concat([d for d in frames if not d.empty] or frames[:1], ignore_index=True)
+        df_date['DATE'] = pd.to_datetime(df_date['DATE']).dt.strftime('%Y-%m-%d')
+        return df_date
+
+
+    def _lazy_events(self, dict_code, df_ID_PATIENT, years, dev, print_option=False):
+        '''
+        Return, as Spark DataFrames, the results of the loc_* methods for each type of code of dict_code, 
+        along with the name of their code column and the type of code in the output of treatment_dates.
+        '''
+
+        # The DCIR is scanned once for all the types of code it holds
+        dcir = self.loc_dcir(df_ID_PATIENT=df_ID_PATIENT, years=years, dict_code={key: dict_code[key] for key in ['CCAM', 'CIP13', 'UCD'] if key in dict_code}, print_option=print_option)
+
+        events = []
+        for key in dict_code :
+
+            if key == 'CCAM' :
+                events.append((dcir['CCAM'], 'CAM_PRS_IDE', 'COD_ACT'))
+                events.append((self.loc_ccam_pmsi(list_CCAM=dict_code['CCAM'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev), 'CDC_ACT', 'COD_ACT'))
+
+            if key == 'ICD10' :
+                events.append((self.loc_icd10_pmsi(list_ICD10=dict_code['ICD10'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev), 'DGN_PAL', 'COD_DIAG'))
+
+            if key == 'UCD' :
+                events.append((self.loc_ucd_pmsi(list_UCD=dict_code['UCD'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev), 'COD_UCD', 'COD_UCD'))
+                events.append((dcir['UCD'], 'COD_UCD', 'COD_UCD'))
+
+            if key == 'CIP13' :
+                events.append((dcir['CIP13'], 'PHA_CIP_C13', 'COD_CIP'))
+
+            if key == 'ATC' :
+                events.append((self.loc_atc_pmsi(list_ATC=dict_code['ATC'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option, dev=dev), 'PHA_ATC_C07', 'COD_ATC'))
+                events.append((self.loc_atc_dcir(list_ATC=dict_code['ATC'], df_ID_PATIENT=df_ID_PATIENT, years=years, print_option=print_option), 'PHA_ATC_C07', 'COD_ATC'))
+
+        return events
+
+
+    def _lazy_had_treatment(self, dict_code, df_ID_PATIENT, years, print_option, dev):
+        '''
+        Spark version of Had_Treatment, returning a Spark DataFrame.
+        '''
+
+        from pyspark.sql import functions as F
+
+        id_columns = ['BEN_IDT_ANO', 'BEN_RNG_GEM', 'BEN_NIR_PSA']
+        frames = [df.select(*id_columns) for df, _, _ in self._lazy_events(dict_code, df_ID_PATIENT, years, dev, print_option)]
+        if len(frames) == 0:
+            frames = [self._empty_frame(id_columns)]
+        unique_identifier = reduce(lambda df_1, df_2: df_1.unionByName(df_2), frames).distinct()
+
+        if df_ID_PATIENT is None :
+            df_Treatment = unique_identifier.withColumn("Response", F.lit(1))
+        else :
+            df_Treatment = self.conn.table(self.register_cohort(df_ID_PATIENT)).select(*id_columns)
+            df_Treatment = df_Treatment.withColumn("BEN_RNG_GEM", F.col("BEN_RNG_GEM").cast("int"))
+            unique_identifier = unique_identifier.withColumn("BEN_RNG_GEM", F.col("BEN_RNG_GEM").cast("int")).withColumn("Response", F.lit(1))
+            df_Treatment = df_Treatment.join(unique_identifier, on=id_columns, how="left").fillna(0, subset=["Response"])
+
+        if print_option==True :
+            print(str(df_Treatment.filter(F.col("Response") == 1).count()) + ' unique patients identified.')
+
+        return df_Treatment
+
+
+    def _lazy_treatment_dates(self, dict_code, df_ID_PATIENT, years, dev):
+        '''
+        Spark version of treatment_dates, returning a Spark DataFrame whose column DATE is of date type.
+        '''
+
+        from pyspark.sql import functions as F
+
+        code_columns = ['COD_ACT', 'COD_DIAG', 'COD_UCD', 'COD_CIP', 'COD_ATC']
+        frames = []
+        for df, code_column, code_type in self._lazy_events(dict_code, df_ID_PATIENT, years, dev):
+            if code_column not in df.columns:
+                # Empty result of loc_atc_* when no code matches in IR_PHA_R
+                continue
+            frames.append(df.select('BEN_IDT_ANO', 'BEN_NIR_PSA', 'BEN_RNG_GEM',
+                                    *[(F.col(code_column) if col == code_type else F.lit(None)).cast("string").alias(col) for col in code_columns],
+                                    F.to_date(F.col('EXE_SOI_DTD')).alias('DATE')))
+
+        if len(frames) == 0:
+            return self.conn.createDataFrame([], "BEN_IDT_ANO string, BEN_NIR_PSA string, BEN_RNG_GEM string, " + ", ".join(f"{col} string" for col in code_columns) + ", DATE date")
+        return reduce(lambda df_1, df_2: df_1.unionByName(df_2), frames)
@@ -0,0 +1,16 @@
+import sqlite3
+import pytest
+
+from pysnds import SNDS_Query
+
+
+def test_get_arrow_mixed_types_across_batches():
+    pytest.importorskip("pyarrow")
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE T (X, Y REAL)")
+    conn.executemany("INSERT INTO T VALUES (?, ?)", [(1, 1.5), (2, None), ('a', 2.0), (3, None)])
+
+    table = SNDS_Query(conn).GetArrow("SELECT X, Y FROM T", batch_size=2)
+
+    assert table.column('X').to_pylist() == ['1', '2', 'a', '3']
+    assert table.column('Y').to_pylist() == [1.5, None, 2.0, None]